@@ -1,215 +1,407 @@
 import azure.functions as func
-from azure.identity import ManagedIdentityCredential
-from azure.mgmt.appcontainers import ContainerAppsAPIClient
+import asyncio
 import logging
 import json
-from time import time
 import os
 
-from launcher.azure_storage_utils import AzureUtils
-from launcher.jobsetup import MissingFilesError
-from launcher.pdb2pqr import PDB2PQRRunner
-from launcher.apbs import APBSRunner
+from launcher.batch import job_blobs, submit_job_blobs, validation_response
+from launcher.bulk_submission import BulkSubmissionError, parse_body, submit_jobs
+from launcher.claim_check import encode_message
+from launcher.dispatch import dispatch_submission, dispatch_submission_async
+from launcher.jobtypes import prepare_job, prepare_job_async
+from launcher.ledger import (
+    claim_delivery,
+    claim_delivery_async,
+    delivery_fingerprint,
+    idempotency_enabled,
+    submit_claimed,
+    submit_claimed_async,
+)
+from launcher.pdb_mirror import PDB_MIRROR_QUEUE, fill_pdb_mirror, pdb_mirror_enabled
+from launcher.pipeline import (
+    advance_pipeline,
+    parse_status_blob_name,
+    pipelines_enabled,
+    run_stage,
+)
+from launcher.result_cache import record_result, result_cache_enabled
+from launcher.runtime_estimator import (
+    record_runtime,
+    refit_runtime_model,
+    runtime_refit_enabled,
+)
+from launcher.scheduler import autoscale_executions, request_container_start
+from launcher.subjobs import (
+    parse_subjob_status_name,
+    reduce_subjobs,
+    run_follow_up,
+)
+from launcher.storage import get_storage
+from launcher.submission import (
+    build_status_dict,
+    parse_job_blob_name,
+)
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
 
 def upload_status_file(filename: str, inital_status: dict):
-    AzureUtils.put_object("outputs", filename, json.dumps(inital_status))
+    get_storage().put_object("outputs", filename, json.dumps(inital_status))
+
+
+async def upload_status_file_async(filename: str, inital_status: dict):
+    await get_storage().to_async().put_object(
+        "outputs", filename, json.dumps(inital_status)
+    )
 
 
 def get_job_info(tag: str, container: str, object_name: str) -> dict:
-    return AzureUtils.get_azure_object_json(tag, container, object_name)
-
-
-def build_status_dict(
-    job_id: str,
-    job_tag: str,
-    job_type: str,
-    status: str,
-    inputfile_list: list,
-    outputfile_list: list,
-    message: str = "",
-) -> dict:
-    """Build a dictionary for the initial status
-
-    :param job_id str: Identifier string for specific job
-    :param job_type str: Name of job type (e.g. 'apbs', 'pdb2pqr')
-    :param status str: A string indicating initial status of job
-    :param inputfile_list list: List of current input files
-    :param outputfile_list list: List of current output files
-    :param message: Optional message to add to status
-    :type message: optional
-
-    :return: a JSON-compatible dictionary containing initial status
-             info of the job
-    :rtype: dict
-    """
+    return get_storage().get_object_json(tag, container, object_name)
+
+
+async def get_job_info_async(tag: str, container: str, object_name: str) -> dict:
+    return await get_storage().to_async().get_object_json(tag, container, object_name)
+
+
+def _log_job(job_id: str, date: str, file_name: str):
+    logging.info(f"Job ID: {job_id}")
+    logging.info(f"Date: {date}")
+    logging.info(f"File Name: {file_name}")
 
-    # TODO: 2021/03/02, Elvis - add submission time to initial status
-    # TODO: 2021/03/25, Elvis - Reconstruct format of status since
-    #                           they're constructed on a per-job basis
-
-    initial_status_dict = {
-        "jobid": job_id,
-        "jobtype": job_type,
-        job_type: {
-            "status": status,
-            "startTime": time(),
-            "endTime": None,
-            "subtasks": [],
-            "inputFiles": inputfile_list,
-            "outputFiles": outputfile_list,
-        },
-        "metadata": {"versions": {}},
-    }
-
-    # if message is not None:
-    if status == "invalid":
-        initial_status_dict[job_type]["message"] = message
-        initial_status_dict[job_type]["startTime"] = None
-        initial_status_dict[job_type]["subtasks"] = None
-        initial_status_dict[job_type]["inputFiles"] = None
-        initial_status_dict[job_type]["outputFiles"] = None
-
-    logging.info(f"{job_tag} Initial Status: {initial_status_dict}")
-    return initial_status_dict
-
-
-def start_container_job():
-    logging.info("In start container job")
-    client_id = os.getenv("CONTAINER_APP_CLIENT_ID")
-    if client_id is None:
-        logging.error("No client ID found for Managed Identity")
-        return
-    subscription_id = os.getenv("SUBSCRIPTION_ID")
-    if subscription_id is None:
-        logging.error("No subscription ID found for Managed Identity")
-        return
 
-    resource_group_name = os.getenv("RESOURCE_GROUP_NAME")
-    if resource_group_name is None:
-        logging.error("No resource group name found for Managed Identity")
+def BlobTrigger(client: func.InputStream, msg: func.Out[str]):
+    name = client.name
+    if not name:
+        logging.error("No name found for blob")
         return
-    job_name = os.getenv("JOB_NAME")
-    if job_name is None:
-        logging.error("No job name found for Managed Identity")
+    cleaned = name.replace("inputs/", "")
+    date, job_id, file_name, type = parse_job_blob_name(name)
+    tag = f"{date}/{job_id}"
+    _log_job(job_id, date, file_name)
+    claims = []
+    if idempotency_enabled():
+        claim = claim_delivery(
+            get_storage(), tag, file_name, delivery_fingerprint(client)
+        )
+        if claim is None:
+            return
+        claims.append(claim)
+
+    def submit():
+        form = get_job_info(tag, "inputs", cleaned)["form"]
+        submission = prepare_job(type, form, job_id, date)
+
+        initial_status: dict = submission.status_dict()
+        logging.info(
+            f"Uploading {submission.status_object} to outputs: {initial_status}"
+        )
+        upload_status_file(submission.status_object, initial_status)
+        if submission.should_queue:
+            dispatch_submission(submission, msg)
+
+    submit_claimed(get_storage(), claims, submit)
+
+
+async def BlobTriggerAsync(client: func.InputStream, msg: func.Out[str]):
+    """Asyncio variant of BlobTrigger, enabled with ASYNC_BLOB_TRIGGER.
+
+    Storage I/O is awaited instead of holding a worker thread, and the status
+    upload overlaps with starting the container job.
+    """
+    name = client.name
+    if not name:
+        logging.error("No name found for blob")
         return
-    logging.info("Starting poll")
+    cleaned = name.replace("inputs/", "")
+    date, job_id, file_name, type = parse_job_blob_name(name)
+    tag = f"{date}/{job_id}"
+    _log_job(job_id, date, file_name)
+    claims = []
+    if idempotency_enabled():
+        claim = await claim_delivery_async(
+            get_storage(), tag, file_name, delivery_fingerprint(client)
+        )
+        if claim is None:
+            return
+        claims.append(claim)
+
+    async def submit():
+        form = (await get_job_info_async(tag, "inputs", cleaned))["form"]
+        submission = await prepare_job_async(type, form, job_id, date)
+
+        initial_status: dict = submission.status_dict()
+        logging.info(
+            f"Uploading {submission.status_object} to outputs: {initial_status}"
+        )
+        pending = [upload_status_file_async(submission.status_object, initial_status)]
+        if submission.should_queue:
+            pending.append(dispatch_submission_async(submission, msg))
+        await asyncio.gather(*pending)
+
+    await submit_claimed_async(get_storage(), claims, submit)
+
+
+async def EventGridBatch(
+    req: func.HttpRequest, msg: func.Out[str]
+) -> func.HttpResponse:
+    """Event Grid webhook taking batches of job blob BlobCreated events."""
+    if req.method == "OPTIONS":
+        # CloudEvents schema subscription handshake
+        return func.HttpResponse(
+            status_code=200,
+            headers={
+                "WebHook-Allowed-Origin": req.headers.get("WebHook-Request-Origin", "*")
+            },
+        )
     try:
-        credential = ManagedIdentityCredential(client_id=client_id)
-        logging.info("Successful credential call")
+        events = req.get_json()
+    except ValueError:
+        return func.HttpResponse("Invalid JSON", status_code=400)
+    if isinstance(events, dict):
+        events = [events]
+
+    validation = validation_response(events)
+    if validation is not None:
+        logging.info("Validating the Event Grid subscription")
+        return func.HttpResponse(json.dumps(validation), mimetype="application/json")
+
+    blobs = job_blobs(events)
+    logging.info(f"{len(blobs)} job blob(s) in {len(events)} event(s)")
+    result = await submit_job_blobs(blobs, msg)
+    return func.HttpResponse(
+        json.dumps(
+            {
+                "jobs": [submission.job_tag for submission in result.submissions],
+                "failed": [submission.job_tag for submission in result.errors],
+            }
+        ),
+        # Event Grid retries the delivery on an error response
+        status_code=500 if result.errors else 200,
+        mimetype="application/json",
+    )
 
-        client = ContainerAppsAPIClient(credential, subscription_id)
-        logging.info("Client created")
 
-        logging.info("Checking job status")
-        job_info = client.jobs.get(
-            resource_group_name=resource_group_name, job_name=job_name
+if os.getenv("EVENT_GRID_BATCH", "").lower() in ("1", "true"):
+    app.function_name(name="EventGridBatch")(
+        app.route(
+            route="eventgrid/jobs",
+            methods=["POST", "OPTIONS"],
+            auth_level=func.AuthLevel.FUNCTION,
+        )(
+            app.queue_output(
+                arg_name="msg",
+                queue_name="apbsbackendqueue",
+                connection="OutputQueue",
+            )(EventGridBatch)
         )
-        logging.info(f"Current info: {job_info}")
+    )
+
 
-        poller = client.jobs.begin_start(
-            resource_group_name=resource_group_name, job_name=job_name
+async def SubmitJobs(req: func.HttpRequest, msg: func.Out[str]) -> func.HttpResponse:
+    """Submit a JSON array or NDJSON body of jobs in one request."""
+    try:
+        jobs = parse_body(req.get_body())
+    except BulkSubmissionError as err:
+        return func.HttpResponse(str(err), status_code=400)
+
+    jobs = await submit_jobs(jobs, msg)
+    results = [job.result() for job in jobs]
+    accepted = sum(1 for result in results if "error" not in result)
+    logging.info(f"Accepted {accepted} of {len(results)} job(s)")
+    return func.HttpResponse(
+        json.dumps({"jobs": results}),
+        status_code=200 if accepted else 400,
+        mimetype="application/json",
+    )
+
+
+if os.getenv("BULK_SUBMISSION", "").lower() in ("1", "true"):
+    app.function_name(name="SubmitJobs")(
+        app.route(
+            route="jobs",
+            methods=["POST"],
+            auth_level=func.AuthLevel.FUNCTION,
+        )(
+            app.queue_output(
+                arg_name="msg",
+                queue_name="apbsbackendqueue",
+                connection="OutputQueue",
+            )(SubmitJobs)
         )
-        logging.info("Poller created")
-        logging.info(f"Poller status: {poller.status()}")
-        logging.info("Waiting for job start")
-        result = poller.result(timeout=150)
-        logging.info(f"Job start status: {result}")
+    )
+
+
+def register_job_trigger(handler):
+    """Bind a job handler to the job blob trigger and the backend queue."""
+    handler = app.queue_output(
+        arg_name="msg",
+        queue_name="apbsbackendqueue",
+        connection="OutputQueue",
+    )(handler)
+    handler = app.blob_trigger(
+        arg_name="client",
+        path="inputs/{date}/{job}/{jobtype}-job.json",
+        connection="BlobStorageConnectionString",
+        Source="EventGrid",
+    )(handler)
+    return app.function_name(name="BlobTrigger")(handler)
+
+
+if os.getenv("ASYNC_BLOB_TRIGGER", "").lower() in ("1", "true"):
+    register_job_trigger(BlobTriggerAsync)
+else:
+    register_job_trigger(BlobTrigger)
+
+
+def QueueAutoscaler(timer: func.TimerRequest):
+    if timer.past_due:
+        logging.info("Autoscaler timer is past due")
+    started = autoscale_executions()
+    logging.info(f"Autoscaler started {started} container job execution(s)")
+
+
+if os.getenv("QUEUE_AUTOSCALER", "").lower() in ("1", "true"):
+    app.function_name(name="QueueAutoscaler")(
+        app.timer_trigger(
+            schedule=os.getenv("QUEUE_AUTOSCALER_SCHEDULE", "*/30 * * * * *"),
+            arg_name="timer",
+            run_on_startup=False,
+        )(QueueAutoscaler)
+    )
+
+
+def RuntimeModelRefit(timer: func.TimerRequest):
+    try:
+        model = refit_runtime_model(get_storage())
     except Exception as err:
-        logging.error(f"Error starting container job: {type(err).__name__}: {err}")
+        logging.error(f"Error refitting runtime model: {type(err).__name__}: {err}")
         return
+    if model is None:
+        logging.info("Not enough job history to fit the runtime model")
+    else:
+        logging.info(f"Runtime model refitted on {model.samples} jobs")
 
 
-@app.blob_trigger(
-    arg_name="client",
-    path="inputs/{date}/{job}/{jobtype}-job.json",
-    connection="BlobStorageConnectionString",
-    Source="EventGrid",
-)
-@app.queue_output(
-    arg_name="msg",
-    queue_name="apbsbackendqueue",
-    connection="OutputQueue",
-)
-def BlobTrigger(client: func.InputStream, msg: func.Out[str]):
+if runtime_refit_enabled():
+    app.function_name(name="RuntimeModelRefit")(
+        app.timer_trigger(
+            schedule=os.getenv("RUNTIME_MODEL_REFIT_SCHEDULE", "0 0 3 * * *"),
+            arg_name="timer",
+            run_on_startup=False,
+        )(RuntimeModelRefit)
+    )
+
+
+def SubjobReducer(client: func.InputStream, msg: func.Out[str]):
     name = client.name
     if not name:
         logging.error("No name found for blob")
         return
-    cleaned = name.replace("inputs/", "")
-    split = name.split("/")
-    job_id, file_name = split[-2:]
-    date = split[-3]
+    subjob = parse_subjob_status_name(name)
+    if subjob is None:
+        # Job statuses are handled by StatusTrigger
+        logging.info(f"{name} is not a subjob status, ignoring it")
+        return
+    logging.info(f"{subjob['job_tag']} Status update from {subjob['subjob']}")
+    storage = get_storage()
+    follow_up = reduce_subjobs(storage, subjob["job_tag"], subjob["job_type"])
+    if follow_up is not None:
+        logging.info(f"Queue Message: {follow_up}")
 
-    tag = f"{date}/{job_id}"
-    type = split[-1].split("-")[0]
+        def send():
+            msg.set(encode_message(follow_up))
+            request_container_start()
 
-    logging.info(f"Job ID: {job_id}")
-    logging.info(f"Date: {date}")
-    logging.info(f"File Name: {file_name}")
+        run_follow_up(storage, subjob["job_tag"], send)
 
-    input_files = []
-    output_files = []
-    job_runner = None
-    message = ""
-    status = "pending"
-    timeout_seconds = 0
-    form = get_job_info(tag, "inputs", cleaned)["form"]
-    if type == "pdb2pqr":
-        logging.info("Running PDB2PQR job")
-        # logging.info(f"Form: {form}")
-        # AzureUtils.put_object("outputs", "form-test.json", json.dumps(form))
-        # logging.info(f"Copying {cleaned} to outputs")
-        # AzureUtils.copy_object("inputs", "outputs", file_name, file_name, tag)
-        job_runner = PDB2PQRRunner(form, job_id, date)
-        job_command_line_args = job_runner.prepare_job()
-    elif type == "apbs":
-        logging.info("Running APBS job")
-        job_runner = APBSRunner(form, job_id, date)
-        try:
-            job_command_line_args = job_runner.prepare_job("outputs", "inputs")
-        except MissingFilesError as err:
-            logging.error(f"{tag} Error preparing APBS job: {err}")
-            status = "failed"
-            message = f"Files specified byut not found: {err.missing_files}"
-    else:
-        status = "invalid"
-        message = "Invalid job type"
-        logging.error(f"{tag} Invalid job type: {type}")
 
-    if type in ("apbs", "pdb2pqr"):
-        if job_runner is None:
-            logging.error(f"{tag} Job runner is None")
-            return
-        input_files: list[str] = job_runner.input_files
-        output_files: list[str] = job_runner.output_files
-        timeout_seconds: int = job_runner.estimated_max_runtime
-    status_filename = f"{type}-status.json"
-    status_object = f"{tag}/{status_filename}"
-    initial_status: dict = build_status_dict(
-        job_id, tag, type, status, input_files, output_files, message
+if any(
+    os.getenv(setting, "").lower() in ("1", "true")
+    for setting in ("MG_PARA_FANOUT", "SWEEP_JOBS")
+):
+    app.function_name(name="SubjobReducer")(
+        app.blob_trigger(
+            arg_name="client",
+            path="outputs/{date}/{job}/{subjob}/{jobtype}-status.json",
+            connection="BlobStorageConnectionString",
+            Source="EventGrid",
+        )(
+            app.queue_output(
+                arg_name="msg",
+                queue_name="apbsbackendqueue",
+                connection="OutputQueue",
+            )(SubjobReducer)
+        )
+    )
+
+
+def StatusTrigger(client: func.InputStream, msg: func.Out[str]):
+    name = client.name
+    if not name:
+        logging.error("No name found for blob")
+        return
+    parsed = parse_status_blob_name(name)
+    if parsed is None:
+        # Subjob statuses are handled by SubjobReducer
+        logging.info(f"{name} is not a job status, ignoring it")
+        return
+    date, job_id, type = parsed
+    storage = get_storage()
+    if runtime_refit_enabled():
+        record_runtime(storage, f"{date}/{job_id}", type)
+    if type != "pdb2pqr":
+        return
+    if result_cache_enabled():
+        record_result(storage, f"{date}/{job_id}", type)
+    if not pipelines_enabled():
+        return
+    submission = advance_pipeline(storage, job_id, date)
+    if submission is None:
+        return
+
+    def submit():
+        initial_status: dict = submission.status_dict()
+        logging.info(
+            f"Uploading {submission.status_object} to outputs: {initial_status}"
+        )
+        upload_status_file(submission.status_object, initial_status)
+        if submission.should_queue:
+            dispatch_submission(submission, msg)
+
+    run_stage(storage, submission.job_tag, submit)
+
+
+if pipelines_enabled() or result_cache_enabled() or runtime_refit_enabled():
+    app.function_name(name="StatusTrigger")(
+        app.blob_trigger(
+            arg_name="client",
+            path="outputs/{date}/{job}/{jobtype}-status.json",
+            connection="BlobStorageConnectionString",
+            Source="EventGrid",
+        )(
+            app.queue_output(
+                arg_name="msg",
+                queue_name="apbsbackendqueue",
+                connection="OutputQueue",
+            )(StatusTrigger)
+        )
+    )
+
+
+def PdbMirrorFill(msg: func.QueueMessage):
+    pdb_id = msg.get_json()["pdb_id"]
+    try:
+        fill_pdb_mirror(get_storage(), "inputs", pdb_id)
+    except Exception as err:
+        # Jobs for this entry keep downloading it from RCSB
+        logging.error(f"Error mirroring {pdb_id}: {type(err).__name__}: {err}")
+
+
+if pdb_mirror_enabled():
+    app.function_name(name="PdbMirrorFill")(
+        app.queue_trigger(
+            arg_name="msg",
+            queue_name=PDB_MIRROR_QUEUE,
+            connection="OutputQueue",
+        )(PdbMirrorFill)
     )
-    logging.info(f"Uploading {tag}/{status_filename} to outputs: {initial_status}")
-    upload_status_file(status_object, initial_status)
-    if status not in ("invalid", "failed"):
-        if timeout_seconds == 0:
-            timeout_seconds = 2000
-        queue_message = {
-            "job_date": date,
-            "job_id": job_id,
-            "job_tag": tag,
-            "job_type": type,
-            # TODO: change this to container
-            "bucket_name": "inputs",
-            "input_files": input_files,
-            "command_line_args": job_command_line_args,
-            "max_run_time": timeout_seconds,
-        }
-        logging.info(f"Queue Message: {queue_message}")
-        msg.set(json.dumps(queue_message))
-        logging.info("Message sent to queue")
-        logging.info("Starting container job")
-        start_container_job()
-        logging.info("Container job started")
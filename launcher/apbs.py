@@ -1,28 +1,52 @@
 """A class to interpret/prepare an APBS job submission for job queue."""
 
-from io import StringIO
 from locale import atof, atoi
+from contextlib import contextmanager
 from os.path import splitext
+from typing import Dict, List, Optional, Tuple
 import logging
-
-# from .s3_utils import S3Utils
-from .azure_storage_utils import AzureUtils as S3Utils
+import os
 
 from .jobsetup import JobSetup, MissingFilesError
+from .runtime_estimator import PQR_BYTES_PER_ATOM, JobFeatures
+from .stages import AsyncStage, Stage, run_stages, run_stages_async
+from .storage import StorageBackend
 from .utils import (
     apbs_extract_input_files,
     apbs_infile_creator,
+    stream_object,
+    stream_object_async,
 )
 
 
+def is_not_water(line: str) -> bool:
+    """Line filter that drops water molecules from a PQR file."""
+    return "WAT" not in line and "HOH" not in line
+
+
 class APBSRunner(JobSetup):
-    def __init__(self, form: dict, job_id: str, job_date: str):
-        super().__init__(job_id, job_date)
+    def __init__(
+        self,
+        form: dict,
+        job_id: str,
+        job_date: str,
+        storage: Optional[StorageBackend] = None,
+    ):
+        super().__init__(job_id, job_date, storage)
         self.form = None
         self.infile_name = None
         self.command_line_args = None
         self.infile_support_filenames = []
         self.estimated_max_runtime = 7200
+        self.stage_timings = {}
+        # Estimated from the PQR file size, for the runtime estimator
+        self.pqr_atom_count = 0
+        # Let the worker read an unchanged PQR file from the output bucket
+        # instead of copying it to the input bucket
+        self.pqr_by_reference = os.getenv("APBS_PQR_BY_REFERENCE", "").lower() in (
+            "1",
+            "true",
+        )
 
         if "filename" in form:
             self.infile_name = form["filename"]
@@ -52,136 +76,363 @@ class APBSRunner(JobSetup):
         infile_name = self.infile_name
         form = self.form
         job_id = self.job_id
-        job_date = self.job_date
-        job_tag = f"{job_date}/{job_id}"
+        job_tag = self.job_tag
 
         # downloading necessary files
         if infile_name is not None:
             # If APBS directly run, verify necessary files exist in S3
-            infile_object_name = f"{job_date}/{job_id}/{infile_name}"
+            # Check S3 for the .in file and all supporting files at once
+            existing_objects = self.storage.objects_exist(
+                input_bucket_name,
+                self._expected_object_names(),
+                prefix=f"{job_tag}/",
+            )
+            return self._check_input_files(existing_objects)
 
-            # Check S3 for .in file existence; add to missing list if not
-            self.add_input_file(infile_name)
-            if not S3Utils.object_exists(input_bucket_name, infile_object_name):
-                logging.error(
-                    "%s Missing APBS input file '%s'",
-                    job_tag,
-                    infile_name,
+        elif form is not None:
+            # Using APBS input file name from PDB2PQR run
+            infile_name = f"{job_id}.in"
+            storage = self.storage
+
+            def download_infile(results: dict) -> Tuple[str, str, Optional[str]]:
+                # Get text for infile string
+                infile_str = storage.download_file_str(
+                    output_bucket_name, f"{job_tag}/{infile_name}"
+                )
+                return self._create_infile(infile_str)
+
+            def upload_infile(results: dict):
+                # Upload *.in file to input bucket
+                _, new_infile_contents, _ = results["download_infile"]
+                infile_object_name = f"{job_tag}/{self.apbs_options['tempFile']}"
+                logging.debug("%s Write file to S3: %s", job_tag, infile_object_name)
+                storage.put_object(
+                    input_bucket_name,
+                    infile_object_name,
+                    new_infile_contents.encode("utf-8"),
                 )
-                self.add_missing_file(infile_name)
-
-            # Get list of expected supporting files
-            expected_files_list = self.infile_support_filenames
-
-            # Check if additional expected files exist in S3
-            for name in expected_files_list:
-                object_name = f"{job_tag}/{name}"
-                self.add_input_file(str(name))
-                if not S3Utils.object_exists(input_bucket_name, object_name):
-                    logging.error(
-                        "%s Missing APBS input file '%s'",
-                        job_tag,
-                        name,
+
+            def copy_water_pqr(results: dict):
+                # Keep original PQR file (with water) in S3 output bucket
+                pqr_file_name, _, water_pqrname = results["download_infile"]
+                if water_pqrname is None:
+                    return
+                with self._water_errors_logged():
+                    storage.copy_object(
+                        output_bucket_name,
+                        f"{job_tag}/{pqr_file_name}",
+                        f"{job_tag}/{water_pqrname}",
                     )
-                    self.add_missing_file(str(name))
 
-            # Set and return command line args
-            self.command_line_args = infile_name
+            def transfer_pqr(results: dict):
+                # Move the PQR file from the PDB2PQR run to the input bucket
+                pqr_file_name, _, water_pqrname = results["download_infile"]
+                pqr_object_name = f"{job_tag}/{pqr_file_name}"
+                if water_pqrname is None:
+                    if self.pqr_by_reference:
+                        # The worker reads it from the output bucket
+                        return
+                    # Unchanged, so let the storage service copy it
+                    logging.debug("%s Copy file to S3: %s", job_tag, pqr_object_name)
+                    storage.copy_object(
+                        output_bucket_name,
+                        pqr_object_name,
+                        pqr_object_name,
+                        dest_container=input_bucket_name,
+                    )
+                    return
 
-            if len(self._missing_files) > 0:
-                raise MissingFilesError(
-                    f"File(s) specified  missing from storage: {self._missing_files}",
-                    self._missing_files,
-                )
+                # Stream it through the water filter
+                logging.debug("%s Write file to S3: %s", job_tag, pqr_object_name)
+                with self._water_errors_logged():
+                    stream_object(
+                        storage,
+                        output_bucket_name,
+                        pqr_object_name,
+                        input_bucket_name,
+                        pqr_object_name,
+                        keep_line=is_not_water,
+                    )
+
+            def measure_pqr(results: dict):
+                pqr_file_name, _, _ = results["download_infile"]
+                with self._size_errors_logged():
+                    self._set_pqr_size(
+                        storage.object_size(
+                            output_bucket_name, f"{job_tag}/{pqr_file_name}"
+                        )
+                    )
+
+            after_infile = ("download_infile",)
+            output = run_stages(
+                job_tag,
+                [
+                    Stage("download_infile", download_infile),
+                    Stage("upload_infile", upload_infile, after_infile),
+                    Stage("copy_water_pqr", copy_water_pqr, after_infile),
+                    Stage("transfer_pqr", transfer_pqr, after_infile),
+                    Stage("measure_pqr", measure_pqr, after_infile),
+                ],
+            )
+            self.stage_timings = output.timings
+            return self._finish_form_job(
+                output.results["download_infile"], output_bucket_name
+            )
 
-            return self.command_line_args
+    async def prepare_job_async(
+        self, output_bucket_name: str, input_bucket_name: str
+    ) -> str:
+        """Asyncio version of prepare_job.
+
+        Transfers that do not depend on each other are awaited concurrently.
+        """
+        infile_name = self.infile_name
+        form = self.form
+        job_id = self.job_id
+        job_tag = self.job_tag
+        storage = self.storage.to_async()
+
+        if infile_name is not None:
+            existing_objects = await storage.objects_exist(
+                input_bucket_name,
+                self._expected_object_names(),
+                prefix=f"{job_tag}/",
+            )
+            return self._check_input_files(existing_objects)
 
         elif form is not None:
-            # Using APBS input file name from PDB2PQR run
             infile_name = f"{job_id}.in"
 
-            apbs_options = self.apbs_options
+            async def download_infile(results: dict) -> Tuple[str, str, Optional[str]]:
+                infile_str = await storage.download_file_str(
+                    output_bucket_name, f"{job_tag}/{infile_name}"
+                )
+                return self._create_infile(infile_str)
+
+            async def upload_infile(results: dict):
+                _, new_infile_contents, _ = results["download_infile"]
+                await storage.put_object(
+                    input_bucket_name,
+                    f"{job_tag}/{self.apbs_options['tempFile']}",
+                    new_infile_contents.encode("utf-8"),
+                )
 
-            # Get text for infile string
-            infile_str = S3Utils.download_file_str(
-                output_bucket_name, f"{job_tag}/{infile_name}"
+            async def copy_water_pqr(results: dict):
+                pqr_file_name, _, water_pqrname = results["download_infile"]
+                if water_pqrname is None:
+                    return
+                with self._water_errors_logged():
+                    await storage.copy_object(
+                        output_bucket_name,
+                        f"{job_tag}/{pqr_file_name}",
+                        f"{job_tag}/{water_pqrname}",
+                    )
+
+            async def transfer_pqr(results: dict):
+                pqr_file_name, _, water_pqrname = results["download_infile"]
+                pqr_object_name = f"{job_tag}/{pqr_file_name}"
+                if water_pqrname is None:
+                    if not self.pqr_by_reference:
+                        await storage.copy_object(
+                            output_bucket_name,
+                            pqr_object_name,
+                            pqr_object_name,
+                            dest_container=input_bucket_name,
+                        )
+                    return
+
+                with self._water_errors_logged():
+                    await stream_object_async(
+                        storage,
+                        output_bucket_name,
+                        pqr_object_name,
+                        input_bucket_name,
+                        pqr_object_name,
+                        keep_line=is_not_water,
+                    )
+
+            async def measure_pqr(results: dict):
+                pqr_file_name, _, _ = results["download_infile"]
+                with self._size_errors_logged():
+                    self._set_pqr_size(
+                        await storage.object_size(
+                            output_bucket_name, f"{job_tag}/{pqr_file_name}"
+                        )
+                    )
+
+            after_infile = ("download_infile",)
+            output = await run_stages_async(
+                job_tag,
+                [
+                    AsyncStage("download_infile", download_infile),
+                    AsyncStage("upload_infile", upload_infile, after_infile),
+                    AsyncStage("copy_water_pqr", copy_water_pqr, after_infile),
+                    AsyncStage("transfer_pqr", transfer_pqr, after_infile),
+                    AsyncStage("measure_pqr", measure_pqr, after_infile),
+                ],
             )
+            self.stage_timings = output.timings
+            return self._finish_form_job(
+                output.results["download_infile"], output_bucket_name
+            )
+
+    def uploaded_input_files(self) -> List[str]:
+        # Form jobs only read files generated for the job
+        if self.form is not None:
+            return []
+        return super().uploaded_input_files()
 
-            # Extracts PQR file name from the '*.in' file within storage bucket
-            pqr_file_name = apbs_extract_input_files(job_tag, infile_str)[0]
-            apbs_options["pqrFileName"] = pqr_file_name
+    def _expected_object_names(self) -> List[str]:
+        """Object names of the .in file and its expected supporting files."""
+        return [f"{self.job_tag}/{self.infile_name}"] + [
+            f"{self.job_tag}/{name}" for name in self.infile_support_filenames
+        ]
 
-            # Get contents of updated APBS input file, based on form
-            apbs_options["tempFile"] = "apbsinput.in"
-            new_infile_contents = apbs_infile_creator(job_tag, apbs_options)
+    def _check_input_files(self, existing_objects: Dict[str, bool]) -> str:
+        """Record input/missing files for a direct APBS run.
 
-            # Get contents of PQR file from PDB2PQR run
-            pqrfile_text = S3Utils.download_file_str(
-                output_bucket_name, f"{job_tag}/{pqr_file_name}"
+        :raises MissingFilesError: if any expected file is not in storage
+        """
+        job_tag = self.job_tag
+        infile_name = self.infile_name
+
+        # Add .in file to missing list if not found
+        self.add_input_file(infile_name)
+        if not existing_objects[f"{job_tag}/{infile_name}"]:
+            logging.error(
+                "%s Missing APBS input file '%s'",
+                job_tag,
+                infile_name,
             )
+            self.add_missing_file(infile_name)
 
-            # Remove waters from molecule (PQR file) if requested by the user
-            try:
-                if "removewater" in form and form["removewater"] == "on":
-                    pqr_filename_root, pqr_filename_ext = splitext(pqr_file_name)
+        # Check if additional expected files exist in S3
+        for name in self.infile_support_filenames:
+            object_name = f"{job_tag}/{name}"
+            self.add_input_file(str(name))
+            if not existing_objects[object_name]:
+                logging.error(
+                    "%s Missing APBS input file '%s'",
+                    job_tag,
+                    name,
+                )
+                self.add_missing_file(str(name))
 
-                    water_pqrname = f"{pqr_filename_root}-water{pqr_filename_ext}"
+        # Set and return command line args
+        self.command_line_args = infile_name
 
-                    # Add lines to new PQR text, skipping lines with water
-                    nowater_pqrfile_text = "".join(
-                        line
-                        for line in StringIO(pqrfile_text)
-                        if "WAT" not in line and "HOH" not in line
-                    )
+        if len(self._missing_files) > 0:
+            raise MissingFilesError(
+                f"File(s) specified  missing from storage: {self._missing_files}",
+                self._missing_files,
+            )
 
-                    # Send original PQR file (with water) to S3 output bucket
-                    S3Utils.put_object(
-                        output_bucket_name,
-                        f"{job_tag}/{water_pqrname}",
-                        pqrfile_text.encode("utf-8"),
-                    )
-                    self.add_output_file(f"{job_id}/{water_pqrname}")
+        return self.command_line_args
+
+    def _create_infile(self, infile_str: str) -> Tuple[str, str, Optional[str]]:
+        """Build the new APBS input file from the form and the PDB2PQR infile.
+
+        :return: the PQR file name, the contents of the new input file and
+                 the name to keep the original PQR file under if waters are
+                 removed (None otherwise)
+        """
+        apbs_options = self.apbs_options
+
+        # Extracts PQR file name from the '*.in' file within storage bucket
+        pqr_file_name = apbs_extract_input_files(self.job_tag, infile_str)[0]
+        apbs_options["pqrFileName"] = pqr_file_name
 
-                    # Replace PQR file text with version with water removed
-                    pqrfile_text = nowater_pqrfile_text
+        # Get contents of updated APBS input file, based on form
+        apbs_options["tempFile"] = "apbsinput.in"
+        new_infile_contents = apbs_infile_creator(self.job_tag, apbs_options)
+        return pqr_file_name, new_infile_contents, self._water_pqr_name(pqr_file_name)
 
-            except Exception as err:
+    def _water_pqr_name(self, pqr_file_name: str) -> Optional[str]:
+        """Name for the original PQR file if the user asked to remove waters.
+
+        :return: the '-water' PQR file name, or None if water is kept
+        """
+        form = self.form
+        if "removewater" in form and form["removewater"] == "on":
+            pqr_filename_root, pqr_filename_ext = splitext(pqr_file_name)
+
+            water_pqrname = f"{pqr_filename_root}-water{pqr_filename_ext}"
+            self.add_output_file(f"{self.job_id}/{water_pqrname}")
+            return water_pqrname
+        return None
+
+    @contextmanager
+    def _water_errors_logged(self, removing_water: bool = True):
+        try:
+            yield
+        except Exception as err:
+            if removing_water:
                 logging.exception(
                     "%s Failed to remove water molecules: %s",
                     self.job_tag,
                     err,
                 )
-                raise
-
-            # Upload *.pqr and *.in file to input bucket
-            logging.debug(
-                "%s Write file to S3: %s",
-                job_tag,
-                f"{job_tag}/{apbs_options['tempFile']}",
+            raise
+
+    @contextmanager
+    def _size_errors_logged(self):
+        # The size only feeds the runtime estimate, so it must not fail the job
+        try:
+            yield
+        except Exception as err:
+            logging.warning(
+                "%s Could not read the PQR file size: %s", self.job_tag, err
             )
-            S3Utils.put_object(
-                input_bucket_name,
-                f"{job_tag}/{apbs_options['tempFile']}",
-                new_infile_contents.encode("utf-8"),
+
+    def _set_pqr_size(self, size: int):
+        self.pqr_atom_count = size // PQR_BYTES_PER_ATOM
+
+    def runtime_features(self) -> JobFeatures:
+        """Size of the job, as known at submission, for the runtime estimator."""
+        if self.form is None:
+            # Direct run: the input file is not parsed
+            return JobFeatures("apbs")
+        apbs_options = self.apbs_options
+        calc_type = apbs_options["calcType"]
+        grid_points = 0
+        if calc_type != "fe-manual":
+            grid_points = (
+                apbs_options["dimeNX"] * apbs_options["dimeNY"] * apbs_options["dimeNZ"]
             )
-            logging.debug(
-                "%s Write file to S3: %s",
-                job_tag,
-                f"{job_tag}/{pqr_file_name}",
+        processors = 1
+        if calc_type == "mg-para":
+            processors = int(
+                apbs_options["pdimeNX"]
+                * apbs_options["pdimeNY"]
+                * apbs_options["pdimeNZ"]
             )
-            S3Utils.put_object(
-                input_bucket_name,
-                f"{job_tag}/{pqr_file_name}",
-                pqrfile_text.encode("utf-8"),
+        return JobFeatures(
+            "apbs",
+            calc_type=calc_type,
+            grid_points=grid_points,
+            processors=processors,
+            atom_count=self.pqr_atom_count,
+        )
+
+    def _finish_form_job(
+        self,
+        infile_info: Tuple[str, str, Optional[str]],
+        output_bucket_name: str,
+    ) -> str:
+        pqr_file_name, _, water_pqrname = infile_info
+
+        # Set input files for status reporting
+        if water_pqrname is None and self.pqr_by_reference:
+            self.add_input_reference(
+                pqr_file_name, output_bucket_name, f"{self.job_tag}/{pqr_file_name}"
             )
-
-            # Set input files for status reporting
+        else:
             self.add_input_file(pqr_file_name)
-            self.add_input_file(apbs_options["tempFile"])
+        self.add_input_file(self.apbs_options["tempFile"])
 
-            # Return command line args
-            self.command_line_args = apbs_options["tempFile"]  # 'apbsinput.in'
-            return self.command_line_args
+        # Return command line args
+        self.command_line_args = self.apbs_options["tempFile"]  # 'apbsinput.in'
+        return self.command_line_args
 
     def field_storage_to_dict(self, form: dict) -> dict:
         """Converts the CGI input from the web interface to a dictionary"""
@@ -0,0 +1,307 @@
+"""Asyncio counterpart of AzureUtils, built on azure.storage.blob.aio."""
+
+import asyncio
+import logging
+import json
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from aiohttp import ClientSession, DummyCookieJar, TCPConnector
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.blob.aio import BlobClient, BlobServiceClient, ContainerClient
+
+from .azure_storage_utils import (
+    COPY_MODE_SERVER,
+    COPY_POLL_INTERVAL,
+    COPY_TIMEOUT,
+    EXISTS_CONCURRENCY,
+    MAX_LISTING_SIZE,
+    AzureUtils,
+)
+
+
+class AsyncAzureUtils:
+    # aiohttp sessions are bound to the event loop that created them, so the
+    # registry is rebuilt if the worker hands us a different loop.
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _transport: Optional[AioHttpTransport] = None
+    _service_clients: Dict[str, BlobServiceClient] = {}
+    _container_clients: Dict[Tuple[str, str], ContainerClient] = {}
+
+    @classmethod
+    def _get_transport(cls) -> AioHttpTransport:
+        loop = asyncio.get_running_loop()
+        if cls._loop is not loop:
+            cls._loop = loop
+            cls._transport = None
+            cls._service_clients = {}
+            cls._container_clients = {}
+        if cls._transport is None:
+            pool_size = AzureUtils._get_pool_size()
+            session = ClientSession(
+                connector=TCPConnector(limit=pool_size),
+                cookie_jar=DummyCookieJar(),
+                auto_decompress=False,
+                trust_env=True,
+            )
+            cls._transport = AioHttpTransport(session=session, session_owner=False)
+            logging.info(
+                f"Created shared async blob transport (pool size: {pool_size})"
+            )
+        return cls._transport
+
+    @classmethod
+    def get_service_client(cls) -> BlobServiceClient:
+        connection_string = AzureUtils._get_connection_string()
+        transport = cls._get_transport()
+        client = cls._service_clients.get(connection_string)
+        if client is None:
+            client = BlobServiceClient.from_connection_string(
+                connection_string, transport=transport
+            )
+            cls._service_clients[connection_string] = client
+            logging.info(f"Created async blob service client for {client.account_name}")
+        return client
+
+    @classmethod
+    def get_container_client(cls, container_name: str) -> ContainerClient:
+        service_client = cls.get_service_client()
+        key = (service_client.account_name or "", container_name)
+        client = cls._container_clients.get(key)
+        if client is None:
+            client = service_client.get_container_client(container_name)
+            cls._container_clients[key] = client
+        return client
+
+    @classmethod
+    async def copy_object(
+        cls,
+        container_name: str,
+        src: str,
+        dest: str,
+        dest_container: Optional[str] = None,
+    ):
+        """Copy a blob, preferring a copy performed by the storage service."""
+        if dest_container is None:
+            dest_container = container_name
+        src_client = cls.get_container_client(container_name).get_blob_client(src)
+        dest_client = cls.get_container_client(dest_container).get_blob_client(dest)
+
+        if AzureUtils._get_copy_mode() == COPY_MODE_SERVER:
+            try:
+                if await cls._server_side_copy(src_client, dest_client):
+                    return
+            except HttpResponseError as err:
+                logging.warning(
+                    f"Server-side copy of {container_name}/{src} failed "
+                    f"({err.status_code}), falling back to streamed copy"
+                )
+        await cls._stream_copy(src_client, dest_client)
+
+    @staticmethod
+    async def _server_side_copy(
+        src_client: BlobClient, dest_client: BlobClient
+    ) -> bool:
+        copy_props = await dest_client.start_copy_from_url(src_client.url)
+        status = copy_props["copy_status"]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + COPY_TIMEOUT
+        while status == "pending":
+            if loop.time() > deadline:
+                logging.warning(f"Timed out waiting for copy to {dest_client.url}")
+                try:
+                    await dest_client.abort_copy(copy_props["copy_id"])
+                except HttpResponseError as err:
+                    logging.warning(f"Could not abort copy to {dest_client.url}: {err}")
+                return False
+            await asyncio.sleep(COPY_POLL_INTERVAL)
+            status = (await dest_client.get_blob_properties()).copy.status
+
+        if status != "success":
+            logging.warning(f"Copy to {dest_client.url} ended with status '{status}'")
+            return False
+        logging.info(f"Copied {src_client.url} to {dest_client.url} (server-side)")
+        return True
+
+    @staticmethod
+    async def _stream_copy(src_client: BlobClient, dest_client: BlobClient):
+        downloader = await src_client.download_blob()
+        await dest_client.upload_blob(downloader.chunks(), overwrite=True)
+        logging.info(f"Copied {src_client.url} to {dest_client.url} (streamed)")
+
+    @classmethod
+    async def download_file_bytes(cls, bucket_name: str, object_name: str) -> bytes:
+        blob_client = cls.get_container_client(bucket_name).get_blob_client(object_name)
+        downloader = await blob_client.download_blob()
+        return await downloader.readall()
+
+    @classmethod
+    async def download_file_str(cls, bucket_name: str, object_name: str) -> str:
+        return (await cls.download_file_bytes(bucket_name, object_name)).decode("utf-8")
+
+    @classmethod
+    async def download_chunks(
+        cls, bucket_name: str, object_name: str
+    ) -> AsyncIterator[bytes]:
+        blob_client = cls.get_container_client(bucket_name).get_blob_client(object_name)
+        downloader = await blob_client.download_blob()
+        return downloader.chunks()
+
+    @classmethod
+    async def upload_stream(
+        cls, container_name: str, object_name: str, chunks: AsyncIterable[bytes]
+    ):
+        blob_client = cls.get_container_client(container_name).get_blob_client(
+            object_name
+        )
+        await blob_client.upload_blob(chunks, overwrite=True)
+        logging.info(f"Output: {blob_client}")
+
+    @classmethod
+    async def put_object(cls, container_name: str, object_name: str, body):
+        blob_client = cls.get_container_client(container_name).get_blob_client(
+            object_name
+        )
+        await blob_client.upload_blob(body, overwrite=True)
+        logging.info(f"Output: {blob_client}")
+
+    @classmethod
+    async def create_object(cls, container_name: str, object_name: str, body) -> bool:
+        """See AzureUtils.create_object."""
+        blob_client = cls.get_container_client(container_name).get_blob_client(
+            object_name
+        )
+        try:
+            await blob_client.upload_blob(body, overwrite=False)
+        except ResourceExistsError:
+            return False
+        logging.info(f"Output: {blob_client}")
+        return True
+
+    @classmethod
+    async def download_with_etag(
+        cls, bucket_name: str, object_name: str
+    ) -> Tuple[bytes, str]:
+        """See AzureUtils.download_with_etag."""
+        blob_client = cls.get_container_client(bucket_name).get_blob_client(object_name)
+        try:
+            downloader = await blob_client.download_blob()
+        except ResourceNotFoundError:
+            # Like the local backends, so callers handle one exception
+            raise FileNotFoundError(f"{bucket_name}/{object_name}")
+        return await downloader.readall(), downloader.properties.etag
+
+    @classmethod
+    async def replace_object(
+        cls, container_name: str, object_name: str, body, etag: str
+    ) -> bool:
+        """See AzureUtils.replace_object."""
+        blob_client = cls.get_container_client(container_name).get_blob_client(
+            object_name
+        )
+        try:
+            await blob_client.upload_blob(
+                body,
+                overwrite=True,
+                etag=etag,
+                match_condition=MatchConditions.IfNotModified,
+            )
+        except (ResourceModifiedError, ResourceNotFoundError):
+            return False
+        logging.info(f"Output: {blob_client}")
+        return True
+
+    @classmethod
+    async def delete_object(cls, container_name: str, object_name: str):
+        """See AzureUtils.delete_object."""
+        blob_client = cls.get_container_client(container_name).get_blob_client(
+            object_name
+        )
+        try:
+            await blob_client.delete_blob()
+        except ResourceNotFoundError:
+            pass
+
+    @classmethod
+    async def object_size(cls, bucket_name: str, object_name: str) -> int:
+        blob_client = cls.get_container_client(bucket_name).get_blob_client(object_name)
+        return (await blob_client.get_blob_properties()).size
+
+    @classmethod
+    async def object_exists(cls, bucket_name: str, object_name: str) -> bool:
+        blob_client = cls.get_container_client(bucket_name).get_blob_client(object_name)
+        return await blob_client.exists()
+
+    @classmethod
+    async def list_object_names(
+        cls, container_name: str, prefix: str, limit: Optional[int] = None
+    ) -> Optional[Set[str]]:
+        names = set()
+        container_client = cls.get_container_client(container_name)
+        async for name in container_client.list_blob_names(name_starts_with=prefix):
+            names.add(name)
+            if limit is not None and len(names) > limit:
+                return None
+        return names
+
+    @classmethod
+    async def objects_exist(
+        cls,
+        container_name: str,
+        object_names: Iterable[str],
+        prefix: Optional[str] = None,
+    ) -> Dict[str, bool]:
+        """See AzureUtils.objects_exist."""
+        object_names = list(object_names)
+        if not object_names:
+            return {}
+
+        if prefix is not None and all(name.startswith(prefix) for name in object_names):
+            listing = await cls.list_object_names(
+                container_name, prefix, MAX_LISTING_SIZE
+            )
+            if listing is not None:
+                return {name: name in listing for name in object_names}
+            logging.info(
+                f"More than {MAX_LISTING_SIZE} blobs under {container_name}/{prefix}, "
+                "checking objects individually"
+            )
+
+        semaphore = asyncio.Semaphore(EXISTS_CONCURRENCY)
+
+        async def _exists(name: str) -> bool:
+            async with semaphore:
+                return await cls.object_exists(container_name, name)
+
+        found: List[bool] = await asyncio.gather(
+            *(_exists(name) for name in object_names)
+        )
+        return dict(zip(object_names, found))
+
+    @classmethod
+    async def get_azure_object_json(
+        cls, tag: str, container: str, object_name: str
+    ) -> dict:
+        resp = {}
+        out = await cls.download_file_str(container, object_name)
+        try:
+            resp = json.loads(out)
+            logging.info(f"{tag}: Found JSON object data: {resp}")
+        except Exception as err:
+            logging.error(f"{tag}: Error parsing JSON object data: {err}")
+        return resp
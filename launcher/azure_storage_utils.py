@@ -1,14 +1,50 @@
 import logging
 import os
 import json
-from typing import Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
 
-from azure.storage.blob import BlobServiceClient
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobClient, BlobServiceClient, ContainerClient
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+# Default number of keep-alive connections kept open to the storage account
+DEFAULT_POOL_SIZE = 32
+
+# Copy modes: "server" keeps the data inside the storage service,
+# "stream" pipes the bytes through the function
+COPY_MODE_SERVER = "server"
+COPY_MODE_STREAM = "stream"
+COPY_POLL_INTERVAL = 0.5
+COPY_TIMEOUT = 60.0
+
+# Past this many blobs under a prefix, individual HEAD requests are cheaper
+# than paging through the whole listing
+MAX_LISTING_SIZE = 5000
+EXISTS_CONCURRENCY = 8
 
 
 class AzureUtils:
     _connection_string: Optional[str] = None
 
+    # Clients are expensive to build (connection string parsing, pipeline
+    # setup, TLS handshakes), so they are created once per worker process and
+    # shared between invocations and threads.
+    _clients_lock = threading.Lock()
+    _transport: Optional[RequestsTransport] = None
+    _service_clients: Dict[str, BlobServiceClient] = {}
+    _container_clients: Dict[Tuple[str, str], ContainerClient] = {}
+
     # This enables us to cache the connection string when we need it rather than failing on import
     @classmethod
     def _get_connection_string(cls) -> str:
@@ -19,42 +55,305 @@ class AzureUtils:
         return cls._connection_string
 
     @staticmethod
-    def copy_object(container_name: str, src: str, dest: str):
-        src_data = AzureUtils.download_file_str(container_name, src)
-        AzureUtils.put_object(container_name, dest, src_data)
+    def _get_pool_size() -> int:
+        pool_size = os.environ.get("BlobStoragePoolSize")
+        if not pool_size:
+            return DEFAULT_POOL_SIZE
+        try:
+            return max(1, int(pool_size))
+        except ValueError:
+            logging.warning(
+                f"Invalid BlobStoragePoolSize '{pool_size}', using {DEFAULT_POOL_SIZE}"
+            )
+            return DEFAULT_POOL_SIZE
 
     @classmethod
-    def download_file_str(cls, bucket_name: str, object_name: str) -> str:
+    def _get_transport(cls) -> RequestsTransport:
+        # Must be called while holding cls._clients_lock
+        if cls._transport is None:
+            pool_size = cls._get_pool_size()
+            session = Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            cls._transport = RequestsTransport(session=session, session_owner=False)
+            logging.info(f"Created shared blob transport (pool size: {pool_size})")
+        return cls._transport
+
+    @classmethod
+    def get_service_client(cls) -> BlobServiceClient:
         connection_string = cls._get_connection_string()
-        storage_client = BlobServiceClient.from_connection_string(connection_string)
-        blob_client = storage_client.get_blob_client(bucket_name, object_name)
-        return blob_client.download_blob().readall().decode("utf-8")
+        client = cls._service_clients.get(connection_string)
+        if client is not None:
+            return client
+        with cls._clients_lock:
+            client = cls._service_clients.get(connection_string)
+            if client is None:
+                client = BlobServiceClient.from_connection_string(
+                    connection_string, transport=cls._get_transport()
+                )
+                cls._service_clients[connection_string] = client
+                logging.info(f"Created blob service client for {client.account_name}")
+            return client
+
+    @classmethod
+    def get_container_client(cls, container_name: str) -> ContainerClient:
+        service_client = cls.get_service_client()
+        key = (service_client.account_name or "", container_name)
+        client = cls._container_clients.get(key)
+        if client is not None:
+            return client
+        with cls._clients_lock:
+            client = cls._container_clients.get(key)
+            if client is None:
+                client = service_client.get_container_client(container_name)
+                cls._container_clients[key] = client
+            return client
+
+    @classmethod
+    def reset_clients(cls):
+        """Drop all cached clients, e.g. after the connection string changes."""
+        with cls._clients_lock:
+            cls._service_clients = {}
+            cls._container_clients = {}
+            cls._connection_string = None
+
+    @staticmethod
+    def _get_copy_mode() -> str:
+        copy_mode = os.environ.get("BlobCopyMode", COPY_MODE_SERVER).lower()
+        if copy_mode not in (COPY_MODE_SERVER, COPY_MODE_STREAM):
+            logging.warning(
+                f"Invalid BlobCopyMode '{copy_mode}', using {COPY_MODE_SERVER}"
+            )
+            return COPY_MODE_SERVER
+        return copy_mode
+
+    @classmethod
+    def copy_object(
+        cls,
+        container_name: str,
+        src: str,
+        dest: str,
+        dest_container: Optional[str] = None,
+    ):
+        """Copy a blob, preferring a copy performed by the storage service.
+
+        The server-side copy is tried first; if the service rejects it or the
+        copy does not succeed, the blob is streamed chunk by chunk from the
+        source to the destination. Content is copied as bytes in both cases.
+        """
+        if dest_container is None:
+            dest_container = container_name
+        src_client = cls.get_container_client(container_name).get_blob_client(src)
+        dest_client = cls.get_container_client(dest_container).get_blob_client(dest)
+
+        if cls._get_copy_mode() == COPY_MODE_SERVER:
+            try:
+                if cls._server_side_copy(src_client, dest_client):
+                    return
+            except HttpResponseError as err:
+                logging.warning(
+                    f"Server-side copy of {container_name}/{src} failed "
+                    f"({err.status_code}), falling back to streamed copy"
+                )
+        cls._stream_copy(src_client, dest_client)
+
+    @staticmethod
+    def _server_side_copy(src_client: BlobClient, dest_client: BlobClient) -> bool:
+        """Start a service-side copy and wait for it to finish.
+
+        :return: True if the copy succeeded, False if it failed or timed out
+        """
+        copy_props = dest_client.start_copy_from_url(src_client.url)
+        status = copy_props["copy_status"]
+        deadline = monotonic() + COPY_TIMEOUT
+        while status == "pending":
+            if monotonic() > deadline:
+                logging.warning(f"Timed out waiting for copy to {dest_client.url}")
+                try:
+                    dest_client.abort_copy(copy_props["copy_id"])
+                except HttpResponseError as err:
+                    logging.warning(f"Could not abort copy to {dest_client.url}: {err}")
+                return False
+            sleep(COPY_POLL_INTERVAL)
+            status = dest_client.get_blob_properties().copy.status
+
+        if status != "success":
+            logging.warning(f"Copy to {dest_client.url} ended with status '{status}'")
+            return False
+        logging.info(f"Copied {src_client.url} to {dest_client.url} (server-side)")
+        return True
+
+    @staticmethod
+    def _stream_copy(src_client: BlobClient, dest_client: BlobClient):
+        downloader = src_client.download_blob()
+        dest_client.upload_blob(downloader.chunks(), overwrite=True)
+        logging.info(f"Copied {src_client.url} to {dest_client.url} (streamed)")
+
+    @classmethod
+    def download_file_bytes(cls, bucket_name: str, object_name: str) -> bytes:
+        blob_client = cls.get_container_client(bucket_name).get_blob_client(object_name)
+        return blob_client.download_blob().readall()
+
+    @classmethod
+    def download_file_str(cls, bucket_name: str, object_name: str) -> str:
+        return cls.download_file_bytes(bucket_name, object_name).decode("utf-8")
+
+    @classmethod
+    def download_chunks(cls, bucket_name: str, object_name: str) -> Iterator[bytes]:
+        """Download a blob as a stream of chunks instead of reading it whole."""
+        blob_client = cls.get_container_client(bucket_name).get_blob_client(object_name)
+        return blob_client.download_blob().chunks()
+
+    @classmethod
+    def upload_stream(
+        cls, container_name: str, object_name: str, chunks: Iterable[bytes]
+    ):
+        """Upload a blob from an iterable of chunks, staging it block by block."""
+        blob_client = cls.get_container_client(container_name).get_blob_client(
+            object_name
+        )
+        blob_client.upload_blob(chunks, overwrite=True)
+        logging.info(f"Output: {blob_client}")
 
     @classmethod
     def put_object(cls, container_name: str, object_name: str, body):
-        connection_string = cls._get_connection_string()
-        storage_client = BlobServiceClient.from_connection_string(connection_string)
-        blob_client = storage_client.get_blob_client(container_name, object_name)
+        blob_client = cls.get_container_client(container_name).get_blob_client(
+            object_name
+        )
         blob_client.upload_blob(body, overwrite=True)
         logging.info(f"Output: {blob_client}")
 
+    @classmethod
+    def create_object(cls, container_name: str, object_name: str, body) -> bool:
+        """Upload a blob only if it does not exist yet.
+
+        :return: True if this call created the blob
+        """
+        blob_client = cls.get_container_client(container_name).get_blob_client(
+            object_name
+        )
+        try:
+            blob_client.upload_blob(body, overwrite=False)
+        except ResourceExistsError:
+            return False
+        logging.info(f"Output: {blob_client}")
+        return True
+
+    @classmethod
+    def download_with_etag(
+        cls, bucket_name: str, object_name: str
+    ) -> Tuple[bytes, str]:
+        """Download a blob together with the ETag of the version read."""
+        blob_client = cls.get_container_client(bucket_name).get_blob_client(object_name)
+        try:
+            downloader = blob_client.download_blob()
+        except ResourceNotFoundError:
+            # Like the local backends, so callers handle one exception
+            raise FileNotFoundError(f"{bucket_name}/{object_name}")
+        return downloader.readall(), downloader.properties.etag
+
+    @classmethod
+    def replace_object(
+        cls, container_name: str, object_name: str, body, etag: str
+    ) -> bool:
+        """Overwrite a blob only if it is still the version with this ETag.
+
+        :return: True if this call wrote the blob
+        """
+        blob_client = cls.get_container_client(container_name).get_blob_client(
+            object_name
+        )
+        try:
+            blob_client.upload_blob(
+                body,
+                overwrite=True,
+                etag=etag,
+                match_condition=MatchConditions.IfNotModified,
+            )
+        except (ResourceModifiedError, ResourceNotFoundError):
+            return False
+        logging.info(f"Output: {blob_client}")
+        return True
+
+    @classmethod
+    def delete_object(cls, container_name: str, object_name: str):
+        """Delete a blob; a missing blob is not an error."""
+        blob_client = cls.get_container_client(container_name).get_blob_client(
+            object_name
+        )
+        try:
+            blob_client.delete_blob()
+        except ResourceNotFoundError:
+            pass
+
+    @classmethod
+    def object_size(cls, bucket_name: str, object_name: str) -> int:
+        blob_client = cls.get_container_client(bucket_name).get_blob_client(object_name)
+        return blob_client.get_blob_properties().size
+
     @classmethod
     def object_exists(cls, bucket_name: str, object_name: str) -> bool:
-        connection_string = cls._get_connection_string()
-        storage_client = BlobServiceClient.from_connection_string(connection_string)
-        blob_client = storage_client.get_blob_client(bucket_name, object_name)
+        blob_client = cls.get_container_client(bucket_name).get_blob_client(object_name)
         try:
             blob_client.get_blob_properties()
             return True
         except:
             return False
 
+    @classmethod
+    def list_object_names(
+        cls, container_name: str, prefix: str, limit: Optional[int] = None
+    ) -> Optional[Set[str]]:
+        """List the names of all blobs under a prefix.
+
+        :return: the blob names, or None if there are more than `limit` blobs
+        """
+        names = set()
+        container_client = cls.get_container_client(container_name)
+        for name in container_client.list_blob_names(name_starts_with=prefix):
+            names.add(name)
+            if limit is not None and len(names) > limit:
+                return None
+        return names
+
+    @classmethod
+    def objects_exist(
+        cls,
+        container_name: str,
+        object_names: Iterable[str],
+        prefix: Optional[str] = None,
+    ) -> Dict[str, bool]:
+        """Check the existence of many objects at once.
+
+        If a common prefix is given it is listed once and every name is looked
+        up in the result; otherwise, or if the prefix holds too many blobs,
+        the objects are checked with concurrent HEAD requests.
+        """
+        object_names = list(object_names)
+        if not object_names:
+            return {}
+
+        if prefix is not None and all(name.startswith(prefix) for name in object_names):
+            listing = cls.list_object_names(container_name, prefix, MAX_LISTING_SIZE)
+            if listing is not None:
+                return {name: name in listing for name in object_names}
+            logging.info(
+                f"More than {MAX_LISTING_SIZE} blobs under {container_name}/{prefix}, "
+                "checking objects individually"
+            )
+
+        workers = max(1, min(EXISTS_CONCURRENCY, len(object_names)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            found = executor.map(
+                lambda name: cls.object_exists(container_name, name), object_names
+            )
+            return dict(zip(object_names, found))
+
     @classmethod
     def get_azure_object_json(cls, tag: str, container: str, object_name: str) -> dict:
         resp = {}
-        connection_string = cls._get_connection_string()
-        storage_client = BlobServiceClient.from_connection_string(connection_string)
-        blob_client = storage_client.get_blob_client(container, object_name)
+        blob_client = cls.get_container_client(container).get_blob_client(object_name)
         out = blob_client.download_blob().readall().decode("utf-8")
         try:
             resp = json.loads(out)
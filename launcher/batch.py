@@ -0,0 +1,228 @@
+"""Submit many job blobs in one invocation.
+
+Event Grid can deliver up to 5000 events per request to a webhook. The
+EventGridBatch function takes those BlobCreated events for
+'inputs/{date}/{job_id}/{jobtype}-job.json' and prepares their jobs
+concurrently, with at most SUBMISSION_BATCH_CONCURRENCY in flight. It then
+sends all their queue messages through dispatch_submissions_async.
+
+A job that raises gets a failed status, and the webhook answers with an
+error so that Event Grid retries the delivery. With IDEMPOTENT_TRIGGERS on,
+the retry skips the jobs that were submitted the first time.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import azure.functions as func
+
+from .dispatch import dispatch_submissions_async
+from .jobtypes import prepare_job_async
+from .ledger import (
+    DeliveryClaim,
+    claim_delivery_async,
+    etag_fingerprint,
+    idempotency_enabled,
+    release_delivery_async,
+    submit_claimed_async,
+)
+from .storage import StorageBackend, get_storage
+from .submission import (
+    INPUT_CONTAINER,
+    OUTPUT_CONTAINER,
+    JobSubmission,
+    parse_job_blob_name,
+)
+
+DEFAULT_BATCH_CONCURRENCY = 16
+
+BLOB_CREATED = "Microsoft.Storage.BlobCreated"
+SUBSCRIPTION_VALIDATION = "Microsoft.EventGrid.SubscriptionValidationEvent"
+
+_job_blob_subject = re.compile(
+    rf"/blobServices/default/containers/{INPUT_CONTAINER}/blobs/"
+    r"([^/]+/[^/]+/[^/]+-job\.json)$"
+)
+
+
+def batch_concurrency() -> int:
+    value = os.getenv("SUBMISSION_BATCH_CONCURRENCY")
+    if not value:
+        return DEFAULT_BATCH_CONCURRENCY
+    try:
+        return max(1, int(value))
+    except ValueError:
+        logging.warning(
+            f"Invalid SUBMISSION_BATCH_CONCURRENCY '{value}', "
+            f"using {DEFAULT_BATCH_CONCURRENCY}"
+        )
+        return DEFAULT_BATCH_CONCURRENCY
+
+
+@dataclass(frozen=True)
+class JobBlob:
+    """A job blob to submit, named relative to the input container."""
+
+    name: str
+    etag: str = ""
+
+
+def _event_type(event: dict) -> str:
+    # Event Grid schema, or CloudEvents schema
+    return event.get("eventType") or event.get("type") or ""
+
+
+def validation_response(events: List[dict]) -> Optional[dict]:
+    """The reply to an Event Grid subscription validation request, if it is one."""
+    for event in events:
+        if _event_type(event) == SUBSCRIPTION_VALIDATION:
+            return {"validationResponse": event["data"]["validationCode"]}
+    return None
+
+
+def job_blobs(events: List[dict]) -> List[JobBlob]:
+    """Job blobs created, ignoring other events and blobs; duplicates dropped."""
+    blobs: List[JobBlob] = []
+    for event in events:
+        if _event_type(event) != BLOB_CREATED:
+            continue
+        match = _job_blob_subject.search(event.get("subject", ""))
+        if match is None:
+            continue
+        blob = JobBlob(match.group(1), (event.get("data") or {}).get("eTag", ""))
+        if blob not in blobs:
+            blobs.append(blob)
+    return blobs
+
+
+async def prepare_with_status(
+    storage: StorageBackend, job_type: str, form: dict, job_id: str, date: str
+) -> JobSubmission:
+    """Prepare one job and write its initial status."""
+    submission = await prepare_job_async(job_type, form, job_id, date, storage)
+    await storage.to_async().put_object(
+        OUTPUT_CONTAINER,
+        submission.status_object,
+        json.dumps(submission.status_dict()),
+    )
+    return submission
+
+
+async def _write_failed_status(
+    storage: StorageBackend, job_type: str, job_id: str, date: str, err: Exception
+) -> JobSubmission:
+    submission = JobSubmission(job_id, date, job_type, status="failed")
+    status = submission.status_dict()
+    # build_status_dict only keeps the message of invalid jobs
+    status[job_type]["message"] = f"Could not submit the job: {type(err).__name__}"
+    try:
+        await storage.to_async().put_object(
+            OUTPUT_CONTAINER, submission.status_object, json.dumps(status)
+        )
+    except Exception as status_err:
+        logging.error(
+            f"{submission.job_tag} Could not write the failed status: "
+            f"{type(status_err).__name__}: {status_err}"
+        )
+    return submission
+
+
+async def _submit(
+    storage: StorageBackend, blob: JobBlob, semaphore: asyncio.Semaphore
+) -> Tuple[Optional[JobSubmission], bool, Optional[DeliveryClaim]]:
+    """Prepare one job blob and write its status.
+
+    :return: the submission (None for a duplicate delivery), whether
+             preparing it raised, and the delivery claimed for it, to be
+             settled once it is queued
+    """
+    date, job_id, file_name, job_type = parse_job_blob_name(blob.name)
+    tag = f"{date}/{job_id}"
+    claim = None
+    async with semaphore:
+        try:
+            if idempotency_enabled():
+                claim = await claim_delivery_async(
+                    storage, tag, file_name, etag_fingerprint(blob.etag)
+                )
+                if claim is None:
+                    return None, False, None
+            job_info = await storage.to_async().get_object_json(
+                tag, INPUT_CONTAINER, blob.name
+            )
+            submission = await prepare_with_status(
+                storage, job_type, job_info["form"], job_id, date
+            )
+        except Exception as err:
+            # One bad job must not hold up the rest of the batch
+            logging.error(
+                f"{tag} Error submitting {file_name}: {type(err).__name__}: {err}"
+            )
+            if claim is not None:
+                await release_delivery_async(storage, claim)
+            # Replaced by the retry if it succeeds
+            return (
+                await _write_failed_status(storage, job_type, job_id, date, err),
+                True,
+                None,
+            )
+    return submission, False, claim
+
+
+@dataclass
+class BatchResult:
+    """Jobs submitted from a batch of job blobs, and the ones that raised."""
+
+    submissions: List[JobSubmission] = field(default_factory=list)
+    errors: List[JobSubmission] = field(default_factory=list)
+
+
+async def submit_job_blobs(
+    blobs: List[JobBlob],
+    msg: func.Out[str],
+    storage: Optional[StorageBackend] = None,
+) -> BatchResult:
+    """Prepare and write the status of every job, then queue them together.
+
+    Jobs that raise get a failed status, and are listed in the result's
+    errors so that the delivery can be retried. The deliveries claimed in
+    the idempotency ledger are only marked done once their jobs are queued;
+    if queueing raises, they are all released and the error is raised.
+    """
+    if storage is None:
+        storage = get_storage()
+    semaphore = asyncio.Semaphore(batch_concurrency())
+    results = await asyncio.gather(
+        *(_submit(storage, blob, semaphore) for blob in blobs)
+    )
+    result = BatchResult()
+    claims: List[DeliveryClaim] = []
+    for submission, raised, claim in results:
+        if submission is not None:
+            (result.errors if raised else result.submissions).append(submission)
+        if claim is not None:
+            claims.append(claim)
+    # Nothing is marked done unless every message was sent
+    await submit_claimed_async(
+        storage,
+        claims,
+        lambda: dispatch_submissions_async(
+            [
+                submission
+                for submission in result.submissions
+                if submission.should_queue
+            ],
+            msg,
+            storage,
+        ),
+    )
+    logging.info(
+        f"Submitted {len(result.submissions)} of {len(blobs)} job blob(s), "
+        f"{len(result.errors)} failed"
+    )
+    return result
@@ -0,0 +1,252 @@
+"""Submit many jobs in one HTTP request.
+
+The body is a JSON array or NDJSON (one object per line) of jobs:
+
+    {"job_type": "pdb2pqr", "form": {...}, "files": {"1abc.pdb": "ATOM ..."}}
+
+'files' holds the contents of uploaded input files, by the name the form
+uses. APBS form jobs build on the output of an earlier PDB2PQR job, so they
+give that job's "job_id" and "job_date" and run under the same ID, as when
+the browser submits them. Every job is validated before anything is
+written. The other valid jobs get new job IDs, and the input files and
+statuses are written with bounded concurrency. Their messages are then queued together, as for a batch of
+job blobs, and all of the job IDs are returned at once.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import azure.functions as func
+
+from .apbs import APBSRunner
+from .batch import batch_concurrency, prepare_with_status
+from .dispatch import dispatch_submissions_async
+from .pipeline import PIPELINE_JOB_TYPE, pipelines_enabled
+from .storage import StorageBackend, get_storage
+from .submission import INPUT_CONTAINER, JOB_TYPES, OUTPUT_CONTAINER, JobSubmission
+from .sweep import SWEEP_JOB_TYPE, sweeps_enabled
+from .weboptions import WebOptions, WebOptionsError
+
+DEFAULT_MAX_BULK_JOBS = 1000
+
+_job_id = re.compile(r"[0-9A-Za-z_-]+")
+_job_date = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+class BulkSubmissionError(ValueError):
+    """The request body is not a list of jobs."""
+
+
+@dataclass
+class BulkJob:
+    """One job of a bulk submission."""
+
+    index: int
+    job_type: str
+    form: dict
+    files: Dict[str, str] = field(default_factory=dict)
+    job_id: str = ""
+    job_date: str = ""
+    error: str = ""
+    submission: Optional[JobSubmission] = None
+
+    @property
+    def job_tag(self) -> str:
+        return f"{self.job_date}/{self.job_id}"
+
+    def result(self) -> dict:
+        if self.error:
+            return {"index": self.index, "error": self.error}
+        return {
+            "index": self.index,
+            "job_id": self.job_id,
+            "job_date": self.job_date,
+            "job_type": self.job_type,
+            "status": self.submission.status if self.submission else "failed",
+        }
+
+
+def max_bulk_jobs() -> int:
+    value = os.getenv("BULK_SUBMISSION_MAX_JOBS")
+    if not value:
+        return DEFAULT_MAX_BULK_JOBS
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning(
+            f"Invalid BULK_SUBMISSION_MAX_JOBS '{value}', using {DEFAULT_MAX_BULK_JOBS}"
+        )
+        return DEFAULT_MAX_BULK_JOBS
+
+
+def parse_body(body: bytes) -> List[BulkJob]:
+    """Jobs from a JSON array or NDJSON body, in order."""
+    text = body.decode("utf-8").strip()
+    try:
+        if text.startswith("["):
+            items = json.loads(text)
+        else:
+            items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    except ValueError as err:
+        raise BulkSubmissionError(f"Invalid JSON: {err}")
+    if not items:
+        raise BulkSubmissionError("No jobs given")
+    if len(items) > max_bulk_jobs():
+        raise BulkSubmissionError(
+            f"{len(items)} jobs is more than the limit of {max_bulk_jobs()}"
+        )
+
+    jobs = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            jobs.append(BulkJob(index, "", {}, error="A job must be an object"))
+            continue
+        jobs.append(
+            BulkJob(
+                index,
+                str(item.get("job_type", "")),
+                item.get("form"),
+                item.get("files") or {},
+                str(item.get("job_id") or ""),
+                str(item.get("job_date") or ""),
+            )
+        )
+    return jobs
+
+
+def _job_types() -> List[str]:
+    job_types = list(JOB_TYPES)
+    if sweeps_enabled():
+        job_types.append(SWEEP_JOB_TYPE)
+    if pipelines_enabled():
+        job_types.append(PIPELINE_JOB_TYPE)
+    return job_types
+
+
+def is_apbs_form_job(job: BulkJob) -> bool:
+    """Whether a job reads its input from an earlier PDB2PQR job."""
+    return (
+        job.job_type == "apbs"
+        and isinstance(job.form, dict)
+        and "filename" not in job.form
+    )
+
+
+def _check_existing_job(job: BulkJob, storage: StorageBackend) -> str:
+    if not job.job_id or not job.job_date:
+        return "APBS form jobs need the job_id and job_date of their PDB2PQR job"
+    if not _job_id.fullmatch(job.job_id) or not _job_date.fullmatch(job.job_date):
+        return f"Invalid job_id or job_date: {job.job_tag}"
+    infile = f"{job.job_tag}/{job.job_id}.in"
+    if not storage.object_exists(OUTPUT_CONTAINER, infile):
+        return f"No PDB2PQR output for {job.job_tag}: {infile} not found"
+    return ""
+
+
+def validate_job(job: BulkJob, storage: StorageBackend) -> str:
+    """Check a job's form, reading but not writing storage.
+
+    :return: the reason the job is invalid, or "" if it is valid
+    """
+    if job.job_type not in _job_types():
+        return f"Invalid job type: {job.job_type}"
+    if not isinstance(job.form, dict):
+        return "The form must be an object"
+    if is_apbs_form_job(job):
+        error = _check_existing_job(job, storage)
+        if error:
+            return error
+    elif job.job_id or job.job_date:
+        return "Only APBS form jobs can give a job_id and job_date"
+    if not isinstance(job.files, dict) or any(
+        not isinstance(contents, str) or "/" in name or name in ("", ".", "..")
+        for name, contents in job.files.items()
+    ):
+        return "files must map plain file names to their contents"
+    try:
+        if job.job_type == "pdb2pqr" and job.form.get("invoke_method", "gui") in (
+            "gui",
+            "v1",
+        ):
+            options = WebOptions(job.job_tag, dict(job.form))
+            if options.user_did_upload and job.form["PDBFILE"] not in job.files:
+                return f"Uploaded file missing from files: {job.form['PDBFILE']}"
+        elif is_apbs_form_job(job):
+            # The constructor runs field_storage_to_dict on the form
+            APBSRunner(dict(job.form), job.job_id, job.job_date, storage)
+    except WebOptionsError as err:
+        return str(err)
+    except (KeyError, ValueError) as err:
+        return f"Invalid form: {type(err).__name__}: {err}"
+    return ""
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+async def _submit(
+    storage: StorageBackend, job: BulkJob, semaphore: asyncio.Semaphore
+) -> BulkJob:
+    async_storage = storage.to_async()
+    async with semaphore:
+        try:
+            await asyncio.gather(
+                *(
+                    async_storage.put_object(
+                        INPUT_CONTAINER,
+                        f"{job.job_tag}/{name}",
+                        contents.encode("utf-8"),
+                    )
+                    for name, contents in job.files.items()
+                )
+            )
+            job.submission = await prepare_with_status(
+                storage, job.job_type, job.form, job.job_id, job.job_date
+            )
+        except Exception as err:
+            logging.error(
+                f"{job.job_tag} Error submitting job: {type(err).__name__}: {err}"
+            )
+            job.error = f"Could not submit the job: {type(err).__name__}"
+    return job
+
+
+async def submit_jobs(
+    jobs: List[BulkJob],
+    msg: func.Out[str],
+    storage: Optional[StorageBackend] = None,
+) -> List[BulkJob]:
+    """Validate all jobs, then submit the valid ones together."""
+    if storage is None:
+        storage = get_storage()
+    job_date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    for job in jobs:
+        if job.error:
+            continue
+        job.error = validate_job(job, storage)
+        if not job.error and not is_apbs_form_job(job):
+            job.job_id = new_job_id()
+            job.job_date = job_date
+    valid = [job for job in jobs if not job.error]
+    logging.info(f"{len(valid)} of {len(jobs)} submitted job(s) are valid")
+
+    semaphore = asyncio.Semaphore(batch_concurrency())
+    await asyncio.gather(*(_submit(storage, job, semaphore) for job in valid))
+    await dispatch_submissions_async(
+        [
+            job.submission
+            for job in valid
+            if job.submission is not None and job.submission.should_queue
+        ],
+        msg,
+        storage,
+    )
+    return jobs
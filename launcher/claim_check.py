@@ -0,0 +1,167 @@
+"""Keep queue messages within the queue's size limit.
+
+Queue messages can be at most 64 KB once Base64 encoded, about 48 KB of
+JSON. Messages with many input files, and packed or sweep messages, can
+pass that. With QUEUE_CLAIM_CHECK on, a message over the threshold is
+written to 'inputs/queue-messages/{sha256}.json' and the queue gets a
+pointer to it instead:
+
+    {"schema_version": 1, "job_type": ..., "claim_check":
+        {"container": "inputs", "object": ..., "sha256": ..., "size": ...}}
+
+With QUEUE_MESSAGE_ENCODING=compact, messages are sent as zlib compressed,
+Base64 encoded JSON:
+
+    {"schema_version": 1, "encoding": "zlib+base64", "data": ...}
+
+A message without 'schema_version' is the plain JSON message. The worker
+reads the others with decode_message.
+
+Claim check blobs are not deleted once read: a message can be delivered
+more than once, and identical messages share a blob. They are left to a
+lifecycle rule on the 'queue-messages/' prefix that deletes them some time
+after they were last written, longer than the queue's message time-to-live.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import zlib
+from typing import Optional, Tuple
+
+from .storage import StorageBackend, get_storage
+from .submission import INPUT_CONTAINER
+
+SCHEMA_VERSION = 1
+COMPACT_ENCODING = "zlib+base64"
+CLAIM_CHECK_PREFIX = "queue-messages"
+
+# Base64 adds a third: 64 KB on the queue is 48 KB of JSON, less some margin
+QUEUE_MESSAGE_LIMIT = 48 * 1024
+DEFAULT_CLAIM_CHECK_THRESHOLD = 45 * 1024
+
+# Copied into pointers, so they can be logged and routed without the blob
+_POINTER_FIELDS = ("job_date", "job_id", "job_tag", "job_type", "max_run_time")
+
+
+def claim_check_enabled() -> bool:
+    return os.getenv("QUEUE_CLAIM_CHECK", "").lower() in ("1", "true")
+
+
+def compact_encoding_enabled() -> bool:
+    return os.getenv("QUEUE_MESSAGE_ENCODING", "json").lower() == "compact"
+
+
+def claim_check_threshold() -> int:
+    value = os.getenv("QUEUE_CLAIM_CHECK_THRESHOLD")
+    if not value:
+        return DEFAULT_CLAIM_CHECK_THRESHOLD
+    try:
+        return min(int(value), QUEUE_MESSAGE_LIMIT)
+    except ValueError:
+        logging.warning(
+            f"Invalid QUEUE_CLAIM_CHECK_THRESHOLD '{value}', "
+            f"using {DEFAULT_CLAIM_CHECK_THRESHOLD}"
+        )
+        return DEFAULT_CLAIM_CHECK_THRESHOLD
+
+
+def _compact(body: str) -> str:
+    data = base64.b64encode(zlib.compress(body.encode("utf-8"))).decode("ascii")
+    return json.dumps(
+        {"schema_version": SCHEMA_VERSION, "encoding": COMPACT_ENCODING, "data": data}
+    )
+
+
+def _encoded(message: dict) -> str:
+    body = json.dumps(message)
+    if compact_encoding_enabled():
+        compact = _compact(body)
+        # Tiny messages can grow when compressed
+        if len(compact) < len(body):
+            return compact
+    return body
+
+
+def _claim_check(message: dict, body: str) -> Tuple[str, str, bytes]:
+    """The pointer to send, and the object to write the body to."""
+    data = body.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    object_name = f"{CLAIM_CHECK_PREFIX}/{digest}.json"
+    pointer = {"schema_version": SCHEMA_VERSION}
+    pointer.update({name: message[name] for name in _POINTER_FIELDS if name in message})
+    pointer["claim_check"] = {
+        "container": INPUT_CONTAINER,
+        "object": object_name,
+        "sha256": digest,
+        "size": len(data),
+    }
+    return json.dumps(pointer), object_name, data
+
+
+def _check_size(message: dict, body: str):
+    if len(body.encode("utf-8")) > QUEUE_MESSAGE_LIMIT:
+        logging.error(
+            f"{message.get('job_tag', message.get('job_type'))} Queue message of "
+            f"{len(body)} bytes is over the queue's limit; set QUEUE_CLAIM_CHECK"
+        )
+
+
+def encode_message(message: dict, storage: Optional[StorageBackend] = None) -> str:
+    """The body to queue for a message, spilling it to a blob if too large."""
+    body = _encoded(message)
+    if not claim_check_enabled():
+        _check_size(message, body)
+        return body
+    if len(body.encode("utf-8")) <= claim_check_threshold():
+        return body
+    if storage is None:
+        storage = get_storage()
+    # Always the full JSON message: the blob is not size limited
+    pointer, object_name, data = _claim_check(message, json.dumps(message))
+    # Written even if it exists, so that the lifecycle rule counts from now
+    storage.put_object(INPUT_CONTAINER, object_name, data)
+    logging.info(f"Queue message of {len(data)} bytes sent as {object_name}")
+    return pointer
+
+
+async def encode_message_async(
+    message: dict, storage: Optional[StorageBackend] = None
+) -> str:
+    """Asyncio version of encode_message."""
+    body = _encoded(message)
+    if not claim_check_enabled():
+        _check_size(message, body)
+        return body
+    if len(body.encode("utf-8")) <= claim_check_threshold():
+        return body
+    if storage is None:
+        storage = get_storage()
+    pointer, object_name, data = _claim_check(message, json.dumps(message))
+    await storage.to_async().put_object(INPUT_CONTAINER, object_name, data)
+    logging.info(f"Queue message of {len(data)} bytes sent as {object_name}")
+    return pointer
+
+
+def decode_message(body: str, storage: Optional[StorageBackend] = None) -> dict:
+    """The message a queued body stands for, whatever its encoding."""
+    message = json.loads(body)
+    if "schema_version" not in message:
+        return message
+    if message["schema_version"] > SCHEMA_VERSION:
+        raise ValueError(f"Unknown schema_version: {message['schema_version']}")
+    if message.get("encoding") == COMPACT_ENCODING:
+        return json.loads(zlib.decompress(base64.b64decode(message["data"])))
+    if "claim_check" in message:
+        if storage is None:
+            storage = get_storage()
+        claim_check = message["claim_check"]
+        data = b"".join(
+            storage.iter_chunks(claim_check["container"], claim_check["object"])
+        )
+        if hashlib.sha256(data).hexdigest() != claim_check["sha256"]:
+            raise ValueError(f"Claim check {claim_check['object']} does not match")
+        return json.loads(data)
+    raise ValueError("Queue message has neither an encoding nor a claim check")
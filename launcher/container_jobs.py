@@ -0,0 +1,178 @@
+"""Start executions of the APBS/PDB2PQR Container Apps job."""
+
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Set, Tuple
+
+from azure.identity import ManagedIdentityCredential
+from azure.mgmt.appcontainers import ContainerAppsAPIClient
+
+# Start modes: "wait" blocks until the execution is running, "background"
+# returns once the start request is accepted and polls on another thread
+START_MODE_WAIT = "wait"
+START_MODE_BACKGROUND = "background"
+START_TIMEOUT = 150
+
+# Threads used to follow start requests in background mode
+BACKGROUND_POLLERS = 4
+
+
+@dataclass(frozen=True)
+class ContainerJobSettings:
+    client_id: str
+    subscription_id: str
+    resource_group_name: str
+    job_name: str
+
+
+def get_job_settings(job_name: Optional[str] = None) -> Optional[ContainerJobSettings]:
+    """Read the container job settings, logging the first one missing.
+
+    :param job_name: use this job instead of JOB_NAME
+    """
+    client_id = os.getenv("CONTAINER_APP_CLIENT_ID")
+    if client_id is None:
+        logging.error("No client ID found for Managed Identity")
+        return None
+    subscription_id = os.getenv("SUBSCRIPTION_ID")
+    if subscription_id is None:
+        logging.error("No subscription ID found for Managed Identity")
+        return None
+    resource_group_name = os.getenv("RESOURCE_GROUP_NAME")
+    if resource_group_name is None:
+        logging.error("No resource group name found for Managed Identity")
+        return None
+    if job_name is None:
+        job_name = os.getenv("JOB_NAME")
+    if job_name is None:
+        logging.error("No job name found for Managed Identity")
+        return None
+    return ContainerJobSettings(
+        client_id, subscription_id, resource_group_name, job_name
+    )
+
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, "").lower() in ("1", "true")
+
+
+def _get_start_mode() -> str:
+    mode = os.getenv("CONTAINER_JOB_START_MODE", START_MODE_WAIT).lower()
+    if mode not in (START_MODE_WAIT, START_MODE_BACKGROUND):
+        logging.warning(
+            f"Unknown CONTAINER_JOB_START_MODE '{mode}', using '{START_MODE_WAIT}'"
+        )
+        return START_MODE_WAIT
+    return mode
+
+
+# The credential caches its access token, so keeping one credential and one
+# management client per worker process saves a token request and the client
+# pipeline setup on every invocation.
+_client_lock = threading.Lock()
+_client: Optional[ContainerAppsAPIClient] = None
+# The client is per identity and subscription, not per job
+_client_key: Optional[Tuple[str, str]] = None
+
+_pollers_lock = threading.Lock()
+_poller_executor: Optional[ThreadPoolExecutor] = None
+_pending_starts: Set[Future] = set()
+
+
+def get_container_apps_client(settings: ContainerJobSettings) -> ContainerAppsAPIClient:
+    global _client, _client_key
+    with _client_lock:
+        key = (settings.client_id, settings.subscription_id)
+        if _client is None or _client_key != key:
+            credential = ManagedIdentityCredential(client_id=settings.client_id)
+            _client = ContainerAppsAPIClient(credential, settings.subscription_id)
+            _client_key = key
+            logging.info("Created Container Apps client")
+        return _client
+
+
+def set_container_apps_client(
+    client: Optional[ContainerAppsAPIClient],
+    settings: Optional[ContainerJobSettings] = None,
+):
+    """Replace the shared client, e.g. with a fake; None rebuilds it lazily."""
+    global _client, _client_key
+    with _client_lock:
+        _client = client
+        _client_key = None
+        if client is not None and settings is not None:
+            _client_key = (settings.client_id, settings.subscription_id)
+
+
+def pending_starts() -> int:
+    """Number of start requests still being followed in the background."""
+    with _pollers_lock:
+        return len(_pending_starts)
+
+
+def _wait_for_start(job_name: str, poller):
+    result = poller.result(timeout=START_TIMEOUT)
+    logging.info(f"Job start status for {job_name}: {result}")
+    return result
+
+
+def _log_background_start(future: Future):
+    with _pollers_lock:
+        _pending_starts.discard(future)
+    err = future.exception()
+    if err is not None:
+        logging.error(
+            f"Error waiting for container job start: {type(err).__name__}: {err}"
+        )
+
+
+def _track_in_background(job_name: str, poller):
+    global _poller_executor
+    with _pollers_lock:
+        if _poller_executor is None:
+            _poller_executor = ThreadPoolExecutor(
+                max_workers=BACKGROUND_POLLERS, thread_name_prefix="job-start"
+            )
+        future = _poller_executor.submit(_wait_for_start, job_name, poller)
+        _pending_starts.add(future)
+    future.add_done_callback(_log_background_start)
+
+
+def begin_job_start(client: ContainerAppsAPIClient, settings: ContainerJobSettings):
+    """Ask for one new execution of the job, honouring the start mode."""
+    if _env_flag("CONTAINER_JOB_DIAGNOSTICS"):
+        logging.info("Checking job status")
+        job_info = client.jobs.get(
+            resource_group_name=settings.resource_group_name,
+            job_name=settings.job_name,
+        )
+        logging.info(f"Current info: {job_info}")
+
+    poller = client.jobs.begin_start(
+        resource_group_name=settings.resource_group_name,
+        job_name=settings.job_name,
+    )
+    logging.info(f"Poller status: {poller.status()}")
+    if _get_start_mode() == START_MODE_BACKGROUND:
+        logging.info("Start accepted, waiting for job start in the background")
+        _track_in_background(settings.job_name, poller)
+    else:
+        logging.info("Waiting for job start")
+        _wait_for_start(settings.job_name, poller)
+
+
+def start_container_job(job_name: Optional[str] = None):
+    """Start one execution of JOB_NAME, or of job_name if given."""
+    logging.info("In start container job")
+    settings = get_job_settings(job_name)
+    if settings is None:
+        return
+    logging.info("Starting poll")
+    try:
+        begin_job_start(get_container_apps_client(settings), settings)
+    except Exception as err:
+        logging.error(f"Error starting container job: {type(err).__name__}: {err}")
+        return
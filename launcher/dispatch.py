@@ -0,0 +1,115 @@
+"""Send a prepared submission to its queue and get a container to run it."""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import azure.functions as func
+
+from .fanout import rank_messages, rank_messages_async, should_fan_out
+from .packing import (
+    is_packable,
+    pack_child_messages,
+    pack_ready_messages,
+    packing_enabled,
+)
+from .routing import enqueue_messages, enqueue_messages_async, route_submission
+from .scheduler import JobClass, request_container_start
+from .storage import StorageBackend, get_storage
+from .submission import JobSubmission
+
+
+def dispatch_submission(
+    submission: JobSubmission,
+    msg: func.Out[str],
+    storage: Optional[StorageBackend] = None,
+):
+    """Queue a submission, splitting or packing it as configured."""
+    if storage is None:
+        storage = get_storage()
+    job_class = route_submission(submission)
+    if submission.child_messages:
+        queue_messages = pack_child_messages(submission, job_class)
+    elif should_fan_out(submission):
+        queue_messages = rank_messages(storage, submission)
+    else:
+        queue_messages = [submission.queue_message()]
+    _send(submission, msg, queue_messages, job_class)
+
+
+async def dispatch_submission_async(
+    submission: JobSubmission,
+    msg: func.Out[str],
+    storage: Optional[StorageBackend] = None,
+):
+    """Asyncio version of dispatch_submission."""
+    if storage is None:
+        storage = get_storage()
+    job_class = route_submission(submission)
+    if submission.child_messages:
+        queue_messages = pack_child_messages(submission, job_class)
+    elif should_fan_out(submission):
+        queue_messages = await rank_messages_async(storage, submission)
+    else:
+        queue_messages = [submission.queue_message()]
+    _log_messages(submission, queue_messages)
+    await enqueue_messages_async(msg, queue_messages, job_class)
+    logging.info("Starting container job")
+    await asyncio.to_thread(request_container_start, job_class, len(queue_messages))
+
+
+async def dispatch_submissions_async(
+    submissions: List[JobSubmission],
+    msg: func.Out[str],
+    storage: Optional[StorageBackend] = None,
+):
+    """Queue several submissions at once.
+
+    Messages are grouped by queue, so each queue gets one send and one
+    container start request for all of its messages. Small jobs are packed
+    with each other directly, as they are all at hand.
+    """
+    if storage is None:
+        storage = get_storage()
+    # By job class: the class, messages to send as they are, messages to pack
+    groups: Dict[str, Tuple[Optional[JobClass], List[dict], List[dict]]] = {}
+    for submission in submissions:
+        job_class = route_submission(submission)
+        pack = packing_enabled() and is_packable(submission)
+        if submission.child_messages:
+            queue_messages = submission.child_messages
+        elif should_fan_out(submission):
+            queue_messages = await rank_messages_async(storage, submission)
+            pack = False
+        else:
+            queue_messages = [submission.queue_message()]
+        _log_messages(submission, queue_messages)
+        key = job_class.name if job_class is not None else "default"
+        group = groups.setdefault(key, (job_class, [], []))
+        group[2 if pack else 1].extend(queue_messages)
+
+    for job_class, queue_messages, packable in groups.values():
+        queue_messages = queue_messages + pack_ready_messages(packable)
+        if not queue_messages:
+            continue
+        await enqueue_messages_async(msg, queue_messages, job_class)
+        logging.info("Starting container job")
+        await asyncio.to_thread(request_container_start, job_class, len(queue_messages))
+
+
+def _send(
+    submission: JobSubmission,
+    msg: func.Out[str],
+    queue_messages: List[dict],
+    job_class,
+):
+    _log_messages(submission, queue_messages)
+    enqueue_messages(msg, queue_messages, job_class)
+    logging.info("Starting container job")
+    request_container_start(job_class, len(queue_messages))
+    logging.info("Container job started")
+
+
+def _log_messages(submission: JobSubmission, queue_messages: List[dict]):
+    for queue_message in queue_messages:
+        logging.info(f"{submission.job_tag} Queue Message: {queue_message}")
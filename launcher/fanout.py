@@ -0,0 +1,141 @@
+"""Run mg-para APBS jobs as one subjob per processor.
+
+APBS can solve a single processor's share of a parallel focusing
+calculation when the ELEC block has 'async <rank>'. Instead of running all
+pdimeNX*pdimeNY*pdimeNZ ranks in one container, each rank gets its own
+input file and queue message, and the reducer in subjobs.py merges the
+results once every rank has finished.
+"""
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from .apbs import APBSRunner
+from .storage import StorageBackend
+from .submission import INPUT_CONTAINER, JobSubmission
+from .subjobs import SUBJOB_KIND_MG_PARA, subjob_tag, write_subjob_manifest
+from .utils import DEFAULT_COPY_CONCURRENCY, apbs_infile_creator
+
+# More ranks than this and the job is left to run in one container
+MAX_RANKS = 64
+
+
+def fanout_enabled() -> bool:
+    return os.getenv("MG_PARA_FANOUT", "").lower() in ("1", "true")
+
+
+def rank_count(submission: JobSubmission) -> int:
+    features = submission.runtime_features
+    return features.processors if features is not None else 1
+
+
+def should_fan_out(submission: JobSubmission) -> bool:
+    if not fanout_enabled() or not isinstance(submission.runner, APBSRunner):
+        return False
+    if submission.runner.form is None:
+        # Direct runs bring their own input file, which is not rewritten
+        return False
+    ranks = rank_count(submission)
+    if submission.runner.apbs_options["calcType"] != "mg-para" or ranks < 2:
+        return False
+    if ranks > MAX_RANKS:
+        logging.warning(
+            f"{submission.job_tag} {ranks} ranks is more than {MAX_RANKS}, "
+            "running the job in one container"
+        )
+        return False
+    return True
+
+
+def rank_name(rank: int) -> str:
+    return f"rank{rank}"
+
+
+def _rank_infile(submission: JobSubmission, rank: int) -> Tuple[str, str]:
+    """Object name and contents of the input file for one rank."""
+    runner = submission.runner
+    apbs_options = dict(runner.apbs_options, asyncflag=True)
+    apbs_options["async"] = rank
+    rank_tag = subjob_tag(submission.job_tag, rank_name(rank))
+    contents = apbs_infile_creator(rank_tag, apbs_options)
+    return f"{rank_tag}/{apbs_options['tempFile']}", contents
+
+
+def _rank_message(submission: JobSubmission, rank: int, ranks: int) -> dict:
+    runner = submission.runner
+    job_tag = submission.job_tag
+    infile_name = runner.apbs_options["tempFile"]
+    pqr_file_name = runner.apbs_options["pqrFileName"]
+    rank_tag = subjob_tag(job_tag, rank_name(rank))
+
+    # Every rank reads the parent's PQR file, wherever that lives
+    parent_pqr = f"{job_tag}/{pqr_file_name}"
+    pqr_source = submission.input_manifest.get(
+        parent_pqr, {"container": INPUT_CONTAINER, "object": parent_pqr}
+    )
+    message = submission.queue_message()
+    message.update(
+        {
+            "job_id": f"{submission.job_id}/{rank_name(rank)}",
+            "job_tag": rank_tag,
+            "input_files": [f"{rank_tag}/{pqr_file_name}", f"{rank_tag}/{infile_name}"],
+            "input_manifest": {f"{rank_tag}/{pqr_file_name}": pqr_source},
+            "command_line_args": infile_name,
+            "parent_job_tag": job_tag,
+            "rank": rank,
+            "ranks": ranks,
+        }
+    )
+    return message
+
+
+def _finish(
+    storage: StorageBackend, submission: JobSubmission, ranks: int
+) -> List[dict]:
+    write_subjob_manifest(
+        storage,
+        submission,
+        SUBJOB_KIND_MG_PARA,
+        [rank_name(rank) for rank in range(ranks)],
+        {"ranks": ranks},
+    )
+    return [_rank_message(submission, rank, ranks) for rank in range(ranks)]
+
+
+def rank_messages(storage: StorageBackend, submission: JobSubmission) -> List[dict]:
+    """Upload the rank input files and return one queue message per rank."""
+    ranks = rank_count(submission)
+    infiles = [_rank_infile(submission, rank) for rank in range(ranks)]
+    with ThreadPoolExecutor(max_workers=DEFAULT_COPY_CONCURRENCY) as executor:
+        list(
+            executor.map(
+                lambda infile: storage.put_object(
+                    INPUT_CONTAINER, infile[0], infile[1].encode("utf-8")
+                ),
+                infiles,
+            )
+        )
+    return _finish(storage, submission, ranks)
+
+
+async def rank_messages_async(
+    storage: StorageBackend, submission: JobSubmission
+) -> List[dict]:
+    """Asyncio version of rank_messages."""
+    ranks = rank_count(submission)
+    async_storage = storage.to_async()
+    semaphore = asyncio.Semaphore(DEFAULT_COPY_CONCURRENCY)
+
+    async def _upload(infile: Tuple[str, str]):
+        async with semaphore:
+            await async_storage.put_object(
+                INPUT_CONTAINER, infile[0], infile[1].encode("utf-8")
+            )
+
+    await asyncio.gather(
+        *(_upload(_rank_infile(submission, rank)) for rank in range(ranks))
+    )
+    return await asyncio.to_thread(_finish, storage, submission, ranks)
@@ -0,0 +1,81 @@
+"""Shared, content-addressed copies of uploaded input files.
+
+The same structures are uploaded over and over, each time under a new
+'{date}/{job_id}/'. With the store enabled, every uploaded input is also
+kept once under 'store/sha256/{digest}' in the input container, and the
+job's input_manifest points the worker at that copy:
+
+    {"{date}/{job_id}/1abc.pdb": {"container": "inputs",
+                                  "object": "store/sha256/...",
+                                  "sha256": "..."}}
+
+so workers can cache hot inputs locally by digest. The upload is hashed as
+it is streamed, then copied to the store by the storage service if the
+content is new; the store copy replaces the sanitizing copy of PDB2PQR web
+uploads. The uploads themselves are kept, as a retry of the submission
+reads them again, so storage only shrinks once a lifecycle rule on the
+input container expires them.
+"""
+
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from .jobsetup import JobSetup
+from .storage import StorageBackend
+from .utils import DEFAULT_COPY_CONCURRENCY
+
+INPUT_STORE_PREFIX = "store/sha256"
+
+
+def input_store_enabled() -> bool:
+    return os.getenv("INPUT_CONTENT_STORE", "").lower() in ("1", "true")
+
+
+def content_object(digest: str) -> str:
+    return f"{INPUT_STORE_PREFIX}/{digest}"
+
+
+def store_input(storage: StorageBackend, container: str, object_name: str) -> dict:
+    """Add an object to the store.
+
+    :return: the input_manifest entry for the stored copy
+    """
+    digest = hashlib.sha256()
+    for chunk in storage.iter_chunks(container, object_name):
+        digest.update(chunk)
+    stored = content_object(digest.hexdigest())
+    # Named by content, so an existing object already holds these bytes
+    if not storage.object_exists(container, stored):
+        # Jobs racing to store the same content copy identical bytes
+        storage.copy_object(container, object_name, stored)
+        logging.debug(f"Stored {object_name} as {stored}")
+    return {"container": container, "object": stored, "sha256": digest.hexdigest()}
+
+
+def store_inputs(runner: JobSetup, container: str) -> Dict[str, dict]:
+    """Point the runner's uploaded inputs at their copies in the store."""
+    uploaded = runner.uploaded_input_files()
+    if not uploaded:
+        return {}
+    with ThreadPoolExecutor(
+        max_workers=min(DEFAULT_COPY_CONCURRENCY, len(uploaded))
+    ) as executor:
+        entries = dict(
+            zip(
+                uploaded,
+                executor.map(
+                    lambda name: store_input(
+                        runner.storage,
+                        container,
+                        runner.renamed_inputs.get(name, name),
+                    ),
+                    uploaded,
+                ),
+            )
+        )
+    runner.input_manifest.update(entries)
+    logging.info(f"{runner.job_tag} {len(entries)} input(s) read from the store")
+    return entries
@@ -0,0 +1,68 @@
+"""Direct access to the backend job queue, alongside the queue_output binding."""
+
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+from azure.identity import ManagedIdentityCredential
+from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+
+BACKEND_QUEUE = "apbsbackendqueue"
+
+# Uses the same settings as the "OutputQueue" binding connection: either
+# OutputQueue (a connection string, e.g. for local development) or the
+# identity based OutputQueue__serviceUri/OutputQueue__clientId pair.
+# Messages are Base64 encoded, like those written by the binding.
+_queue_lock = threading.Lock()
+_queue_clients: Dict[str, QueueClient] = {}
+
+
+def get_queue_client(queue_name: str = BACKEND_QUEUE) -> QueueClient:
+    with _queue_lock:
+        client = _queue_clients.get(queue_name)
+        if client is not None:
+            return client
+        connection_string = os.getenv("OutputQueue")
+        service_uri = os.getenv("OutputQueue__serviceUri")
+        if connection_string:
+            client = QueueClient.from_connection_string(
+                connection_string,
+                queue_name,
+                message_encode_policy=TextBase64EncodePolicy(),
+            )
+        elif service_uri:
+            credential = ManagedIdentityCredential(
+                client_id=os.getenv("OutputQueue__clientId")
+            )
+            client = QueueClient(
+                service_uri,
+                queue_name,
+                credential=credential,
+                message_encode_policy=TextBase64EncodePolicy(),
+            )
+        else:
+            raise ValueError(
+                "Missing OutputQueue or OutputQueue__serviceUri environment variable"
+            )
+        _queue_clients[queue_name] = client
+        logging.info(f"Created queue client for {queue_name}")
+        return client
+
+
+def get_queue_depth(queue_name: str = BACKEND_QUEUE) -> Optional[int]:
+    """Approximate number of messages waiting, or None if it can't be read."""
+    try:
+        properties = get_queue_client(queue_name).get_queue_properties()
+    except Exception as err:
+        logging.warning(
+            f"Could not read the length of {queue_name}: {type(err).__name__}: {err}"
+        )
+        return None
+    return properties.approximate_message_count
+
+
+def send_message(queue_name: str, content: str):
+    """Queue a message outside of the queue_output binding."""
+    get_queue_client(queue_name).send_message(content)
+    logging.info(f"Message sent to {queue_name}")
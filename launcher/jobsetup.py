@@ -1,8 +1,11 @@
 """Base class containing shared methods used in APBS/PDB2PQR setup classes."""
 
 import logging
+from typing import List, Optional
 from urllib3.util import parse_url
 
+from .storage import StorageBackend, get_storage
+
 
 class JobDirectoryExistsError(Exception):
     def __init__(self, expression):
@@ -16,11 +19,20 @@ class MissingFilesError(FileNotFoundError):
 
 
 class JobSetup:
-    def __init__(self, job_id: str, job_date: str) -> None:
+    def __init__(
+        self, job_id: str, job_date: str, storage: Optional[StorageBackend] = None
+    ) -> None:
+        self.storage = storage if storage is not None else get_storage()
         self.job_id = job_id
         self.job_date = job_date
         self.job_tag = f"{job_date}/{job_id}"
         self.input_files = []
+        # Inputs that the worker should read from somewhere other than
+        # '{bucket_name}/{input file}', keyed by input file
+        self.input_manifest = {}
+        # Uploaded object to read an input from, when its sanitizing copy is
+        # left to the input store, keyed by input file
+        self.renamed_inputs = {}
         self.output_files = []
         self._missing_files = []
 
@@ -39,6 +51,25 @@ class JobSetup:
         logging.debug(f"{self.job_tag} Adding an input file, {file_name}")
         self.input_files.append(file_name)
 
+    def add_input_reference(self, file_name: str, container: str, object_name: str):
+        """Add an input file that is read from another container/object."""
+        self.add_input_file(file_name)
+        logging.debug(
+            f"{self.job_tag} Input file {file_name} is read from {container}/{object_name}"
+        )
+        self.input_manifest[self.input_files[-1]] = {
+            "container": container,
+            "object": object_name,
+        }
+
+    def uploaded_input_files(self) -> List[str]:
+        """Input objects that came with the submission, not URLs or references."""
+        return [
+            file_name
+            for file_name in self.input_files
+            if not self.is_url(file_name) and file_name not in self.input_manifest
+        ]
+
     def add_output_file(self, file_name: str):
         file_name = self.get_object_name(file_name)
         logging.debug(f"{self.job_tag} Adding an output file, {file_name}")
@@ -0,0 +1,63 @@
+"""Prepare a submission of any job type, including those split into subjobs."""
+
+import asyncio
+from typing import Optional
+
+from .pipeline import (
+    PIPELINE_JOB_TYPE,
+    pipelines_enabled,
+    prepare_pipeline,
+    prepare_pipeline_async,
+)
+from .result_cache import result_cache_enabled, use_cached_result
+from .storage import StorageBackend
+from .submission import JobSubmission, prepare_submission, prepare_submission_async
+from .sweep import SWEEP_JOB_TYPE, prepare_sweep, prepare_sweep_async, sweeps_enabled
+
+
+def _cacheable(submission: JobSubmission) -> bool:
+    return (
+        result_cache_enabled()
+        and submission.job_type == "pdb2pqr"
+        and submission.should_queue
+    )
+
+
+def prepare_job(
+    job_type: str,
+    form: dict,
+    job_id: str,
+    job_date: str,
+    storage: Optional[StorageBackend] = None,
+) -> JobSubmission:
+    """Prepare a job form, or the jobs of a sweep or pipeline if enabled."""
+    if job_type == SWEEP_JOB_TYPE and sweeps_enabled():
+        return prepare_sweep(form, job_id, job_date, storage)
+    if job_type == PIPELINE_JOB_TYPE and pipelines_enabled():
+        return prepare_pipeline(form, job_id, job_date, storage)
+    submission = prepare_submission(job_type, form, job_id, job_date, storage)
+    if _cacheable(submission):
+        use_cached_result(submission.runner.storage, submission)
+    return submission
+
+
+async def prepare_job_async(
+    job_type: str,
+    form: dict,
+    job_id: str,
+    job_date: str,
+    storage: Optional[StorageBackend] = None,
+) -> JobSubmission:
+    """Asyncio version of prepare_job."""
+    if job_type == SWEEP_JOB_TYPE and sweeps_enabled():
+        return await prepare_sweep_async(form, job_id, job_date, storage)
+    if job_type == PIPELINE_JOB_TYPE and pipelines_enabled():
+        return await prepare_pipeline_async(form, job_id, job_date, storage)
+    submission = await prepare_submission_async(
+        job_type, form, job_id, job_date, storage
+    )
+    if _cacheable(submission):
+        await asyncio.to_thread(
+            use_cached_result, submission.runner.storage, submission
+        )
+    return submission
@@ -0,0 +1,362 @@
+"""Idempotency ledger for job blob deliveries.
+
+Event Grid delivers at least once, so the same '{jobtype}-job.json' upload
+can trigger more than one invocation. The first invocation for a given
+blob version claims it by creating 'outputs/idempotency/{job_tag}/
+{file_name}/{etag}' with a conditional write, in the "processing" state.
+The work a claim was taken for is run through submit_claimed (or
+run_claimed for other markers): only once it returns, i.e. once the job is
+queued, does the marker move to "done"; if it raises, the marker is deleted
+so that the retry can claim it again.
+
+Only a "done" marker, or a "processing" one younger than the lease,
+suppresses a delivery. A claim left behind by an invocation that never
+finished (e.g. a recycled host) expires after IDEMPOTENCY_LEASE seconds and
+is then taken over with an ETag conditional write. claim_marker and
+run_claimed give the same guarantee to other steps that must happen once,
+like queueing the APBS stage of a pipeline.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+from time import time
+from typing import Awaitable, Callable, Iterable, Optional, TypeVar
+
+import azure.functions as func
+
+from .storage import AsyncStorageBackend, StorageBackend
+
+IDEMPOTENCY_CONTAINER = "outputs"
+IDEMPOTENCY_PREFIX = "idempotency"
+
+CLAIM_PROCESSING = "processing"
+CLAIM_DONE = "done"
+# Longer than the function timeout, so a live claim never expires
+DEFAULT_IDEMPOTENCY_LEASE = 15 * 60
+
+T = TypeVar("T")
+
+
+def idempotency_enabled() -> bool:
+    return os.getenv("IDEMPOTENT_TRIGGERS", "").lower() in ("1", "true")
+
+
+def idempotency_lease() -> int:
+    value = os.getenv("IDEMPOTENCY_LEASE")
+    if not value:
+        return DEFAULT_IDEMPOTENCY_LEASE
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning(
+            f"Invalid IDEMPOTENCY_LEASE '{value}', using {DEFAULT_IDEMPOTENCY_LEASE}"
+        )
+        return DEFAULT_IDEMPOTENCY_LEASE
+
+
+@dataclass
+class LedgerStats:
+    """Running count of claimed and suppressed deliveries."""
+
+    claimed: int = 0
+    duplicates: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, duplicate: bool):
+        with self._lock:
+            if duplicate:
+                self.duplicates += 1
+            else:
+                self.claimed += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"claimed": self.claimed, "duplicates": self.duplicates}
+
+    def reset(self):
+        with self._lock:
+            self.claimed = 0
+            self.duplicates = 0
+
+
+ledger_stats = LedgerStats()
+
+
+def etag_fingerprint(etag: str) -> str:
+    # ETags are quoted and may contain characters not wanted in names
+    return re.sub(r"[^0-9A-Za-z]", "", etag)
+
+
+def delivery_fingerprint(client: func.InputStream) -> str:
+    """The blob version being delivered: its ETag, or a hash of its contents."""
+    # Only set by newer versions of the Python worker
+    properties = getattr(client, "blob_properties", None) or {}
+    for key in ("ETag", "Etag", "etag"):
+        if properties.get(key):
+            return etag_fingerprint(str(properties[key]))
+    return hashlib.sha256(client.read()).hexdigest()
+
+
+def _marker(state: str) -> str:
+    return json.dumps({"state": state, "time": time()})
+
+
+def _expired(data: bytes) -> bool:
+    """Whether a marker is a claim left behind by an unfinished invocation."""
+    try:
+        marker = json.loads(data)
+    except ValueError:
+        marker = None
+    if not isinstance(marker, dict) or marker.get("state") == CLAIM_DONE:
+        # Markers from before the claim states were added are all done
+        return False
+    return time() - marker.get("time", 0) >= idempotency_lease()
+
+
+def claim_marker(storage: StorageBackend, container: str, object_name: str) -> bool:
+    """Create a "processing" marker, or take over an expired one.
+
+    :return: True if this call holds the claim
+    """
+    if storage.create_object(container, object_name, _marker(CLAIM_PROCESSING)):
+        return True
+    try:
+        data, etag = storage.download_with_etag(container, object_name)
+    except FileNotFoundError:
+        # Released between the create and the read
+        return storage.create_object(container, object_name, _marker(CLAIM_PROCESSING))
+    if not _expired(data):
+        return False
+    logging.warning(f"Taking over an expired claim on {container}/{object_name}")
+    return storage.replace_object(
+        container, object_name, _marker(CLAIM_PROCESSING), etag
+    )
+
+
+async def claim_marker_async(
+    storage: AsyncStorageBackend, container: str, object_name: str
+) -> bool:
+    """Asyncio version of claim_marker."""
+    if await storage.create_object(container, object_name, _marker(CLAIM_PROCESSING)):
+        return True
+    try:
+        data, etag = await storage.download_with_etag(container, object_name)
+    except FileNotFoundError:
+        return await storage.create_object(
+            container, object_name, _marker(CLAIM_PROCESSING)
+        )
+    if not _expired(data):
+        return False
+    logging.warning(f"Taking over an expired claim on {container}/{object_name}")
+    return await storage.replace_object(
+        container, object_name, _marker(CLAIM_PROCESSING), etag
+    )
+
+
+def release_marker(storage: StorageBackend, container: str, object_name: str):
+    """Give up a claim without running its work, so it can be claimed again."""
+    storage.delete_object(container, object_name)
+
+
+def _settle_error(container: str, object_name: str, action: str, err: Exception):
+    logging.warning(
+        f"Could not {action} the claim on {container}/{object_name}: "
+        f"{type(err).__name__}: {err}"
+    )
+
+
+def _complete_markers(storage: StorageBackend, container: str, object_names):
+    for object_name in object_names:
+        try:
+            storage.put_object(container, object_name, _marker(CLAIM_DONE))
+        except Exception as err:
+            # The claim expires after the lease, and the work then runs again
+            _settle_error(container, object_name, "complete", err)
+
+
+def _release_markers(storage: StorageBackend, container: str, object_names):
+    for object_name in object_names:
+        try:
+            release_marker(storage, container, object_name)
+        except Exception as err:
+            # The retry takes the claim over once the lease expires
+            _settle_error(container, object_name, "release", err)
+
+
+async def _complete_markers_async(
+    storage: AsyncStorageBackend, container: str, object_names
+):
+    for object_name in object_names:
+        try:
+            await storage.put_object(container, object_name, _marker(CLAIM_DONE))
+        except Exception as err:
+            _settle_error(container, object_name, "complete", err)
+
+
+async def _release_markers_async(
+    storage: AsyncStorageBackend, container: str, object_names
+):
+    for object_name in object_names:
+        try:
+            await storage.delete_object(container, object_name)
+        except Exception as err:
+            _settle_error(container, object_name, "release", err)
+
+
+def run_claimed(
+    storage: StorageBackend,
+    container: str,
+    object_names: Iterable[str],
+    work: Callable[[], T],
+) -> T:
+    """Run the work claimed markers were taken for, then mark them done.
+
+    If work raises, the markers are released instead so that a retry can
+    claim them again, and the error is raised.
+    """
+    object_names = list(object_names)
+    try:
+        result = work()
+    except Exception:
+        _release_markers(storage, container, object_names)
+        raise
+    _complete_markers(storage, container, object_names)
+    return result
+
+
+async def run_claimed_async(
+    storage: StorageBackend,
+    container: str,
+    object_names: Iterable[str],
+    work: Callable[[], Awaitable[T]],
+) -> T:
+    """Asyncio version of run_claimed."""
+    object_names = list(object_names)
+    try:
+        result = await work()
+    except Exception:
+        await _release_markers_async(storage.to_async(), container, object_names)
+        raise
+    await _complete_markers_async(storage.to_async(), container, object_names)
+    return result
+
+
+@dataclass(frozen=True)
+class DeliveryClaim:
+    """A claimed delivery of a job blob, settled by submit_claimed."""
+
+    job_tag: str
+    file_name: str
+    fingerprint: str
+
+    @property
+    def object_name(self) -> str:
+        return (
+            f"{IDEMPOTENCY_PREFIX}/{self.job_tag}/{self.file_name}/{self.fingerprint}"
+        )
+
+
+def _claimed(claim: DeliveryClaim, written: bool) -> Optional[DeliveryClaim]:
+    ledger_stats.record(duplicate=not written)
+    if not written:
+        counts = ledger_stats.snapshot()
+        logging.warning(
+            f"{claim.job_tag} Duplicate delivery of {claim.file_name} suppressed "
+            f"({counts['duplicates']} of {counts['claimed'] + counts['duplicates']} "
+            "deliveries so far)"
+        )
+        return None
+    return claim
+
+
+def _ledger_error(claim: DeliveryClaim, err: Exception) -> DeliveryClaim:
+    # Without the ledger, process the delivery rather than risk dropping it
+    logging.warning(
+        f"{claim.job_tag} Could not write the idempotency marker: "
+        f"{type(err).__name__}: {err}"
+    )
+    return claim
+
+
+def claim_delivery(
+    storage: StorageBackend,
+    job_tag: str,
+    file_name: str,
+    fingerprint: str,
+) -> Optional[DeliveryClaim]:
+    """Claim a delivery; None if another invocation handled or is handling it.
+
+    The job of a returned claim must be submitted through submit_claimed.
+    """
+    claim = DeliveryClaim(job_tag, file_name, fingerprint)
+    try:
+        written = claim_marker(storage, IDEMPOTENCY_CONTAINER, claim.object_name)
+    except Exception as err:
+        return _ledger_error(claim, err)
+    return _claimed(claim, written)
+
+
+async def claim_delivery_async(
+    storage: StorageBackend,
+    job_tag: str,
+    file_name: str,
+    fingerprint: str,
+) -> Optional[DeliveryClaim]:
+    """Asyncio version of claim_delivery."""
+    claim = DeliveryClaim(job_tag, file_name, fingerprint)
+    try:
+        written = await claim_marker_async(
+            storage.to_async(), IDEMPOTENCY_CONTAINER, claim.object_name
+        )
+    except Exception as err:
+        return _ledger_error(claim, err)
+    return _claimed(claim, written)
+
+
+def submit_claimed(
+    storage: StorageBackend,
+    claims: Iterable[DeliveryClaim],
+    submit: Callable[[], T],
+) -> T:
+    """Run submit, which queues the claimed deliveries' jobs, then settle them.
+
+    The claims are marked done only if submit returns, so redeliveries are
+    suppressed; if it raises, they are all released for the retry.
+    """
+    return run_claimed(
+        storage,
+        IDEMPOTENCY_CONTAINER,
+        [claim.object_name for claim in claims],
+        submit,
+    )
+
+
+async def submit_claimed_async(
+    storage: StorageBackend,
+    claims: Iterable[DeliveryClaim],
+    submit: Callable[[], Awaitable[T]],
+) -> T:
+    """Asyncio version of submit_claimed."""
+    return await run_claimed_async(
+        storage,
+        IDEMPOTENCY_CONTAINER,
+        [claim.object_name for claim in claims],
+        submit,
+    )
+
+
+def release_delivery(storage: StorageBackend, claim: DeliveryClaim):
+    """Give up a claim whose job will not be submitted, e.g. as it failed."""
+    _release_markers(storage, IDEMPOTENCY_CONTAINER, [claim.object_name])
+
+
+async def release_delivery_async(storage: StorageBackend, claim: DeliveryClaim):
+    """Asyncio version of release_delivery."""
+    await _release_markers_async(
+        storage.to_async(), IDEMPOTENCY_CONTAINER, [claim.object_name]
+    )
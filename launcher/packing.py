@@ -0,0 +1,119 @@
+"""Pack several small jobs into one queue message.
+
+Small jobs spend more time waiting for a container than running in it, so
+compatible jobs (same type and queue) are sent as a single message:
+
+    {"job_type": "batch", "jobs": [<queue message>, ...], "max_run_time": ...}
+
+Each entry is the usual per-job queue message and each job keeps its own
+status file. Only messages owned by one invocation are packed together: the
+children of a sweep, or the jobs of an Event Grid batch or bulk submission.
+Jobs are never handed to another invocation to send, so a message can only
+be lost together with the invocation that owns its job, and the trigger's
+retry then submits it again.
+"""
+
+import logging
+import os
+from typing import Dict, List, Optional
+
+from .routing import classify_submission
+from .scheduler import FAST_CLASS, JobClass
+from .submission import DEFAULT_MAX_RUNTIME, JobSubmission
+
+BATCH_JOB_TYPE = "batch"
+
+DEFAULT_PACKING_MAX_JOBS = 8
+# Total max_run_time of the jobs in one batch. Without a runtime model, jobs
+# carry the fixed timeouts (2700 s for PDB2PQR, 7200 s for APBS), so this
+# still fits a full batch of PDB2PQR jobs, or three APBS jobs.
+DEFAULT_PACKING_MAX_RUNTIME = DEFAULT_PACKING_MAX_JOBS * 2700
+
+
+def packing_enabled() -> bool:
+    return os.getenv("JOB_PACKING", "").lower() in ("1", "true")
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning(f"Invalid {name} '{value}', using {default}")
+        return default
+
+
+def packing_max_jobs() -> int:
+    return max(1, _env_int("JOB_PACKING_MAX_JOBS", DEFAULT_PACKING_MAX_JOBS))
+
+
+def packing_max_runtime() -> int:
+    return _env_int("JOB_PACKING_MAX_RUNTIME", DEFAULT_PACKING_MAX_RUNTIME)
+
+
+def _runtime(message: dict) -> int:
+    return message.get("max_run_time") or DEFAULT_MAX_RUNTIME
+
+
+def pack_messages(messages: List[dict]) -> dict:
+    """The queue message for a batch; a single job is sent unchanged."""
+    if len(messages) == 1:
+        return messages[0]
+    return {
+        "job_type": BATCH_JOB_TYPE,
+        "jobs": messages,
+        # The jobs run one after the other
+        "max_run_time": sum(_runtime(message) for message in messages),
+    }
+
+
+def pack_batches(messages: List[dict], max_jobs: int, max_runtime: int) -> List[dict]:
+    """Pack messages that are all available now, without waiting for others."""
+    batches: List[List[dict]] = []
+    runtime = 0
+    for message in messages:
+        if (
+            not batches
+            or len(batches[-1]) >= max_jobs
+            or runtime + _runtime(message) > max_runtime
+        ):
+            batches.append([])
+            runtime = 0
+        batches[-1].append(message)
+        runtime += _runtime(message)
+    return [pack_messages(batch) for batch in batches]
+
+
+def is_packable(submission: JobSubmission) -> bool:
+    """Only jobs small enough for the fast class are worth packing."""
+    return classify_submission(submission) == FAST_CLASS
+
+
+def pack_child_messages(
+    submission: JobSubmission, job_class: Optional[JobClass]
+) -> List[dict]:
+    """The messages to send for the children of a split submission."""
+    messages = submission.child_messages
+    if not packing_enabled() or not is_packable(submission):
+        return messages
+    packed = pack_ready_messages(messages)
+    logging.info(
+        f"{submission.job_tag} Packed {len(messages)} subjobs into {len(packed)} messages"
+    )
+    return packed
+
+
+def pack_ready_messages(messages: List[dict]) -> List[dict]:
+    """Pack messages that are all at hand, keeping job types apart."""
+    max_jobs = packing_max_jobs()
+    max_runtime = packing_max_runtime()
+    by_type: Dict[str, List[dict]] = {}
+    for message in messages:
+        by_type.setdefault(message["job_type"], []).append(message)
+    return [
+        packed
+        for same_type in by_type.values()
+        for packed in pack_batches(same_type, max_jobs, max_runtime)
+    ]
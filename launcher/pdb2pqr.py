@@ -1,17 +1,28 @@
 """A class to interpret/prepare a PDB2PQR job submission for job queue."""
 
 from os.path import splitext
+from typing import List, Optional
 import logging
 
+from .input_store import input_store_enabled
 from .jobsetup import JobSetup
+from .runtime_estimator import JobFeatures
+from .storage import StorageBackend
+from .utils import AzureCopyObject, AzureCopyResult, copy_objects, copy_objects_async
 from .weboptions import WebOptions, WebOptionsError
 
 
 class PDB2PQRRunner(JobSetup):
     """Class to setup a PDB2PQR job."""
 
-    def __init__(self, form: dict, job_id: str, job_date: str):
-        super().__init__(job_id, job_date)
+    def __init__(
+        self,
+        form: dict,
+        job_id: str,
+        job_date: str,
+        storage: Optional[StorageBackend] = None,
+    ):
+        super().__init__(job_id, job_date, storage)
         self.weboptions = None
         self.invoke_method = "gui"  # Assumes web submission unless specified
         self.cli_params = None
@@ -54,18 +65,71 @@ class PDB2PQRRunner(JobSetup):
                 command_line_args = self.version_1_job(job_id)
 
                 # Copy all the sanitized files from the file queue
-                for payload in self.weboptions.files_copy_queue:
-                    logging.info(
-                        "%s Copying original object '%s' to sanitized object name '%s' (bucket: %s)",
-                        self.job_tag,
-                        payload.source_object,
-                        payload.dest_object,
-                        payload.source_container,
-                    )
-                    payload.copy_object()
+                results = copy_objects(
+                    self.job_tag, self._sanitize_copies(), storage=self.storage
+                )
+                self._raise_copy_errors(results)
+
+        elif self.invoke_method in ["cli", "v2"]:
+            command_line_args = self.version_2_job()
+        return self._set_command_line_args(command_line_args)
+
+    async def prepare_job_async(self, input_container_name: str = ""):
+        """Asyncio version of prepare_job."""
+        job_id = self.job_id
+        command_line_args = ""
+
+        if self.invoke_method in ["gui", "v1"]:
+            if self.weboptions is not None:
+                command_line_args = self.version_1_job(job_id)
+
+                # Copy all the sanitized files from the file queue
+                results = await copy_objects_async(
+                    self.job_tag,
+                    self._sanitize_copies(),
+                    storage=self.storage.to_async(),
+                )
+                self._raise_copy_errors(results)
 
         elif self.invoke_method in ["cli", "v2"]:
             command_line_args = self.version_2_job()
+        return self._set_command_line_args(command_line_args)
+
+    def runtime_features(self) -> JobFeatures:
+        """Size of the job, as known at submission, for the runtime estimator."""
+        ph_calc_method = ""
+        if self.weboptions is not None:
+            ph_calc_method = self.weboptions.runoptions.get("ph_calc_method", "")
+        elif self.cli_params is not None:
+            ph_calc_method = str(
+                self.cli_params["flags"].get("titration-state-method", "")
+            )
+        return JobFeatures("pdb2pqr", ph_calc_method=ph_calc_method)
+
+    def _sanitize_copies(self) -> List[AzureCopyObject]:
+        """The sanitizing copies to make now.
+
+        With the input store on, an uploaded input is written to the store
+        under its sanitized name instead, so it is not copied here.
+        """
+        payloads = self.weboptions.files_copy_queue
+        if not input_store_enabled():
+            return payloads
+        uploaded = set(self.uploaded_input_files())
+        copies = []
+        for payload in payloads:
+            if payload.dest_object in uploaded:
+                self.renamed_inputs[payload.dest_object] = payload.source_object
+            else:
+                copies.append(payload)
+        return copies
+
+    def _raise_copy_errors(self, results: List[AzureCopyResult]):
+        for result in results:
+            if result.error is not None:
+                raise result.error
+
+    def _set_command_line_args(self, command_line_args: str) -> str:
         self.command_line_args = command_line_args
         logging.debug(
             "%s Using command line arguments: %s",
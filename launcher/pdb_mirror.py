@@ -0,0 +1,212 @@
+"""Blob storage mirror of RCSB PDB entries used by ID-based PDB2PQR jobs.
+
+PDB2PQR jobs submitted with a PDB ID list
+'https://files.rcsb.org/download/{id}.pdb' as an input, which every worker
+downloads from RCSB on every run. With the mirror enabled, entries are kept
+under 'inputs/pdb-mirror/{ID}.pdb', each with a '{ID}.json' record of when
+it was fetched and last used. The record drives the TTL (older entries
+are refilled) and can drive LRU eviction, e.g. by a cleanup job or a
+lifecycle rule.
+
+At submission, a fresh entry replaces the URL input with an input_manifest
+reference to the mirrored object. A missing or stale entry leaves the URL in
+place and queues a fill message, which the PdbMirrorFill function handles.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+from time import time
+from typing import Optional, Protocol
+
+import requests
+
+from .job_queue import send_message
+from .jobsetup import JobSetup
+from .storage import StorageBackend
+
+RCSB_DOWNLOAD_URL = "https://files.rcsb.org/download/"
+PDB_MIRROR_PREFIX = "pdb-mirror"
+PDB_MIRROR_QUEUE = "pdbmirrorfill"
+
+DEFAULT_PDB_MIRROR_TTL = 30 * 24 * 3600
+# Don't rewrite an entry's record on every use
+LAST_USED_RESOLUTION = 3600
+FETCH_TIMEOUT = 30
+
+_rcsb_url = re.compile(re.escape(RCSB_DOWNLOAD_URL) + r"([0-9A-Za-z]{4})\.pdb$")
+
+
+def pdb_mirror_enabled() -> bool:
+    return os.getenv("PDB_MIRROR", "").lower() in ("1", "true")
+
+
+def mirror_ttl() -> int:
+    value = os.getenv("PDB_MIRROR_TTL")
+    if not value:
+        return DEFAULT_PDB_MIRROR_TTL
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning(
+            f"Invalid PDB_MIRROR_TTL '{value}', using {DEFAULT_PDB_MIRROR_TTL}"
+        )
+        return DEFAULT_PDB_MIRROR_TTL
+
+
+def rcsb_pdb_id(input_file: str) -> Optional[str]:
+    """The PDB ID of an RCSB download URL, or None for other inputs."""
+    match = _rcsb_url.match(input_file)
+    return match.group(1).upper() if match else None
+
+
+def mirror_object(pdb_id: str) -> str:
+    return f"{PDB_MIRROR_PREFIX}/{pdb_id}.pdb"
+
+
+def _record_object(pdb_id: str) -> str:
+    return f"{PDB_MIRROR_PREFIX}/{pdb_id}.json"
+
+
+class PdbFetcher(Protocol):
+    def fetch(self, pdb_id: str) -> bytes:
+        """Download the PDB file of an entry."""
+        ...
+
+
+class RcsbFetcher:
+    """Downloads entries from the RCSB file server."""
+
+    def __init__(self, base_url: str = RCSB_DOWNLOAD_URL):
+        self.base_url = base_url
+
+    def fetch(self, pdb_id: str) -> bytes:
+        response = requests.get(f"{self.base_url}{pdb_id}.pdb", timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+
+
+class LocalPdbFetcher:
+    """Reads entries from '{root}/{ID}.pdb', for tests and local development."""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def fetch(self, pdb_id: str) -> bytes:
+        return (self.root / f"{pdb_id}.pdb").read_bytes()
+
+
+_fetcher: Optional[PdbFetcher] = None
+_fetcher_lock = threading.Lock()
+
+
+def _create_fetcher() -> PdbFetcher:
+    fetcher = os.environ.get("PDB_FETCHER", "rcsb").lower()
+    if fetcher == "local":
+        root = os.environ.get("PDB_FETCHER_ROOT")
+        if not root:
+            raise ValueError("Missing PDB_FETCHER_ROOT environment variable")
+        return LocalPdbFetcher(root)
+    if fetcher != "rcsb":
+        raise ValueError(f"Unknown PDB_FETCHER: {fetcher}")
+    return RcsbFetcher()
+
+
+def get_pdb_fetcher() -> PdbFetcher:
+    """Return the process-wide PDB fetcher, creating it on first use."""
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = _create_fetcher()
+        return _fetcher
+
+
+def set_pdb_fetcher(fetcher: Optional[PdbFetcher]):
+    """Replace the process-wide PDB fetcher (None re-reads the settings)."""
+    global _fetcher
+    with _fetcher_lock:
+        _fetcher = fetcher
+
+
+def _read_record(
+    storage: StorageBackend, container: str, pdb_id: str
+) -> Optional[dict]:
+    try:
+        return storage.get_object_json(pdb_id, container, _record_object(pdb_id))
+    except Exception:
+        # Not mirrored yet
+        return None
+
+
+def _is_fresh(record: Optional[dict], now: float) -> bool:
+    return bool(record) and now - record.get("fetched", 0) < mirror_ttl()
+
+
+def schedule_fill(pdb_id: str):
+    try:
+        send_message(PDB_MIRROR_QUEUE, json.dumps({"pdb_id": pdb_id}))
+    except Exception as err:
+        # The job still runs, downloading from RCSB itself
+        logging.warning(
+            f"Could not schedule a mirror fill for {pdb_id}: {type(err).__name__}: {err}"
+        )
+
+
+def use_pdb_mirror(runner: JobSetup, container: str) -> int:
+    """Point RCSB URL inputs at mirrored copies, filling the mirror as needed.
+
+    :return: the number of inputs now read from the mirror
+    """
+    storage = runner.storage
+    now = time()
+    mirrored = 0
+    for index, input_file in enumerate(runner.input_files):
+        pdb_id = rcsb_pdb_id(input_file)
+        if pdb_id is None:
+            continue
+        record = _read_record(storage, container, pdb_id)
+        if not _is_fresh(record, now):
+            logging.info(f"{runner.job_tag} {pdb_id} not mirrored, scheduling a fill")
+            schedule_fill(pdb_id)
+            continue
+        # Same file name as the download, so the command line is unchanged
+        object_name = f"{runner.job_tag}/{input_file.rsplit('/', 1)[1]}"
+        runner.input_files[index] = object_name
+        runner.input_manifest[object_name] = {
+            "container": container,
+            "object": mirror_object(pdb_id),
+        }
+        mirrored += 1
+        if now - record.get("last_used", 0) > LAST_USED_RESOLUTION:
+            record["last_used"] = now
+            storage.put_object(container, _record_object(pdb_id), json.dumps(record))
+        logging.info(f"{runner.job_tag} {pdb_id} read from the PDB mirror")
+    return mirrored
+
+
+def fill_pdb_mirror(
+    storage: StorageBackend,
+    container: str,
+    pdb_id: str,
+    fetcher: Optional[PdbFetcher] = None,
+) -> bool:
+    """Fetch an entry into the mirror unless a fresh copy is already there.
+
+    :return: True if the entry was fetched
+    """
+    pdb_id = pdb_id.upper()
+    now = time()
+    if _is_fresh(_read_record(storage, container, pdb_id), now):
+        return False
+    if fetcher is None:
+        fetcher = get_pdb_fetcher()
+    contents = fetcher.fetch(pdb_id)
+    storage.put_object(container, mirror_object(pdb_id), contents)
+    # The record goes last, so a fresh record always has its file
+    record = {"fetched": now, "last_used": now, "size": len(contents)}
+    storage.put_object(container, _record_object(pdb_id), json.dumps(record))
+    logging.info(f"Mirrored {pdb_id} ({len(contents)} bytes)")
+    return True
@@ -0,0 +1,229 @@
+"""PDB2PQR -> APBS pipelines, chained without a round trip through the client.
+
+A pipeline is submitted as 'inputs/{date}/{job_id}/pipeline-job.json' with:
+
+    {"form": {"pdb2pqr": <PDB2PQR web form>, "apbs": <APBS form>}}
+
+The PDB2PQR stage is queued straight away, as a normal PDB2PQR job (or
+completed from the result cache, if enabled), and the APBS stage is saved
+to 'inputs/{date}/{job_id}/pipeline.json'. When the PDB2PQR status
+becomes complete, the status blob trigger prepares
+the APBS stage from that declaration under the same job ID, exactly as if
+the browser had submitted 'apbs-job.json'.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+from .apbs import APBSRunner
+from .ledger import claim_marker, release_marker, run_claimed
+from .result_cache import result_cache_enabled, use_cached_result
+from .storage import StorageBackend, get_storage
+from .submission import (
+    INPUT_CONTAINER,
+    OUTPUT_CONTAINER,
+    JobSubmission,
+    prepare_submission,
+    prepare_submission_async,
+)
+from .weboptions import WebOptionsError
+
+PIPELINE_JOB_TYPE = "pipeline"
+PIPELINE_OBJECT = "pipeline.json"
+# Claimed while the APBS stage of a pipeline is queued, and done after
+STAGE_MARKER = "apbs-stage-queued"
+
+FIRST_STAGE = "pdb2pqr"
+SECOND_STAGE = "apbs"
+
+
+def pipelines_enabled() -> bool:
+    return os.getenv("PIPELINE_JOBS", "").lower() in ("1", "true")
+
+
+class PipelineError(ValueError):
+    """The pipeline description in the form is not valid."""
+
+
+def _parse_pipeline(
+    form: dict, job_id: str, job_date: str, storage: StorageBackend
+) -> Tuple[dict, dict]:
+    try:
+        pdb2pqr_form = dict(form[FIRST_STAGE])
+        apbs_form = dict(form[SECOND_STAGE])
+    except (KeyError, TypeError, ValueError):
+        raise PipelineError("A pipeline needs a pdb2pqr form and an apbs form")
+    if "filename" in apbs_form:
+        raise PipelineError("The APBS stage needs a form, not an input file")
+    # The APBS stage reads the input file PDB2PQR writes for it
+    pdb2pqr_form["INPUT"] = "on"
+    apbs_form["pdb2pqrid"] = job_id
+    try:
+        # Check the APBS form now rather than after PDB2PQR has run
+        APBSRunner(dict(apbs_form), job_id, job_date, storage)
+    except (KeyError, ValueError) as err:
+        raise PipelineError(f"Invalid APBS form: {err}")
+    return pdb2pqr_form, apbs_form
+
+
+def _invalid(submission: JobSubmission, message: str) -> JobSubmission:
+    logging.error(f"{submission.job_tag} Invalid pipeline: {message}")
+    submission.status = "invalid"
+    submission.message = message
+    return submission
+
+
+def _declare_stage(
+    storage: StorageBackend, submission: JobSubmission, apbs_form: dict
+) -> Dict[str, Tuple[str, str]]:
+    """Save the APBS stage and a pending status for it.
+
+    :return: the objects to write, by container and object name
+    """
+    stage = JobSubmission(submission.job_id, submission.job_date, SECOND_STAGE)
+    return {
+        INPUT_CONTAINER: (
+            f"{submission.job_tag}/{PIPELINE_OBJECT}",
+            json.dumps({"stages": [FIRST_STAGE, SECOND_STAGE], "form": apbs_form}),
+        ),
+        OUTPUT_CONTAINER: (stage.status_object, json.dumps(stage.status_dict())),
+    }
+
+
+def prepare_pipeline(
+    form: dict,
+    job_id: str,
+    job_date: str,
+    storage: Optional[StorageBackend] = None,
+) -> JobSubmission:
+    """Prepare the PDB2PQR stage and save the APBS stage for later."""
+    if storage is None:
+        storage = get_storage()
+    try:
+        pdb2pqr_form, apbs_form = _parse_pipeline(form, job_id, job_date, storage)
+        submission = prepare_submission(
+            FIRST_STAGE, pdb2pqr_form, job_id, job_date, storage
+        )
+    except (PipelineError, WebOptionsError) as err:
+        return _invalid(JobSubmission(job_id, job_date, FIRST_STAGE), str(err))
+    if submission.should_queue and result_cache_enabled():
+        use_cached_result(storage, submission)
+    if submission.should_queue or submission.cached_from:
+        for container, (object_name, contents) in _declare_stage(
+            storage, submission, apbs_form
+        ).items():
+            storage.put_object(container, object_name, contents)
+        logging.info(f"{submission.job_tag} APBS stage waits for PDB2PQR")
+    return submission
+
+
+async def prepare_pipeline_async(
+    form: dict,
+    job_id: str,
+    job_date: str,
+    storage: Optional[StorageBackend] = None,
+) -> JobSubmission:
+    """Asyncio version of prepare_pipeline."""
+    if storage is None:
+        storage = get_storage()
+    try:
+        pdb2pqr_form, apbs_form = _parse_pipeline(form, job_id, job_date, storage)
+        submission = await prepare_submission_async(
+            FIRST_STAGE, pdb2pqr_form, job_id, job_date, storage
+        )
+    except (PipelineError, WebOptionsError) as err:
+        return _invalid(JobSubmission(job_id, job_date, FIRST_STAGE), str(err))
+    if submission.should_queue and result_cache_enabled():
+        await asyncio.to_thread(use_cached_result, storage, submission)
+    if submission.should_queue or submission.cached_from:
+        async_storage = storage.to_async()
+        await asyncio.gather(
+            *(
+                async_storage.put_object(container, object_name, contents)
+                for container, (object_name, contents) in _declare_stage(
+                    storage, submission, apbs_form
+                ).items()
+            )
+        )
+        logging.info(f"{submission.job_tag} APBS stage waits for PDB2PQR")
+    return submission
+
+
+def parse_status_blob_name(name: str) -> Optional[Tuple[str, str, str]]:
+    """Split 'outputs/{date}/{job_id}/{job_type}-status.json'.
+
+    :return: the job date, job ID and job type; None for any other blob,
+             like the status of a subjob, '{date}/{job_id}/{subjob}/...'
+    """
+    split = name.split("/")
+    if split[0] == OUTPUT_CONTAINER:
+        split = split[1:]
+    if len(split) != 3 or not split[2].endswith("-status.json"):
+        return None
+    date, job_id, file_name = split
+    return date, job_id, file_name[: -len("-status.json")]
+
+
+def _read_json(
+    storage: StorageBackend, tag: str, container: str, object_name: str
+) -> Optional[dict]:
+    try:
+        return storage.get_object_json(tag, container, object_name)
+    except Exception:
+        # Not written (yet)
+        return None
+
+
+def advance_pipeline(
+    storage: StorageBackend, job_id: str, job_date: str
+) -> Optional[JobSubmission]:
+    """Prepare the APBS stage once the PDB2PQR stage of a pipeline is complete.
+
+    The caller must write the status of a returned stage and queue it
+    through run_stage.
+
+    :return: the APBS submission to upload and dispatch, only for the first
+             caller after PDB2PQR completes; None otherwise
+    """
+    job_tag = f"{job_date}/{job_id}"
+    status = _read_json(
+        storage, job_tag, OUTPUT_CONTAINER, f"{job_tag}/{FIRST_STAGE}-status.json"
+    )
+    state = ((status or {}).get(FIRST_STAGE) or {}).get("status")
+    if state not in ("complete", "failed"):
+        return None
+    pipeline = _read_json(
+        storage, job_tag, INPUT_CONTAINER, f"{job_tag}/{PIPELINE_OBJECT}"
+    )
+    if pipeline is None:
+        # A plain PDB2PQR job
+        return None
+    # Status blobs can be written more than once; only advance one time
+    if not claim_marker(storage, OUTPUT_CONTAINER, f"{job_tag}/{STAGE_MARKER}"):
+        return None
+
+    if state == "failed":
+        logging.info(f"{job_tag} PDB2PQR stage failed, not running APBS")
+        return JobSubmission(job_id, job_date, SECOND_STAGE, status="failed")
+    logging.info(f"{job_tag} PDB2PQR stage complete, preparing APBS")
+    try:
+        return prepare_submission(
+            SECOND_STAGE, pipeline["form"], job_id, job_date, storage
+        )
+    except Exception:
+        # Let the retry of the status event advance the pipeline again
+        release_marker(storage, OUTPUT_CONTAINER, f"{job_tag}/{STAGE_MARKER}")
+        raise
+
+
+def run_stage(storage: StorageBackend, job_tag: str, submit: Callable[[], None]):
+    """Queue the APBS stage from advance_pipeline with submit.
+
+    The stage is only recorded as queued, so never queued again, once
+    submit returns; if it raises, the retry of the status event can advance
+    the pipeline again.
+    """
+    run_claimed(storage, OUTPUT_CONTAINER, [f"{job_tag}/{STAGE_MARKER}"], submit)
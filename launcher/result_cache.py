@@ -0,0 +1,214 @@
+"""Reuse the outputs of identical PDB2PQR jobs instead of running them again.
+
+A job's cache key is a hash of its PDB2PQR command line, with the job ID
+taken out, and of the contents of each input file (URL inputs, i.e. RCSB
+entries, are hashed by URL), and of RESULT_CACHE_VERSION, so that results
+from an older PDB2PQR image are not reused once the setting is changed.
+Completed jobs are recorded under 'outputs/pdb2pqr-cache/{key}.json'. When a
+new submission has the same key and the entry is younger than
+RESULT_CACHE_TTL, the recorded outputs are copied into the new job and its
+status is written as complete without queueing anything. An expired entry
+is replaced by the next job to complete with that key.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+from time import time
+from typing import List
+
+from urllib3.util import parse_url
+
+from .storage import StorageBackend
+from .submission import INPUT_CONTAINER, OUTPUT_CONTAINER, JobSubmission
+
+RESULT_CACHE_PREFIX = "pdb2pqr-cache"
+# Stands in for the job ID in normalized command lines
+JOB_ID_PLACEHOLDER = "{job_id}"
+
+DEFAULT_RESULT_CACHE_TTL = 30 * 24 * 3600
+
+
+def result_cache_enabled() -> bool:
+    return os.getenv("PDB2PQR_RESULT_CACHE", "").lower() in ("1", "true")
+
+
+def result_cache_version() -> str:
+    return os.getenv("RESULT_CACHE_VERSION", "")
+
+
+def result_cache_ttl() -> int:
+    value = os.getenv("RESULT_CACHE_TTL")
+    if not value:
+        return DEFAULT_RESULT_CACHE_TTL
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning(
+            f"Invalid RESULT_CACHE_TTL '{value}', using {DEFAULT_RESULT_CACHE_TTL}"
+        )
+        return DEFAULT_RESULT_CACHE_TTL
+
+
+def normalize_command_line(command_line: str, job_id: str) -> str:
+    """The command line with whitespace collapsed and the job ID removed."""
+    # Only file names made from the job ID, e.g. '{job_id}.pqr'
+    job_file = re.compile(rf"(?<![\w.-]){re.escape(job_id)}(?=\.)")
+    return " ".join(
+        job_file.sub(JOB_ID_PLACEHOLDER, arg) for arg in command_line.split()
+    )
+
+
+def _input_digest(
+    storage: StorageBackend, submission: JobSubmission, input_file: str
+) -> str:
+    if parse_url(input_file).scheme is not None:
+        return hashlib.sha256(input_file.encode("utf-8")).hexdigest()
+    source = submission.input_manifest.get(input_file, {})
+    # Already known if the input went through the input store
+    content_digest = source.get("sha256")
+    if content_digest is None:
+        digest = hashlib.sha256()
+        for chunk in storage.iter_chunks(
+            source.get("container", INPUT_CONTAINER), source.get("object", input_file)
+        ):
+            digest.update(chunk)
+        content_digest = digest.hexdigest()
+    # Name relative to the job, so the same upload to another job matches
+    return f"{input_file[len(submission.job_tag) + 1:]}:{content_digest}"
+
+
+def cache_key(storage: StorageBackend, submission: JobSubmission) -> str:
+    key = hashlib.sha256()
+    key.update(result_cache_version().encode("utf-8"))
+    key.update(b"\0")
+    key.update(
+        normalize_command_line(submission.command_line_args, submission.job_id).encode(
+            "utf-8"
+        )
+    )
+    for input_file in sorted(submission.input_files):
+        key.update(b"\0")
+        key.update(_input_digest(storage, submission, input_file).encode())
+    return key.hexdigest()
+
+
+def _entry_object(key: str) -> str:
+    return f"{RESULT_CACHE_PREFIX}/{key}.json"
+
+
+def _is_fresh(entry: dict, now: float) -> bool:
+    return now - entry.get("created", 0) < result_cache_ttl()
+
+
+def _renamed(object_name: str, source_tag: str, job_tag: str) -> str:
+    source_id = source_tag.split("/", 1)[1]
+    job_id = job_tag.split("/", 1)[1]
+    file_name = object_name[len(source_tag) + 1 :].replace(source_id, job_id)
+    return f"{job_tag}/{file_name}"
+
+
+def _copy_outputs(
+    storage: StorageBackend, source_tag: str, job_tag: str, output_files: List[str]
+) -> List[str]:
+    source_id = source_tag.split("/", 1)[1]
+    job_id = job_tag.split("/", 1)[1]
+    copied = []
+    for output_file in output_files:
+        dest = _renamed(output_file, source_tag, job_tag)
+        if output_file.endswith(".in"):
+            # The APBS input file names the PQR file, which was renamed
+            contents = storage.download_file_str(OUTPUT_CONTAINER, output_file)
+            storage.put_object(
+                OUTPUT_CONTAINER, dest, contents.replace(source_id, job_id)
+            )
+        else:
+            storage.copy_object(OUTPUT_CONTAINER, output_file, dest)
+        copied.append(dest)
+    return copied
+
+
+def use_cached_result(storage: StorageBackend, submission: JobSubmission) -> bool:
+    """Complete a PDB2PQR submission from the cache if an identical job ran.
+
+    Otherwise, the submission's cache key is set so that its result can be
+    recorded once it completes.
+
+    :return: True if the submission was completed from the cache
+    """
+    try:
+        submission.cache_key = cache_key(storage, submission)
+        entry = storage.get_object_json(
+            submission.job_tag, OUTPUT_CONTAINER, _entry_object(submission.cache_key)
+        )
+    except Exception as err:
+        # Missing entries and unreadable inputs both mean running the job
+        logging.info(f"{submission.job_tag} No cached result: {type(err).__name__}")
+        return False
+    if not entry:
+        return False
+    if not _is_fresh(entry, time()):
+        logging.info(f"{submission.job_tag} Cached result has expired")
+        return False
+    try:
+        output_files = _copy_outputs(
+            storage, entry["job_tag"], submission.job_tag, entry["output_files"]
+        )
+    except Exception as err:
+        logging.warning(
+            f"{submission.job_tag} Could not copy cached result from "
+            f"{entry.get('job_tag')}: {type(err).__name__}: {err}"
+        )
+        return False
+    submission.status = "complete"
+    submission.output_files = output_files
+    submission.cached_from = entry["job_tag"]
+    logging.info(f"{submission.job_tag} Completed from the cache of {entry['job_tag']}")
+    return True
+
+
+def record_result(storage: StorageBackend, job_tag: str, job_type: str) -> bool:
+    """Add a completed job with a cache key to the cache.
+
+    :return: True if a new cache entry was written
+    """
+    try:
+        status = storage.get_object_json(
+            job_tag, OUTPUT_CONTAINER, f"{job_tag}/{job_type}-status.json"
+        )
+    except Exception:
+        return False
+    job_status = status.get(job_type) or {}
+    key = (status.get("metadata") or {}).get("resultCacheKey")
+    if job_status.get("status") != "complete" or not key:
+        return False
+    if (status.get("metadata") or {}).get("cachedFrom"):
+        # Already an entry for this result
+        return False
+    now = time()
+    entry = {
+        "job_tag": job_tag,
+        "output_files": job_status.get("outputFiles") or [],
+        "versions": (status.get("metadata") or {}).get("versions") or {},
+        "created": now,
+    }
+    body = json.dumps(entry)
+    # The first job to finish with a key keeps the entry until it expires
+    written = storage.create_object(OUTPUT_CONTAINER, _entry_object(key), body)
+    if not written:
+        try:
+            data, etag = storage.download_with_etag(
+                OUTPUT_CONTAINER, _entry_object(key)
+            )
+        except FileNotFoundError:
+            return False
+        if _is_fresh(json.loads(data), now):
+            return False
+        written = storage.replace_object(
+            OUTPUT_CONTAINER, _entry_object(key), body, etag
+        )
+    if written:
+        logging.info(f"{job_tag} Result cached as {key}")
+    return written
@@ -0,0 +1,99 @@
+"""Send each job to the queue of its size class.
+
+Short jobs go to a fast queue with its own container job, so they are not
+stuck behind long APBS solves on the main queue.
+"""
+
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+import azure.functions as func
+
+from .claim_check import encode_message, encode_message_async
+from .job_queue import BACKEND_QUEUE, send_message
+from .scheduler import FAST_CLASS, SLOW_CLASS, JobClass, get_job_classes
+from .submission import DEFAULT_MAX_RUNTIME, JobSubmission
+
+# Jobs expected to finish within this many seconds count as fast
+DEFAULT_FAST_MAX_RUNTIME = 900
+# Larger APBS grids are always slow (65 x 65 x 65)
+DEFAULT_FAST_MAX_GRID_POINTS = 65**3
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning(f"Invalid {name} '{value}', using {default}")
+        return default
+
+
+def classify_submission(submission: JobSubmission) -> str:
+    """Size class of a job, from its type, grid size and estimated runtime."""
+    features = submission.runtime_features
+    if features is None:
+        return SLOW_CLASS
+    if features.processors > 1:
+        return SLOW_CLASS
+    max_grid_points = _env_int("FAST_JOB_MAX_GRID_POINTS", DEFAULT_FAST_MAX_GRID_POINTS)
+    if features.grid_points > max_grid_points:
+        return SLOW_CLASS
+    if submission.runtime_estimated:
+        max_runtime = _env_int("FAST_JOB_MAX_RUNTIME", DEFAULT_FAST_MAX_RUNTIME)
+        timeout = submission.timeout_seconds or DEFAULT_MAX_RUNTIME
+        return FAST_CLASS if timeout <= max_runtime else SLOW_CLASS
+    # Without a runtime model, fall back on what is known to be quick
+    if features.job_type == "pdb2pqr":
+        return FAST_CLASS
+    if features.job_type == "apbs" and features.grid_points > 0:
+        return FAST_CLASS
+    return SLOW_CLASS
+
+
+def route_submission(submission: JobSubmission) -> Optional[JobClass]:
+    """The job class to queue the submission on, or None if not routing."""
+    job_classes = get_job_classes()
+    if FAST_CLASS not in job_classes:
+        return None
+    job_class = job_classes[classify_submission(submission)]
+    logging.info(f"{submission.job_tag} Routing job to the {job_class.name} queue")
+    return job_class
+
+
+def _send_bodies(msg: func.Out[str], bodies: List[str], job_class: Optional[JobClass]):
+    if job_class is None or job_class.queue_name == BACKEND_QUEUE:
+        # The binding takes a list to write several messages
+        msg.set(bodies[0] if len(bodies) == 1 else bodies)
+        logging.info(f"{len(bodies)} message(s) sent to queue")
+    else:
+        for body in bodies:
+            send_message(job_class.queue_name, body)
+
+
+def enqueue_messages(
+    msg: func.Out[str], queue_messages: List[dict], job_class: Optional[JobClass]
+):
+    """Queue messages through the binding, or directly for another queue."""
+    _send_bodies(
+        msg, [encode_message(message) for message in queue_messages], job_class
+    )
+
+
+async def enqueue_messages_async(
+    msg: func.Out[str], queue_messages: List[dict], job_class: Optional[JobClass]
+):
+    """Asyncio version of enqueue_messages."""
+    bodies = list(
+        await asyncio.gather(
+            *(encode_message_async(message) for message in queue_messages)
+        )
+    )
+    if job_class is None or job_class.queue_name == BACKEND_QUEUE:
+        _send_bodies(msg, bodies, job_class)
+    else:
+        await asyncio.to_thread(_send_bodies, msg, bodies, job_class)
@@ -0,0 +1,355 @@
+"""Predict how long a job will run, to set max_run_time from its size.
+
+The model is a least-squares fit of log(duration) against features of the
+job that are known when it is submitted (grid size, calculation type,
+processor count, atom count, pH method). It is fitted from a history of
+completed jobs and stored as a JSON blob; until one exists, the runners'
+fixed estimates are used.
+"""
+
+import json
+import logging
+import math
+import os
+import threading
+from dataclasses import asdict, dataclass, field
+from time import monotonic, time
+from typing import Dict, Iterable, List, Optional
+
+from .storage import StorageBackend
+
+RUNTIME_MODEL_CONTAINER = "outputs"
+RUNTIME_MODEL_OBJECT = "runtime-estimator/model.json"
+# One JSON record per line: {"features": {...}, "duration": seconds, "job": tag}
+RUNTIME_HISTORY_OBJECT = "runtime-estimator/history.jsonl"
+# Only the most recent records are kept, so the blob stays cheap to rewrite
+MAX_HISTORY_RECORDS = 5000
+# Attempts at the conditional append before giving up on a record
+HISTORY_APPEND_ATTEMPTS = 5
+# Job types whose status records one container's runtime
+RECORDED_JOB_TYPES = ("apbs", "pdb2pqr")
+
+MIN_RUNTIME = 60
+MAX_RUNTIME = 24 * 60 * 60
+DEFAULT_SAFETY_FACTOR = 1.5
+# Standard deviations of log runtime added on top of the prediction
+UPPER_BOUND_SIGMAS = 2.0
+# Fewer completed jobs than this and the fit is not trusted
+MIN_SAMPLES = 20
+RIDGE = 1e-3
+MODEL_TTL = 300.0
+
+# Average bytes per ATOM/HETATM record, used when only the file size is known
+PQR_BYTES_PER_ATOM = 80
+
+
+@dataclass
+class JobFeatures:
+    job_type: str
+    calc_type: str = ""
+    grid_points: int = 0
+    processors: int = 1
+    atom_count: int = 0
+    ph_calc_method: str = ""
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "JobFeatures":
+        known = {name: data[name] for name in cls.__dataclass_fields__ if name in data}
+        return cls(**known)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def vector(self) -> Dict[str, float]:
+        """Regression inputs; categorical features are one-hot encoded."""
+        values = {
+            "bias": 1.0,
+            "log_grid_points": math.log1p(max(0, self.grid_points)),
+            "log_atom_count": math.log1p(max(0, self.atom_count)),
+            "log_processors": math.log(max(1, self.processors)),
+            f"job_type={self.job_type}": 1.0,
+        }
+        if self.calc_type:
+            values[f"calc_type={self.calc_type}"] = 1.0
+        if self.ph_calc_method:
+            values[f"ph_calc_method={self.ph_calc_method}"] = 1.0
+        return values
+
+
+@dataclass
+class RuntimeModel:
+    weights: Dict[str, float]
+    # Standard deviation of the residuals of log(duration)
+    residual_std: float = 0.0
+    samples: int = 0
+    fitted_at: float = field(default_factory=time)
+
+    def covers(self, features: JobFeatures) -> bool:
+        """Whether the history behind the model included this job type."""
+        return f"job_type={features.job_type}" in self.weights
+
+    def predict_seconds(self, features: JobFeatures) -> float:
+        """Typical runtime; features not seen during the fit are ignored."""
+        log_runtime = sum(
+            self.weights.get(name, 0.0) * value
+            for name, value in features.vector().items()
+        )
+        return math.exp(log_runtime)
+
+    def max_runtime(
+        self, features: JobFeatures, safety_factor: float = DEFAULT_SAFETY_FACTOR
+    ) -> int:
+        upper = self.predict_seconds(features) * math.exp(
+            UPPER_BOUND_SIGMAS * self.residual_std
+        )
+        return int(min(MAX_RUNTIME, max(MIN_RUNTIME, upper * safety_factor)))
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "RuntimeModel":
+        return cls(
+            weights={name: float(w) for name, w in data["weights"].items()},
+            residual_std=float(data.get("residual_std", 0.0)),
+            samples=int(data.get("samples", 0)),
+            fitted_at=float(data.get("fitted_at", 0.0)),
+        )
+
+
+def _solve(matrix: List[List[float]], rhs: List[float]) -> List[float]:
+    """Gaussian elimination with partial pivoting."""
+    size = len(rhs)
+    rows = [row[:] + [value] for row, value in zip(matrix, rhs)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            raise ValueError("Runtime history is degenerate, cannot fit")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for row in range(col + 1, size):
+            factor = rows[row][col] / rows[col][col]
+            if factor:
+                for k in range(col, size + 1):
+                    rows[row][k] -= factor * rows[col][k]
+    solution = [0.0] * size
+    for row in range(size - 1, -1, -1):
+        total = rows[row][size] - sum(
+            rows[row][k] * solution[k] for k in range(row + 1, size)
+        )
+        solution[row] = total / rows[row][row]
+    return solution
+
+
+def fit_runtime_model(
+    records: Iterable[dict], min_samples: int = MIN_SAMPLES
+) -> Optional[RuntimeModel]:
+    """Fit a model from {"features": {...}, "duration": seconds} records.
+
+    :return: the model, or None if there are too few usable records
+    """
+    vectors: List[Dict[str, float]] = []
+    targets: List[float] = []
+    for record in records:
+        try:
+            duration = float(record["duration"])
+            features = JobFeatures.from_dict(record["features"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if duration <= 0:
+            continue
+        vectors.append(features.vector())
+        targets.append(math.log(duration))
+
+    if len(targets) < min_samples:
+        logging.info(
+            f"Only {len(targets)} usable runtime records, need {min_samples} to fit"
+        )
+        return None
+
+    names = sorted({name for vector in vectors for name in vector})
+    index = {name: i for i, name in enumerate(names)}
+    size = len(names)
+    normal = [[0.0] * size for _ in range(size)]
+    moments = [0.0] * size
+    for vector, target in zip(vectors, targets):
+        items = [(index[name], value) for name, value in vector.items()]
+        for i, x_i in items:
+            moments[i] += x_i * target
+            for j, x_j in items:
+                normal[i][j] += x_i * x_j
+    # A small ridge term keeps rarely seen categories from blowing up
+    for i, name in enumerate(names):
+        if name != "bias":
+            normal[i][i] += RIDGE * len(targets)
+
+    weights = dict(zip(names, _solve(normal, moments)))
+    residuals = [
+        target - sum(weights[name] * value for name, value in vector.items())
+        for vector, target in zip(vectors, targets)
+    ]
+    residual_std = math.sqrt(sum(r * r for r in residuals) / len(residuals))
+    logging.info(
+        f"Fitted runtime model on {len(targets)} jobs "
+        f"(residual std of log runtime: {residual_std:.3f})"
+    )
+    return RuntimeModel(weights, residual_std, len(targets))
+
+
+def history_record(status: dict) -> Optional[dict]:
+    """Turn the status file of a finished job into a history record.
+
+    Needs the features saved in the status metadata at submission time.
+    Only APBS and PDB2PQR jobs run in a single container, so only theirs
+    are recorded.
+    """
+    job_type = status.get("jobtype")
+    if job_type not in RECORDED_JOB_TYPES:
+        return None
+    features = status.get("metadata", {}).get("runtimeFeatures")
+    job_status = status.get(job_type) or {}
+    if not features or job_status.get("status") != "complete":
+        return None
+    start, end = job_status.get("startTime"), job_status.get("endTime")
+    if start is None or end is None:
+        return None
+    return {"features": features, "duration": float(end) - float(start)}
+
+
+def runtime_refit_enabled() -> bool:
+    return os.getenv("RUNTIME_MODEL_REFIT", "").lower() in ("1", "true")
+
+
+def _append_history(storage: StorageBackend, record: dict) -> bool:
+    line = json.dumps(record)
+    for _ in range(HISTORY_APPEND_ATTEMPTS):
+        try:
+            data, etag = storage.download_with_etag(
+                RUNTIME_MODEL_CONTAINER, RUNTIME_HISTORY_OBJECT
+            )
+        except FileNotFoundError:
+            if storage.create_object(
+                RUNTIME_MODEL_CONTAINER, RUNTIME_HISTORY_OBJECT, line + "\n"
+            ):
+                return True
+            continue
+        lines = data.decode("utf-8").splitlines()
+        if any(f'"job": "{record["job"]}"' in existing for existing in lines):
+            # Already recorded, e.g. from a redelivered status event
+            return False
+        lines = lines[-(MAX_HISTORY_RECORDS - 1) :] + [line]
+        # Conditional, as every completing job appends to the same blob
+        if storage.replace_object(
+            RUNTIME_MODEL_CONTAINER,
+            RUNTIME_HISTORY_OBJECT,
+            "\n".join(lines) + "\n",
+            etag,
+        ):
+            return True
+    logging.warning(f"{record['job']} Could not append to the runtime history")
+    return False
+
+
+def record_runtime(storage: StorageBackend, job_tag: str, job_type: str) -> bool:
+    """Add a completed job to the history the runtime model is fitted on.
+
+    :return: True if a record was appended
+    """
+    if job_type not in RECORDED_JOB_TYPES:
+        return False
+    try:
+        status = storage.get_object_json(
+            job_tag, RUNTIME_MODEL_CONTAINER, f"{job_tag}/{job_type}-status.json"
+        )
+    except Exception:
+        return False
+    record = history_record(status)
+    if record is None:
+        return False
+    record["job"] = f"{job_tag}/{job_type}"
+    appended = _append_history(storage, record)
+    if appended:
+        logging.info(f"{job_tag} Recorded a runtime of {record['duration']:.0f}s")
+    return appended
+
+
+def _get_safety_factor() -> float:
+    value = os.getenv("RUNTIME_SAFETY_FACTOR")
+    if not value:
+        return DEFAULT_SAFETY_FACTOR
+    try:
+        return max(1.0, float(value))
+    except ValueError:
+        logging.warning(
+            f"Invalid RUNTIME_SAFETY_FACTOR '{value}', using {DEFAULT_SAFETY_FACTOR}"
+        )
+        return DEFAULT_SAFETY_FACTOR
+
+
+# The fitted model is shared by every invocation and re-read now and then
+_model_lock = threading.Lock()
+_model: Optional[RuntimeModel] = None
+_model_loaded_at: Optional[float] = None
+
+
+def load_runtime_model(storage: StorageBackend) -> Optional[RuntimeModel]:
+    try:
+        text = storage.download_file_str(RUNTIME_MODEL_CONTAINER, RUNTIME_MODEL_OBJECT)
+        return RuntimeModel.from_dict(json.loads(text))
+    except Exception as err:
+        logging.info(
+            f"No runtime model available, using fixed estimates: "
+            f"{type(err).__name__}: {err}"
+        )
+        return None
+
+
+def get_runtime_model(storage: StorageBackend) -> Optional[RuntimeModel]:
+    global _model, _model_loaded_at
+    with _model_lock:
+        now = monotonic()
+        if _model_loaded_at is None or now - _model_loaded_at > MODEL_TTL:
+            _model = load_runtime_model(storage)
+            _model_loaded_at = now
+        return _model
+
+
+def set_runtime_model(model: Optional[RuntimeModel]):
+    """Use a model directly; None makes the next lookup reload it."""
+    global _model, _model_loaded_at
+    with _model_lock:
+        _model = model
+        _model_loaded_at = monotonic() if model is not None else None
+
+
+def estimate_max_runtime(
+    features: Optional[JobFeatures],
+    default: int,
+    model: Optional[RuntimeModel],
+) -> int:
+    """max_run_time for a job, falling back to default without a model."""
+    if model is None or features is None or not model.covers(features):
+        return default
+    return model.max_runtime(features, _get_safety_factor())
+
+
+def refit_runtime_model(storage: StorageBackend) -> Optional[RuntimeModel]:
+    """Fit a model from the history blob and store it for the triggers."""
+    text = storage.download_file_str(RUNTIME_MODEL_CONTAINER, RUNTIME_HISTORY_OBJECT)
+    records = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            logging.warning(f"Skipping unreadable runtime record: {line[:100]}")
+    model = fit_runtime_model(records)
+    if model is not None:
+        storage.put_object(
+            RUNTIME_MODEL_CONTAINER,
+            RUNTIME_MODEL_OBJECT,
+            json.dumps(model.to_dict()),
+        )
+        set_runtime_model(model)
+    return model
@@ -0,0 +1,333 @@
+"""Coalesce container job start requests into as few starts as needed.
+
+Every execution drains the shared backend queue, so a burst of submissions
+needs a handful of executions, not one per job. The first start request
+is decided at once; requests arriving within a short window after it are
+folded into a single decision: the executions already running are compared
+with the queue depth, and only the shortfall is started.
+
+That later decision runs on a timer after the invocation that asked for it
+has returned. If the host is recycled before the timer fires it is lost, so
+QUEUE_AUTOSCALER should be on with the scheduler to start those executions.
+"""
+
+import logging
+import math
+import os
+import threading
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable, Dict, Optional
+
+from .container_jobs import (
+    ContainerJobSettings,
+    begin_job_start,
+    get_container_apps_client,
+    get_job_settings,
+    start_container_job,
+)
+from .job_queue import BACKEND_QUEUE, get_queue_depth
+
+# Execution states that will still take messages off the queue
+ACTIVE_STATES = ("Running", "Processing")
+
+DEFAULT_START_WINDOW = 2.0
+DEFAULT_JOBS_PER_EXECUTION = 1
+DEFAULT_MAX_EXECUTIONS = 10
+
+DEFAULT_CLASS = "default"
+FAST_CLASS = "fast"
+SLOW_CLASS = "slow"
+DEFAULT_FAST_QUEUE = "apbsbackendqueue-fast"
+
+
+def _env_number(name: str, default, cast=int):
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        logging.warning(f"Invalid {name} '{value}', using {default}")
+        return default
+
+
+@dataclass(frozen=True)
+class ScalingPolicy:
+    # Queue messages one execution is expected to work through
+    jobs_per_execution: int = DEFAULT_JOBS_PER_EXECUTION
+    # Never run more executions than this at once
+    max_executions: int = DEFAULT_MAX_EXECUTIONS
+
+    def desired_executions(self, queue_depth: int) -> int:
+        wanted = math.ceil(max(0, queue_depth) / max(1, self.jobs_per_execution))
+        return min(wanted, max(0, self.max_executions))
+
+    def executions_to_start(self, queue_depth: int, active: int) -> int:
+        return max(0, self.desired_executions(queue_depth) - active)
+
+
+def get_scaling_policy() -> ScalingPolicy:
+    return ScalingPolicy(
+        jobs_per_execution=max(
+            1,
+            _env_number("CONTAINER_JOB_JOBS_PER_EXECUTION", DEFAULT_JOBS_PER_EXECUTION),
+        ),
+        max_executions=max(
+            0, _env_number("CONTAINER_JOB_MAX_EXECUTIONS", DEFAULT_MAX_EXECUTIONS)
+        ),
+    )
+
+
+@dataclass(frozen=True)
+class JobClass:
+    """A queue, the container job draining it and how far it may scale."""
+
+    name: str
+    queue_name: str = BACKEND_QUEUE
+    # None means JOB_NAME
+    job_name: Optional[str] = None
+    policy: ScalingPolicy = ScalingPolicy()
+
+
+def routing_enabled() -> bool:
+    if os.getenv("JOB_ROUTING", "").lower() not in ("1", "true"):
+        return False
+    if not os.getenv("FAST_JOB_NAME"):
+        logging.warning("JOB_ROUTING is set but FAST_JOB_NAME is not, not routing")
+        return False
+    return True
+
+
+def get_job_classes() -> Dict[str, JobClass]:
+    """The job classes in use; a single default one unless JOB_ROUTING is set.
+
+    The slow class keeps the original queue, container job and limits, so
+    only fast jobs move when routing is turned on.
+    """
+    if not routing_enabled():
+        return {DEFAULT_CLASS: JobClass(DEFAULT_CLASS, policy=get_scaling_policy())}
+    fast_policy = ScalingPolicy(
+        jobs_per_execution=max(
+            1,
+            _env_number("FAST_JOB_JOBS_PER_EXECUTION", DEFAULT_JOBS_PER_EXECUTION),
+        ),
+        max_executions=max(
+            0, _env_number("FAST_JOB_MAX_EXECUTIONS", DEFAULT_MAX_EXECUTIONS)
+        ),
+    )
+    return {
+        FAST_CLASS: JobClass(
+            FAST_CLASS,
+            os.getenv("FAST_JOB_QUEUE", DEFAULT_FAST_QUEUE),
+            os.getenv("FAST_JOB_NAME"),
+            fast_policy,
+        ),
+        SLOW_CLASS: JobClass(SLOW_CLASS, policy=get_scaling_policy()),
+    }
+
+
+def count_active_executions(client, settings: ContainerJobSettings) -> int:
+    executions = client.jobs_executions.list(
+        resource_group_name=settings.resource_group_name,
+        job_name=settings.job_name,
+    )
+    return sum(1 for execution in executions if execution.status in ACTIVE_STATES)
+
+
+def reconcile_executions(
+    client,
+    settings: ContainerJobSettings,
+    policy: ScalingPolicy,
+    queue_depth: Optional[int],
+    requested: int = 0,
+) -> int:
+    """Start the executions missing to serve the queue; return how many.
+
+    requested counts start requests whose queue messages may not be visible
+    in queue_depth yet (the queue_output binding is written once the
+    function returns). If the queue depth can't be read, it stands in for it.
+    """
+    backlog = max(queue_depth or 0, requested)
+    try:
+        active = count_active_executions(client, settings)
+    except Exception as err:
+        logging.warning(
+            "Could not list job executions, assuming none are running: "
+            f"{type(err).__name__}: {err}"
+        )
+        active = 0
+    to_start = policy.executions_to_start(backlog, active)
+    logging.info(
+        f"Queue depth: {queue_depth}, requested: {requested}, "
+        f"active executions: {active}, starting: {to_start}"
+    )
+    started = 0
+    for _ in range(to_start):
+        try:
+            begin_job_start(client, settings)
+        except Exception as err:
+            logging.error(f"Error starting container job: {type(err).__name__}: {err}")
+            break
+        started += 1
+    return started
+
+
+class StartScheduler:
+    """Collects start requests and acts on them once per window."""
+
+    def __init__(
+        self,
+        window: Optional[float] = None,
+        client=None,
+        settings: Optional[ContainerJobSettings] = None,
+        policy: Optional[ScalingPolicy] = None,
+        queue_depth: Optional[Callable[[], Optional[int]]] = None,
+        job_class: Optional[JobClass] = None,
+    ):
+        if window is None:
+            window = _env_number(
+                "CONTAINER_JOB_START_WINDOW", DEFAULT_START_WINDOW, float
+            )
+        self.window = window
+        self.client = client
+        self.settings = settings
+        self.job_class = job_class
+        if job_class is not None and policy is None:
+            policy = job_class.policy
+        self.policy = policy
+        if queue_depth is None:
+            queue_name = job_class.queue_name if job_class else BACKEND_QUEUE
+            queue_depth = partial(get_queue_depth, queue_name)
+        self.queue_depth = queue_depth
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._requested = 0
+        self._timer: Optional[threading.Timer] = None
+
+    def request_start(self, count: int = 1):
+        """Note that jobs were queued and start the executions they need.
+
+        A request with none pending is decided before returning; requests
+        arriving within the window after it wait for the window to end.
+        """
+        with self._lock:
+            self._requested += count
+            if self._timer is not None:
+                logging.info(f"Coalesced start request ({self._requested} pending)")
+                return
+            if self.window > 0:
+                self._timer = threading.Timer(self.window, self._end_window)
+                self._timer.daemon = True
+                self._timer.start()
+        self._decide()
+
+    def _end_window(self):
+        with self._lock:
+            self._timer = None
+        self._decide()
+
+    def flush(self) -> int:
+        """Decide on the pending requests now; return the executions started."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        return self._decide()
+
+    def _decide(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                requested = self._requested
+                self._requested = 0
+            if requested == 0:
+                return 0
+
+            job_name = self.job_class.job_name if self.job_class else None
+            settings = self.settings or get_job_settings(job_name)
+            if settings is None:
+                return 0
+            try:
+                client = self.client or get_container_apps_client(settings)
+            except Exception as err:
+                logging.error(
+                    f"Error creating Container Apps client: {type(err).__name__}: {err}"
+                )
+                return 0
+            return reconcile_executions(
+                client,
+                settings,
+                self.policy or get_scaling_policy(),
+                self.queue_depth(),
+                requested,
+            )
+
+
+_scheduler_lock = threading.Lock()
+_schedulers: Dict[str, StartScheduler] = {}
+
+
+def get_scheduler(job_class: Optional[JobClass] = None) -> StartScheduler:
+    """The shared scheduler for a job class (or for the default job)."""
+    name = job_class.name if job_class else DEFAULT_CLASS
+    with _scheduler_lock:
+        scheduler = _schedulers.get(name)
+        if scheduler is None:
+            scheduler = StartScheduler(job_class=job_class)
+            _schedulers[name] = scheduler
+        return scheduler
+
+
+def set_scheduler(scheduler: Optional[StartScheduler], class_name: str = DEFAULT_CLASS):
+    with _scheduler_lock:
+        if scheduler is None:
+            _schedulers.pop(class_name, None)
+        else:
+            _schedulers[class_name] = scheduler
+
+
+def _autoscale_class(job_class: JobClass) -> int:
+    settings = get_job_settings(job_class.job_name)
+    if settings is None:
+        return 0
+    queue_depth = get_queue_depth(job_class.queue_name)
+    if queue_depth is None:
+        logging.warning(
+            f"Depth of {job_class.queue_name} unknown, holding the current executions"
+        )
+        return 0
+    try:
+        client = get_container_apps_client(settings)
+    except Exception as err:
+        logging.error(
+            f"Error creating Container Apps client: {type(err).__name__}: {err}"
+        )
+        return 0
+    return reconcile_executions(client, settings, job_class.policy, queue_depth)
+
+
+def autoscale_executions() -> int:
+    """Bring the running executions in line with the queue depth.
+
+    Unlike the scheduler, this does not wait for a submission: it is run on
+    a timer so a backlog (e.g. after an outage) is drained at full speed.
+    Each job class is scaled on its own queue; if a queue depth can't be
+    read, nothing is started for that class.
+    """
+    return sum(_autoscale_class(job_class) for job_class in get_job_classes().values())
+
+
+def request_container_start(job_class: Optional[JobClass] = None, count: int = 1):
+    """Start container jobs for count new messages.
+
+    Through the scheduler if it is enabled, otherwise one execution is
+    started per message.
+    """
+    if os.getenv("CONTAINER_JOB_START_ON_SUBMIT", "true").lower() in ("0", "false"):
+        logging.info("Leaving the container job start to the autoscaler")
+        return
+    if os.getenv("CONTAINER_JOB_SCHEDULER", "").lower() in ("1", "true"):
+        get_scheduler(job_class).request_start(count)
+    else:
+        for _ in range(count):
+            start_container_job(job_class.job_name if job_class else None)
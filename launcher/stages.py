@@ -0,0 +1,154 @@
+"""Run small dependency graphs of I/O stages concurrently, with timings."""
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Sequence, Tuple, Union
+import asyncio
+import logging
+
+
+@dataclass
+class Stage:
+    """A named unit of work.
+
+    func receives the results of all stages finished so far, keyed by name,
+    and may read the results of the stages it depends on.
+    """
+
+    name: str
+    func: Callable[[Dict[str, Any]], Any]
+    depends_on: Tuple[str, ...] = ()
+
+
+@dataclass
+class AsyncStage:
+    """Asyncio version of Stage; func returns an awaitable."""
+
+    name: str
+    func: Callable[[Dict[str, Any]], Awaitable[Any]]
+    depends_on: Tuple[str, ...] = ()
+
+
+@dataclass
+class StageResults:
+    results: Dict[str, Any] = field(default_factory=dict)
+    # Seconds spent in each stage, plus "total" for the whole graph
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+def _check_graph(stages: Sequence[Union[Stage, AsyncStage]]):
+    names = {stage.name for stage in stages}
+    if len(names) != len(stages):
+        raise ValueError("Stage names must be unique")
+    for stage in stages:
+        unknown = set(stage.depends_on) - names
+        if unknown:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown {unknown}")
+
+
+def _ready(
+    stages: Sequence[Union[Stage, AsyncStage]], done: Dict[str, Any], started: set
+) -> list:
+    return [
+        stage
+        for stage in stages
+        if stage.name not in started and all(name in done for name in stage.depends_on)
+    ]
+
+
+def _log_timings(job_tag: str, timings: Dict[str, float]):
+    logging.info(
+        "%s Stage timings: %s",
+        job_tag,
+        ", ".join(f"{name}={seconds:.3f}s" for name, seconds in timings.items()),
+    )
+
+
+def run_stages(job_tag: str, stages: List[Stage], max_workers: int = 4) -> StageResults:
+    """Run stages on a thread pool, each as soon as its dependencies finish.
+
+    The first exception raised by a stage is re-raised once the stages
+    already running have finished; stages not yet started are skipped.
+    """
+    _check_graph(stages)
+    output = StageResults()
+    started: set = set()
+    running: Dict[Future, Stage] = {}
+    graph_start = perf_counter()
+
+    def _timed(stage: Stage, results: Dict[str, Any]) -> Any:
+        start = perf_counter()
+        try:
+            return stage.func(results)
+        finally:
+            output.timings[stage.name] = perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        error = None
+        while True:
+            if error is None:
+                for stage in _ready(stages, output.results, started):
+                    started.add(stage.name)
+                    future = executor.submit(_timed, stage, dict(output.results))
+                    running[future] = stage
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    output.results[stage.name] = future.result()
+                except Exception as err:
+                    if error is None:
+                        error = err
+
+    output.timings["total"] = perf_counter() - graph_start
+    _log_timings(job_tag, output.timings)
+    if error is not None:
+        raise error
+    if len(started) != len(stages):
+        raise ValueError(f"{job_tag} Stage graph has a dependency cycle")
+    return output
+
+
+async def run_stages_async(job_tag: str, stages: List[AsyncStage]) -> StageResults:
+    """Asyncio version of run_stages."""
+    _check_graph(stages)
+    output = StageResults()
+    started: set = set()
+    running: Dict[asyncio.Task, AsyncStage] = {}
+    graph_start = perf_counter()
+
+    async def _timed(stage: AsyncStage, results: Dict[str, Any]) -> Any:
+        start = perf_counter()
+        try:
+            return await stage.func(results)
+        finally:
+            output.timings[stage.name] = perf_counter() - start
+
+    error = None
+    while True:
+        if error is None:
+            for stage in _ready(stages, output.results, started):
+                started.add(stage.name)
+                task = asyncio.ensure_future(_timed(stage, dict(output.results)))
+                running[task] = stage
+        if not running:
+            break
+        finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            stage = running.pop(task)
+            try:
+                output.results[stage.name] = task.result()
+            except Exception as err:
+                if error is None:
+                    error = err
+
+    output.timings["total"] = perf_counter() - graph_start
+    _log_timings(job_tag, output.timings)
+    if error is not None:
+        raise error
+    if len(started) != len(stages):
+        raise ValueError(f"{job_tag} Stage graph has a dependency cycle")
+    return output
@@ -0,0 +1,791 @@
+"""Storage backends used to stage job files.
+
+The function app talks to Azure Blob Storage in production. The local
+filesystem and in-memory backends let the whole job preparation pipeline
+run without a connection string, e.g. for benchmarks and load tests.
+
+The backend is chosen with the STORAGE_BACKEND setting ("azure", "local" or
+"memory") or injected with set_storage().
+"""
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from shutil import copyfile
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Protocol,
+    Tuple,
+)
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from .azure_storage_aio import AsyncAzureUtils
+from .azure_storage_utils import AzureUtils
+
+# Chunk size used by the local and in-memory backends when streaming
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+@dataclass
+class StorageStats:
+    """Running count of storage operations and bytes moved."""
+
+    operations: Dict[str, int] = field(default_factory=dict)
+    bytes_read: int = 0
+    bytes_written: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, operation: str, bytes_read: int = 0, bytes_written: int = 0):
+        with self._lock:
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def add_bytes(self, bytes_read: int = 0, bytes_written: int = 0):
+        """Count bytes moved by a streaming operation already recorded."""
+        with self._lock:
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "operations": dict(self.operations),
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+            self.bytes_read = 0
+            self.bytes_written = 0
+
+
+class AsyncStorageBackend(Protocol):
+    stats: StorageStats
+
+    async def download_file_str(self, container_name: str, object_name: str) -> str: ...
+
+    async def put_object(self, container_name: str, object_name: str, body): ...
+
+    def iter_chunks(
+        self, container_name: str, object_name: str
+    ) -> AsyncIterator[bytes]: ...
+
+    async def upload_stream(
+        self, container_name: str, object_name: str, chunks: AsyncIterable[bytes]
+    ): ...
+
+    async def create_object(
+        self, container_name: str, object_name: str, body
+    ) -> bool: ...
+
+    async def download_with_etag(
+        self, container_name: str, object_name: str
+    ) -> Tuple[bytes, str]: ...
+
+    async def replace_object(
+        self, container_name: str, object_name: str, body, etag: str
+    ) -> bool: ...
+
+    async def delete_object(self, container_name: str, object_name: str): ...
+
+    async def object_size(self, container_name: str, object_name: str) -> int: ...
+
+    async def object_exists(self, container_name: str, object_name: str) -> bool: ...
+
+    async def objects_exist(
+        self,
+        container_name: str,
+        object_names: Iterable[str],
+        prefix: Optional[str] = None,
+    ) -> Dict[str, bool]: ...
+
+    async def copy_object(
+        self,
+        container_name: str,
+        src: str,
+        dest: str,
+        dest_container: Optional[str] = None,
+    ): ...
+
+    async def get_object_json(
+        self, tag: str, container_name: str, object_name: str
+    ) -> dict: ...
+
+
+class StorageBackend(Protocol):
+    stats: StorageStats
+
+    def download_file_str(self, container_name: str, object_name: str) -> str: ...
+
+    def put_object(self, container_name: str, object_name: str, body): ...
+
+    def iter_chunks(self, container_name: str, object_name: str) -> Iterator[bytes]:
+        """Read an object as a stream of byte chunks."""
+        ...
+
+    def upload_stream(
+        self, container_name: str, object_name: str, chunks: Iterable[bytes]
+    ):
+        """Write an object from an iterable of byte chunks."""
+        ...
+
+    def create_object(self, container_name: str, object_name: str, body) -> bool:
+        """Write an object only if it does not exist; True if it was written."""
+        ...
+
+    def download_with_etag(
+        self, container_name: str, object_name: str
+    ) -> Tuple[bytes, str]:
+        """Read an object and the ETag of the version read."""
+        ...
+
+    def replace_object(
+        self, container_name: str, object_name: str, body, etag: str
+    ) -> bool:
+        """Overwrite an object only if its ETag still matches; True if written."""
+        ...
+
+    def delete_object(self, container_name: str, object_name: str):
+        """Delete an object if it exists."""
+        ...
+
+    def object_size(self, container_name: str, object_name: str) -> int: ...
+
+    def object_exists(self, container_name: str, object_name: str) -> bool: ...
+
+    def objects_exist(
+        self,
+        container_name: str,
+        object_names: Iterable[str],
+        prefix: Optional[str] = None,
+    ) -> Dict[str, bool]: ...
+
+    def copy_object(
+        self,
+        container_name: str,
+        src: str,
+        dest: str,
+        dest_container: Optional[str] = None,
+    ): ...
+
+    def get_object_json(
+        self, tag: str, container_name: str, object_name: str
+    ) -> dict: ...
+
+    def to_async(self) -> AsyncStorageBackend:
+        """Return an asyncio view of this backend sharing the same stats."""
+        ...
+
+
+def _to_bytes(body) -> bytes:
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    if isinstance(body, (bytes, bytearray)):
+        return bytes(body)
+    return b"".join(body)
+
+
+def _etag(data: bytes) -> str:
+    # The local backends have no versions, so the contents stand in for them
+    return f'"{hashlib.sha256(data).hexdigest()}"'
+
+
+def _count_read(stats: StorageStats, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    for chunk in chunks:
+        stats.add_bytes(bytes_read=len(chunk))
+        yield chunk
+
+
+def _count_written(stats: StorageStats, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    for chunk in chunks:
+        stats.add_bytes(bytes_written=len(chunk))
+        yield chunk
+
+
+async def _acount_written(
+    stats: StorageStats, chunks: AsyncIterable[bytes]
+) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        stats.add_bytes(bytes_written=len(chunk))
+        yield chunk
+
+
+def _parse_json(tag: str, text: str) -> dict:
+    resp = {}
+    try:
+        resp = json.loads(text)
+        logging.info(f"{tag}: Found JSON object data: {resp}")
+    except Exception as err:
+        logging.error(f"{tag}: Error parsing JSON object data: {err}")
+    return resp
+
+
+class AzureStorage:
+    """Azure Blob Storage, through the process-wide AzureUtils clients."""
+
+    def __init__(self):
+        self.stats = StorageStats()
+
+    def download_file_str(self, container_name: str, object_name: str) -> str:
+        data = AzureUtils.download_file_bytes(container_name, object_name)
+        self.stats.record("download", bytes_read=len(data))
+        return data.decode("utf-8")
+
+    def put_object(self, container_name: str, object_name: str, body):
+        data = _to_bytes(body)
+        AzureUtils.put_object(container_name, object_name, data)
+        self.stats.record("upload", bytes_written=len(data))
+
+    def iter_chunks(self, container_name: str, object_name: str) -> Iterator[bytes]:
+        self.stats.record("download_stream")
+        return _count_read(
+            self.stats, AzureUtils.download_chunks(container_name, object_name)
+        )
+
+    def upload_stream(
+        self, container_name: str, object_name: str, chunks: Iterable[bytes]
+    ):
+        self.stats.record("upload_stream")
+        AzureUtils.upload_stream(
+            container_name, object_name, _count_written(self.stats, chunks)
+        )
+
+    def create_object(self, container_name: str, object_name: str, body) -> bool:
+        data = _to_bytes(body)
+        created = AzureUtils.create_object(container_name, object_name, data)
+        self.stats.record("create", bytes_written=len(data) if created else 0)
+        return created
+
+    def download_with_etag(
+        self, container_name: str, object_name: str
+    ) -> Tuple[bytes, str]:
+        data, etag = AzureUtils.download_with_etag(container_name, object_name)
+        self.stats.record("download", bytes_read=len(data))
+        return data, etag
+
+    def replace_object(
+        self, container_name: str, object_name: str, body, etag: str
+    ) -> bool:
+        data = _to_bytes(body)
+        replaced = AzureUtils.replace_object(container_name, object_name, data, etag)
+        self.stats.record("replace", bytes_written=len(data) if replaced else 0)
+        return replaced
+
+    def delete_object(self, container_name: str, object_name: str):
+        self.stats.record("delete")
+        AzureUtils.delete_object(container_name, object_name)
+
+    def object_size(self, container_name: str, object_name: str) -> int:
+        self.stats.record("size")
+        return AzureUtils.object_size(container_name, object_name)
+
+    def object_exists(self, container_name: str, object_name: str) -> bool:
+        self.stats.record("exists")
+        return AzureUtils.object_exists(container_name, object_name)
+
+    def objects_exist(
+        self,
+        container_name: str,
+        object_names: Iterable[str],
+        prefix: Optional[str] = None,
+    ) -> Dict[str, bool]:
+        self.stats.record("exists_batch")
+        return AzureUtils.objects_exist(container_name, object_names, prefix)
+
+    def copy_object(
+        self,
+        container_name: str,
+        src: str,
+        dest: str,
+        dest_container: Optional[str] = None,
+    ):
+        self.stats.record("copy")
+        AzureUtils.copy_object(container_name, src, dest, dest_container)
+
+    def get_object_json(self, tag: str, container_name: str, object_name: str) -> dict:
+        return _parse_json(tag, self.download_file_str(container_name, object_name))
+
+    def to_async(self) -> AsyncStorageBackend:
+        return AsyncAzureStorage(self.stats)
+
+
+class AsyncAzureStorage:
+    """Azure Blob Storage, through the AsyncAzureUtils clients."""
+
+    def __init__(self, stats: Optional[StorageStats] = None):
+        self.stats = stats if stats is not None else StorageStats()
+
+    async def download_file_str(self, container_name: str, object_name: str) -> str:
+        data = await AsyncAzureUtils.download_file_bytes(container_name, object_name)
+        self.stats.record("download", bytes_read=len(data))
+        return data.decode("utf-8")
+
+    async def put_object(self, container_name: str, object_name: str, body):
+        data = _to_bytes(body)
+        await AsyncAzureUtils.put_object(container_name, object_name, data)
+        self.stats.record("upload", bytes_written=len(data))
+
+    async def iter_chunks(
+        self, container_name: str, object_name: str
+    ) -> AsyncIterator[bytes]:
+        self.stats.record("download_stream")
+        chunks = await AsyncAzureUtils.download_chunks(container_name, object_name)
+        async for chunk in chunks:
+            self.stats.add_bytes(bytes_read=len(chunk))
+            yield chunk
+
+    async def upload_stream(
+        self, container_name: str, object_name: str, chunks: AsyncIterable[bytes]
+    ):
+        self.stats.record("upload_stream")
+        await AsyncAzureUtils.upload_stream(
+            container_name, object_name, _acount_written(self.stats, chunks)
+        )
+
+    async def create_object(self, container_name: str, object_name: str, body) -> bool:
+        data = _to_bytes(body)
+        created = await AsyncAzureUtils.create_object(container_name, object_name, data)
+        self.stats.record("create", bytes_written=len(data) if created else 0)
+        return created
+
+    async def download_with_etag(
+        self, container_name: str, object_name: str
+    ) -> Tuple[bytes, str]:
+        data, etag = await AsyncAzureUtils.download_with_etag(
+            container_name, object_name
+        )
+        self.stats.record("download", bytes_read=len(data))
+        return data, etag
+
+    async def replace_object(
+        self, container_name: str, object_name: str, body, etag: str
+    ) -> bool:
+        data = _to_bytes(body)
+        replaced = await AsyncAzureUtils.replace_object(
+            container_name, object_name, data, etag
+        )
+        self.stats.record("replace", bytes_written=len(data) if replaced else 0)
+        return replaced
+
+    async def delete_object(self, container_name: str, object_name: str):
+        self.stats.record("delete")
+        await AsyncAzureUtils.delete_object(container_name, object_name)
+
+    async def object_size(self, container_name: str, object_name: str) -> int:
+        self.stats.record("size")
+        return await AsyncAzureUtils.object_size(container_name, object_name)
+
+    async def object_exists(self, container_name: str, object_name: str) -> bool:
+        self.stats.record("exists")
+        return await AsyncAzureUtils.object_exists(container_name, object_name)
+
+    async def objects_exist(
+        self,
+        container_name: str,
+        object_names: Iterable[str],
+        prefix: Optional[str] = None,
+    ) -> Dict[str, bool]:
+        self.stats.record("exists_batch")
+        return await AsyncAzureUtils.objects_exist(container_name, object_names, prefix)
+
+    async def copy_object(
+        self,
+        container_name: str,
+        src: str,
+        dest: str,
+        dest_container: Optional[str] = None,
+    ):
+        self.stats.record("copy")
+        await AsyncAzureUtils.copy_object(container_name, src, dest, dest_container)
+
+    async def get_object_json(
+        self, tag: str, container_name: str, object_name: str
+    ) -> dict:
+        return _parse_json(
+            tag, await self.download_file_str(container_name, object_name)
+        )
+
+
+class AsyncStorageAdapter:
+    """Asyncio view of a synchronous backend, running calls in a thread."""
+
+    def __init__(self, storage: StorageBackend):
+        self.storage = storage
+        self.stats = storage.stats
+
+    async def download_file_str(self, container_name: str, object_name: str) -> str:
+        return await asyncio.to_thread(
+            self.storage.download_file_str, container_name, object_name
+        )
+
+    async def put_object(self, container_name: str, object_name: str, body):
+        await asyncio.to_thread(
+            self.storage.put_object, container_name, object_name, body
+        )
+
+    async def iter_chunks(
+        self, container_name: str, object_name: str
+    ) -> AsyncIterator[bytes]:
+        chunks = self.storage.iter_chunks(container_name, object_name)
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+
+    async def upload_stream(
+        self, container_name: str, object_name: str, chunks: AsyncIterable[bytes]
+    ):
+        # The wrapped backends are local, so buffering the chunks is cheap
+        data = [chunk async for chunk in chunks]
+        await asyncio.to_thread(
+            self.storage.upload_stream, container_name, object_name, data
+        )
+
+    async def create_object(self, container_name: str, object_name: str, body) -> bool:
+        return await asyncio.to_thread(
+            self.storage.create_object, container_name, object_name, body
+        )
+
+    async def download_with_etag(
+        self, container_name: str, object_name: str
+    ) -> Tuple[bytes, str]:
+        return await asyncio.to_thread(
+            self.storage.download_with_etag, container_name, object_name
+        )
+
+    async def replace_object(
+        self, container_name: str, object_name: str, body, etag: str
+    ) -> bool:
+        return await asyncio.to_thread(
+            self.storage.replace_object, container_name, object_name, body, etag
+        )
+
+    async def delete_object(self, container_name: str, object_name: str):
+        await asyncio.to_thread(self.storage.delete_object, container_name, object_name)
+
+    async def object_size(self, container_name: str, object_name: str) -> int:
+        return await asyncio.to_thread(
+            self.storage.object_size, container_name, object_name
+        )
+
+    async def object_exists(self, container_name: str, object_name: str) -> bool:
+        return await asyncio.to_thread(
+            self.storage.object_exists, container_name, object_name
+        )
+
+    async def objects_exist(
+        self,
+        container_name: str,
+        object_names: Iterable[str],
+        prefix: Optional[str] = None,
+    ) -> Dict[str, bool]:
+        return await asyncio.to_thread(
+            self.storage.objects_exist, container_name, list(object_names), prefix
+        )
+
+    async def copy_object(
+        self,
+        container_name: str,
+        src: str,
+        dest: str,
+        dest_container: Optional[str] = None,
+    ):
+        await asyncio.to_thread(
+            self.storage.copy_object, container_name, src, dest, dest_container
+        )
+
+    async def get_object_json(
+        self, tag: str, container_name: str, object_name: str
+    ) -> dict:
+        return await asyncio.to_thread(
+            self.storage.get_object_json, tag, container_name, object_name
+        )
+
+
+class MemoryStorage:
+    """Keeps every object in a dictionary; nothing leaves the process."""
+
+    def __init__(self):
+        self.stats = StorageStats()
+        self.objects: Dict[str, Dict[str, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def _read(self, container_name: str, object_name: str) -> bytes:
+        try:
+            return self.objects[container_name][object_name]
+        except KeyError:
+            raise FileNotFoundError(f"{container_name}/{object_name}")
+
+    def download_file_str(self, container_name: str, object_name: str) -> str:
+        data = self._read(container_name, object_name)
+        self.stats.record("download", bytes_read=len(data))
+        return data.decode("utf-8")
+
+    def put_object(self, container_name: str, object_name: str, body):
+        data = _to_bytes(body)
+        with self._lock:
+            self.objects.setdefault(container_name, {})[object_name] = data
+        self.stats.record("upload", bytes_written=len(data))
+
+    def iter_chunks(self, container_name: str, object_name: str) -> Iterator[bytes]:
+        self.stats.record("download_stream")
+        data = self._read(container_name, object_name)
+        chunks = (
+            data[start : start + STREAM_CHUNK_SIZE]
+            for start in range(0, len(data), STREAM_CHUNK_SIZE)
+        )
+        return _count_read(self.stats, chunks)
+
+    def upload_stream(
+        self, container_name: str, object_name: str, chunks: Iterable[bytes]
+    ):
+        self.stats.record("upload_stream")
+        data = b"".join(_count_written(self.stats, chunks))
+        with self._lock:
+            self.objects.setdefault(container_name, {})[object_name] = data
+
+    def create_object(self, container_name: str, object_name: str, body) -> bool:
+        data = _to_bytes(body)
+        with self._lock:
+            container = self.objects.setdefault(container_name, {})
+            created = object_name not in container
+            if created:
+                container[object_name] = data
+        self.stats.record("create", bytes_written=len(data) if created else 0)
+        return created
+
+    def download_with_etag(
+        self, container_name: str, object_name: str
+    ) -> Tuple[bytes, str]:
+        data = self._read(container_name, object_name)
+        self.stats.record("download", bytes_read=len(data))
+        return data, _etag(data)
+
+    def replace_object(
+        self, container_name: str, object_name: str, body, etag: str
+    ) -> bool:
+        data = _to_bytes(body)
+        with self._lock:
+            container = self.objects.setdefault(container_name, {})
+            replaced = (
+                object_name in container and _etag(container[object_name]) == etag
+            )
+            if replaced:
+                container[object_name] = data
+        self.stats.record("replace", bytes_written=len(data) if replaced else 0)
+        return replaced
+
+    def delete_object(self, container_name: str, object_name: str):
+        with self._lock:
+            self.objects.get(container_name, {}).pop(object_name, None)
+        self.stats.record("delete")
+
+    def object_size(self, container_name: str, object_name: str) -> int:
+        self.stats.record("size")
+        return len(self._read(container_name, object_name))
+
+    def object_exists(self, container_name: str, object_name: str) -> bool:
+        self.stats.record("exists")
+        return object_name in self.objects.get(container_name, {})
+
+    def objects_exist(
+        self,
+        container_name: str,
+        object_names: Iterable[str],
+        prefix: Optional[str] = None,
+    ) -> Dict[str, bool]:
+        self.stats.record("exists_batch")
+        container = self.objects.get(container_name, {})
+        return {name: name in container for name in object_names}
+
+    def copy_object(
+        self,
+        container_name: str,
+        src: str,
+        dest: str,
+        dest_container: Optional[str] = None,
+    ):
+        if dest_container is None:
+            dest_container = container_name
+        data = self._read(container_name, src)
+        with self._lock:
+            self.objects.setdefault(dest_container, {})[dest] = data
+        self.stats.record("copy")
+
+    def get_object_json(self, tag: str, container_name: str, object_name: str) -> dict:
+        return _parse_json(tag, self.download_file_str(container_name, object_name))
+
+    def to_async(self) -> AsyncStorageBackend:
+        return AsyncStorageAdapter(self)
+
+
+class LocalStorage:
+    """Stores objects as files under '{root}/{container}/{object_name}'."""
+
+    def __init__(self, root: str):
+        self.stats = StorageStats()
+        self.root = Path(root)
+        self._lock = threading.Lock()
+
+    def _path(self, container_name: str, object_name: str) -> Path:
+        return self.root / container_name / object_name
+
+    def download_file_str(self, container_name: str, object_name: str) -> str:
+        data = self._path(container_name, object_name).read_bytes()
+        self.stats.record("download", bytes_read=len(data))
+        return data.decode("utf-8")
+
+    def put_object(self, container_name: str, object_name: str, body):
+        data = _to_bytes(body)
+        path = self._path(container_name, object_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        self.stats.record("upload", bytes_written=len(data))
+
+    def iter_chunks(self, container_name: str, object_name: str) -> Iterator[bytes]:
+        self.stats.record("download_stream")
+        path = self._path(container_name, object_name)
+        if not path.is_file():
+            raise FileNotFoundError(f"{container_name}/{object_name}")
+
+        def _read_chunks() -> Iterator[bytes]:
+            with path.open("rb") as stream:
+                while chunk := stream.read(STREAM_CHUNK_SIZE):
+                    yield chunk
+
+        return _count_read(self.stats, _read_chunks())
+
+    def upload_stream(
+        self, container_name: str, object_name: str, chunks: Iterable[bytes]
+    ):
+        self.stats.record("upload_stream")
+        path = self._path(container_name, object_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("wb") as stream:
+            for chunk in _count_written(self.stats, chunks):
+                stream.write(chunk)
+
+    def create_object(self, container_name: str, object_name: str, body) -> bool:
+        data = _to_bytes(body)
+        path = self._path(container_name, object_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with path.open("xb") as stream:
+                stream.write(data)
+        except FileExistsError:
+            self.stats.record("create")
+            return False
+        self.stats.record("create", bytes_written=len(data))
+        return True
+
+    def download_with_etag(
+        self, container_name: str, object_name: str
+    ) -> Tuple[bytes, str]:
+        data = self._path(container_name, object_name).read_bytes()
+        self.stats.record("download", bytes_read=len(data))
+        return data, _etag(data)
+
+    def replace_object(
+        self, container_name: str, object_name: str, body, etag: str
+    ) -> bool:
+        data = _to_bytes(body)
+        path = self._path(container_name, object_name)
+        # Only atomic within this process, which is all local runs need
+        with self._lock:
+            replaced = path.is_file() and _etag(path.read_bytes()) == etag
+            if replaced:
+                path.write_bytes(data)
+        self.stats.record("replace", bytes_written=len(data) if replaced else 0)
+        return replaced
+
+    def delete_object(self, container_name: str, object_name: str):
+        self._path(container_name, object_name).unlink(missing_ok=True)
+        self.stats.record("delete")
+
+    def object_size(self, container_name: str, object_name: str) -> int:
+        self.stats.record("size")
+        return self._path(container_name, object_name).stat().st_size
+
+    def object_exists(self, container_name: str, object_name: str) -> bool:
+        self.stats.record("exists")
+        return self._path(container_name, object_name).is_file()
+
+    def objects_exist(
+        self,
+        container_name: str,
+        object_names: Iterable[str],
+        prefix: Optional[str] = None,
+    ) -> Dict[str, bool]:
+        self.stats.record("exists_batch")
+        return {
+            name: self._path(container_name, name).is_file() for name in object_names
+        }
+
+    def copy_object(
+        self,
+        container_name: str,
+        src: str,
+        dest: str,
+        dest_container: Optional[str] = None,
+    ):
+        if dest_container is None:
+            dest_container = container_name
+        dest_path = self._path(dest_container, dest)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        copyfile(self._path(container_name, src), dest_path)
+        self.stats.record("copy")
+
+    def get_object_json(self, tag: str, container_name: str, object_name: str) -> dict:
+        return _parse_json(tag, self.download_file_str(container_name, object_name))
+
+    def to_async(self) -> AsyncStorageBackend:
+        return AsyncStorageAdapter(self)
+
+
+_storage: Optional[StorageBackend] = None
+_storage_lock = threading.Lock()
+
+
+def _create_storage() -> StorageBackend:
+    backend = os.environ.get("STORAGE_BACKEND", "azure").lower()
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "local":
+        root = os.environ.get("LOCAL_STORAGE_ROOT")
+        if not root:
+            raise ValueError("Missing LOCAL_STORAGE_ROOT environment variable")
+        return LocalStorage(root)
+    if backend != "azure":
+        raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+    return AzureStorage()
+
+
+def get_storage() -> StorageBackend:
+    """Return the process-wide storage backend, creating it on first use."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = _create_storage()
+                logging.info(f"Using storage backend {type(_storage).__name__}")
+    return _storage
+
+
+def set_storage(storage: Optional[StorageBackend]):
+    """Replace the process-wide storage backend (None re-reads the settings)."""
+    global _storage
+    with _storage_lock:
+        _storage = storage
@@ -0,0 +1,243 @@
+"""Jobs split into subjobs, and the reducer that folds them back together.
+
+A parent job '{date}/{job_id}' that is split writes a manifest listing its
+subjobs to 'outputs/{date}/{job_id}/subjobs.json'. Each subjob runs as its
+own job under '{date}/{job_id}/{subjob}', so the worker writes its status
+to 'outputs/{date}/{job_id}/{subjob}/{job_type}-status.json'. Whenever one
+of those changes, the reducer rebuilds the parent status from all of them.
+
+Reducers for subjobs that finish together run at the same time. Each one
+reads the parent status before the subjob statuses, and writes it back
+only if its ETag is unchanged; otherwise it starts over. The last write
+therefore always reflects the latest subjob statuses.
+"""
+
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .ledger import claim_marker, run_claimed
+from .storage import StorageBackend
+from .submission import DEFAULT_MAX_RUNTIME, OUTPUT_CONTAINER, JobSubmission
+
+SUBJOBS_OBJECT = "subjobs.json"
+# Claimed while the follow-up of a finished parent is queued, and done after
+FOLLOW_UP_MARKER = "follow-up-queued"
+
+SUBJOB_KIND_MG_PARA = "mg-para"
+SUBJOB_KIND_SWEEP = "sweep"
+
+# Job type of the follow-up that merges the partial mg-para outputs
+MERGE_JOB_TYPE = "apbs-merge"
+
+STATUS_READ_CONCURRENCY = 8
+# Attempts at the conditional parent status write before giving up
+PARENT_WRITE_ATTEMPTS = 10
+
+FINISHED_STATES = ("complete", "failed")
+
+
+def subjob_tag(job_tag: str, name: str) -> str:
+    return f"{job_tag}/{name}"
+
+
+def write_subjob_manifest(
+    storage: StorageBackend,
+    submission: JobSubmission,
+    kind: str,
+    subjobs: List[str],
+    details: Optional[dict] = None,
+    job_type: Optional[str] = None,
+):
+    manifest = {
+        "kind": kind,
+        # Job type of the subjobs, which may differ from the parent's
+        "job_type": job_type or submission.job_type,
+        "parent_job_type": submission.job_type,
+        "status_object": submission.status_object,
+        "subjobs": subjobs,
+        "details": details or {},
+    }
+    storage.put_object(
+        OUTPUT_CONTAINER, f"{submission.job_tag}/{SUBJOBS_OBJECT}", json.dumps(manifest)
+    )
+    logging.info(f"{submission.job_tag} Split into {len(subjobs)} {kind} subjobs")
+
+
+def _read_json(storage: StorageBackend, tag: str, object_name: str) -> Optional[dict]:
+    try:
+        return storage.get_object_json(tag, OUTPUT_CONTAINER, object_name)
+    except Exception:
+        # Not written yet
+        return None
+
+
+def _parent_state(states: List[str]) -> str:
+    if "failed" in states:
+        return "failed" if all(s in FINISHED_STATES for s in states) else "running"
+    if all(state == "complete" for state in states):
+        return "complete"
+    if any(state != "pending" for state in states):
+        return "running"
+    return "pending"
+
+
+def aggregate_status(
+    parent: dict,
+    parent_job_type: str,
+    job_type: str,
+    subjobs: List[str],
+    statuses: List[Optional[dict]],
+) -> dict:
+    """Parent status built from the subjob statuses."""
+    job_status = parent.setdefault(parent_job_type, {})
+    # The parent's duration spans all its subjobs, so it is not a runtime
+    # the estimator should learn from
+    parent.get("metadata", {}).pop("runtimeFeatures", None)
+    subtasks = []
+    output_files: List[str] = []
+    end_times = []
+    for name, status in zip(subjobs, statuses):
+        sub_status = (status or {}).get(job_type) or {}
+        state = sub_status.get("status", "pending")
+        subtasks.append({"name": name, "status": state})
+        for output_file in sub_status.get("outputFiles") or []:
+            if output_file not in output_files:
+                output_files.append(output_file)
+        if sub_status.get("endTime") is not None:
+            end_times.append(sub_status["endTime"])
+
+    state = _parent_state([subtask["status"] for subtask in subtasks])
+    job_status["status"] = state
+    job_status["subtasks"] = subtasks
+    job_status["outputFiles"] = output_files
+    if state in FINISHED_STATES:
+        job_status["endTime"] = max(end_times) if end_times else time()
+    return parent
+
+
+def _merge_message(job_tag: str, output_files: List[str]) -> dict:
+    """Queue message asking the worker to merge the mg-para rank outputs."""
+    job_date, job_id = job_tag.split("/", 1)
+    return {
+        "job_date": job_date,
+        "job_id": job_id,
+        "job_tag": job_tag,
+        "job_type": MERGE_JOB_TYPE,
+        "bucket_name": OUTPUT_CONTAINER,
+        "input_files": output_files,
+        "command_line_args": "",
+        "max_run_time": DEFAULT_MAX_RUNTIME,
+    }
+
+
+def _read_parent(
+    storage: StorageBackend, job_tag: str, status_object: str, parent_job_type: str
+) -> Tuple[dict, Optional[str]]:
+    """The parent status and its ETag (None if it does not exist yet)."""
+    empty = {
+        "jobid": job_tag.split("/", 1)[1],
+        "jobtype": parent_job_type,
+        "metadata": {"versions": {}},
+    }
+    try:
+        data, etag = storage.download_with_etag(OUTPUT_CONTAINER, status_object)
+    except FileNotFoundError:
+        return empty, None
+    try:
+        return json.loads(data), etag
+    except ValueError:
+        logging.error(f"{job_tag} Unreadable parent status, rebuilding it")
+        return empty, etag
+
+
+def _read_statuses(
+    storage: StorageBackend, job_tag: str, job_type: str, subjobs: List[str]
+) -> List[Optional[dict]]:
+    with ThreadPoolExecutor(max_workers=STATUS_READ_CONCURRENCY) as executor:
+        return list(
+            executor.map(
+                lambda name: _read_json(
+                    storage, job_tag, f"{job_tag}/{name}/{job_type}-status.json"
+                ),
+                subjobs,
+            )
+        )
+
+
+def reduce_subjobs(
+    storage: StorageBackend, job_tag: str, job_type: str
+) -> Optional[dict]:
+    """Update the parent status of job_tag from its subjobs.
+
+    A returned follow-up must be queued through run_follow_up.
+
+    :return: a follow-up queue message to send once all subjobs are
+             complete (only the first caller to get there gets it), or None
+    """
+    manifest = _read_json(storage, job_tag, f"{job_tag}/{SUBJOBS_OBJECT}")
+    if not manifest:
+        logging.info(f"{job_tag} Not a split job, nothing to reduce")
+        return None
+    job_type = manifest.get("job_type", job_type)
+    parent_job_type = manifest.get("parent_job_type", job_type)
+    subjobs: List[str] = manifest["subjobs"]
+    status_object = manifest.get(
+        "status_object", f"{job_tag}/{parent_job_type}-status.json"
+    )
+
+    for _ in range(PARENT_WRITE_ATTEMPTS):
+        # The parent first: a write after it means the statuses may be stale
+        parent, etag = _read_parent(storage, job_tag, status_object, parent_job_type)
+        statuses = _read_statuses(storage, job_tag, job_type, subjobs)
+        parent = aggregate_status(parent, parent_job_type, job_type, subjobs, statuses)
+        body = json.dumps(parent)
+        if etag is None:
+            written = storage.create_object(OUTPUT_CONTAINER, status_object, body)
+        else:
+            written = storage.replace_object(
+                OUTPUT_CONTAINER, status_object, body, etag
+            )
+        if written:
+            break
+        logging.info(f"{job_tag} Parent status changed while reducing, retrying")
+    else:
+        raise RuntimeError(f"{job_tag} Could not update the parent status")
+    state = parent[parent_job_type]["status"]
+    logging.info(f"{job_tag} Reduced {len(subjobs)} subjobs: {state}")
+
+    if state != "complete" or manifest["kind"] != SUBJOB_KIND_MG_PARA:
+        return None
+    # Several subjobs may finish at once; only one reducer queues the merge
+    if not claim_marker(storage, OUTPUT_CONTAINER, f"{job_tag}/{FOLLOW_UP_MARKER}"):
+        return None
+    return _merge_message(job_tag, parent[parent_job_type]["outputFiles"])
+
+
+def run_follow_up(storage: StorageBackend, job_tag: str, send: Callable[[], None]):
+    """Queue the follow-up from reduce_subjobs with send.
+
+    The follow-up is only recorded as queued, so never queued again, once
+    send returns; if it raises, the retry of the status event can queue it.
+    """
+    run_claimed(storage, OUTPUT_CONTAINER, [f"{job_tag}/{FOLLOW_UP_MARKER}"], send)
+
+
+def parse_subjob_status_name(name: str) -> Optional[Dict[str, str]]:
+    """Split 'outputs/{date}/{job_id}/{subjob}/{job_type}-status.json'.
+
+    :return: None for any other blob, like the status of a job itself
+    """
+    split = name.split("/")
+    if split[0] == OUTPUT_CONTAINER:
+        split = split[1:]
+    if len(split) != 4 or not split[3].endswith("-status.json"):
+        return None
+    date, job_id, subjob, file_name = split
+    return {
+        "job_tag": f"{date}/{job_id}",
+        "subjob": subjob,
+        "job_type": file_name[: -len("-status.json")],
+    }
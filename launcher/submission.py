@@ -0,0 +1,277 @@
+"""Turn a submitted job form into a status file and a queue message."""
+
+from dataclasses import dataclass, field
+from time import time
+from typing import Dict, List, Optional, Tuple, Union
+import asyncio
+import logging
+
+from .apbs import APBSRunner
+from .input_store import input_store_enabled, store_inputs
+from .pdb_mirror import pdb_mirror_enabled, use_pdb_mirror
+from .jobsetup import MissingFilesError
+from .pdb2pqr import PDB2PQRRunner
+from .runtime_estimator import (
+    JobFeatures,
+    RuntimeModel,
+    estimate_max_runtime,
+    get_runtime_model,
+)
+from .storage import StorageBackend
+
+# Container/bucket names used throughout the function app
+INPUT_CONTAINER = "inputs"
+OUTPUT_CONTAINER = "outputs"
+
+# Used when a runner does not provide an estimate of its own
+DEFAULT_MAX_RUNTIME = 2000
+
+JOB_TYPES = ("apbs", "pdb2pqr")
+
+
+def parse_job_blob_name(name: str) -> Tuple[str, str, str, str]:
+    """Split a '{date}/{job_id}/{jobtype}-job.json' blob name.
+
+    :return: the job date, job ID, file name and job type
+    """
+    split = name.split("/")
+    job_id, file_name = split[-2:]
+    date = split[-3]
+    job_type = split[-1].split("-")[0]
+    return date, job_id, file_name, job_type
+
+
+def build_status_dict(
+    job_id: str,
+    job_tag: str,
+    job_type: str,
+    status: str,
+    inputfile_list: list,
+    outputfile_list: list,
+    message: str = "",
+) -> dict:
+    """Build a dictionary for the initial status
+
+    :param job_id str: Identifier string for specific job
+    :param job_type str: Name of job type (e.g. 'apbs', 'pdb2pqr')
+    :param status str: A string indicating initial status of job
+    :param inputfile_list list: List of current input files
+    :param outputfile_list list: List of current output files
+    :param message: Optional message to add to status
+    :type message: optional
+
+    :return: a JSON-compatible dictionary containing initial status
+             info of the job
+    :rtype: dict
+    """
+
+    # TODO: 2021/03/02, Elvis - add submission time to initial status
+    # TODO: 2021/03/25, Elvis - Reconstruct format of status since
+    #                           they're constructed on a per-job basis
+
+    initial_status_dict = {
+        "jobid": job_id,
+        "jobtype": job_type,
+        job_type: {
+            "status": status,
+            "startTime": time(),
+            "endTime": None,
+            "subtasks": [],
+            "inputFiles": inputfile_list,
+            "outputFiles": outputfile_list,
+        },
+        "metadata": {"versions": {}},
+    }
+
+    # if message is not None:
+    if status == "invalid":
+        initial_status_dict[job_type]["message"] = message
+        initial_status_dict[job_type]["startTime"] = None
+        initial_status_dict[job_type]["subtasks"] = None
+        initial_status_dict[job_type]["inputFiles"] = None
+        initial_status_dict[job_type]["outputFiles"] = None
+
+    logging.info(f"{job_tag} Initial Status: {initial_status_dict}")
+    return initial_status_dict
+
+
+@dataclass
+class JobSubmission:
+    """Result of preparing a single job for the queue."""
+
+    job_id: str
+    job_date: str
+    job_type: str
+    status: str = "pending"
+    message: str = ""
+    command_line_args: str = ""
+    input_files: List[str] = field(default_factory=list)
+    input_manifest: Dict[str, dict] = field(default_factory=dict)
+    output_files: List[str] = field(default_factory=list)
+    timeout_seconds: int = 0
+    runtime_features: Optional[JobFeatures] = None
+    # True when timeout_seconds came from the runtime model
+    runtime_estimated: bool = False
+    # Queue messages of the subjobs to send instead of queue_message()
+    child_messages: List[dict] = field(default_factory=list)
+    # Identifies the result for the PDB2PQR result cache
+    cache_key: str = ""
+    # Job whose cached result completed this one
+    cached_from: str = ""
+    runner: Optional[Union[APBSRunner, PDB2PQRRunner]] = None
+
+    @property
+    def job_tag(self) -> str:
+        return f"{self.job_date}/{self.job_id}"
+
+    @property
+    def status_object(self) -> str:
+        return f"{self.job_tag}/{self.job_type}-status.json"
+
+    @property
+    def should_queue(self) -> bool:
+        return self.status not in ("invalid", "failed", "complete")
+
+    def status_dict(self) -> dict:
+        status = build_status_dict(
+            self.job_id,
+            self.job_tag,
+            self.job_type,
+            self.status,
+            self.input_files,
+            self.output_files,
+            self.message,
+        )
+        if (
+            self.runtime_features is not None
+            and self.should_queue
+            and not self.child_messages
+        ):
+            # Kept so the runtime estimator can learn from the finished job.
+            # Not for jobs run as subjobs: their duration is not one job's
+            status["metadata"]["runtimeFeatures"] = self.runtime_features.to_dict()
+        if self.cache_key:
+            status["metadata"]["resultCacheKey"] = self.cache_key
+        if self.cached_from:
+            status["metadata"]["cachedFrom"] = self.cached_from
+            status[self.job_type]["endTime"] = time()
+        return status
+
+    def queue_message(self) -> dict:
+        timeout_seconds = self.timeout_seconds
+        if timeout_seconds == 0:
+            timeout_seconds = DEFAULT_MAX_RUNTIME
+        message = {
+            "job_date": self.job_date,
+            "job_id": self.job_id,
+            "job_tag": self.job_tag,
+            "job_type": self.job_type,
+            # TODO: change this to container
+            "bucket_name": INPUT_CONTAINER,
+            "input_files": self.input_files,
+            "command_line_args": self.command_line_args,
+            "max_run_time": timeout_seconds,
+        }
+        if self.input_manifest:
+            message["input_manifest"] = self.input_manifest
+        return message
+
+    def _collect(self, model: Optional[RuntimeModel] = None):
+        """Copy the file lists and runtime estimate from the runner."""
+        if self.runner is None:
+            return
+        self.input_files = self.runner.input_files
+        self.input_manifest = self.runner.input_manifest
+        self.output_files = self.runner.output_files
+        self.runtime_features = self.runner.runtime_features()
+        self.runtime_estimated = model is not None and model.covers(
+            self.runtime_features
+        )
+        self.timeout_seconds = estimate_max_runtime(
+            self.runtime_features, self.runner.estimated_max_runtime, model
+        )
+        logging.info(f"{self.job_tag} Max run time: {self.timeout_seconds}s")
+
+
+def create_submission(
+    job_type: str,
+    form: dict,
+    job_id: str,
+    job_date: str,
+    storage: Optional[StorageBackend] = None,
+) -> JobSubmission:
+    """Create a submission and its job runner, without touching storage."""
+    submission = JobSubmission(job_id, job_date, job_type)
+    if job_type == "pdb2pqr":
+        logging.info("Running PDB2PQR job")
+        submission.runner = PDB2PQRRunner(form, job_id, job_date, storage)
+    elif job_type == "apbs":
+        logging.info("Running APBS job")
+        submission.runner = APBSRunner(form, job_id, job_date, storage)
+    else:
+        submission.status = "invalid"
+        submission.message = "Invalid job type"
+        logging.error(f"{submission.job_tag} Invalid job type: {job_type}")
+    return submission
+
+
+def _missing_files(submission: JobSubmission, err: MissingFilesError):
+    logging.error(f"{submission.job_tag} Error preparing APBS job: {err}")
+    submission.status = "failed"
+    submission.message = f"Files specified byut not found: {err.missing_files}"
+
+
+def prepare_submission(
+    job_type: str,
+    form: dict,
+    job_id: str,
+    job_date: str,
+    storage: Optional[StorageBackend] = None,
+) -> JobSubmission:
+    """Validate a job form and stage its files for the queue."""
+    submission = create_submission(job_type, form, job_id, job_date, storage)
+    runner = submission.runner
+    if isinstance(runner, PDB2PQRRunner):
+        submission.command_line_args = runner.prepare_job()
+    elif isinstance(runner, APBSRunner):
+        try:
+            submission.command_line_args = runner.prepare_job(
+                OUTPUT_CONTAINER, INPUT_CONTAINER
+            )
+        except MissingFilesError as err:
+            _missing_files(submission, err)
+    if runner is not None and submission.should_queue and pdb_mirror_enabled():
+        use_pdb_mirror(runner, INPUT_CONTAINER)
+    if runner is not None and submission.should_queue and input_store_enabled():
+        store_inputs(runner, INPUT_CONTAINER)
+    if runner is not None:
+        submission._collect(get_runtime_model(runner.storage))
+    return submission
+
+
+async def prepare_submission_async(
+    job_type: str,
+    form: dict,
+    job_id: str,
+    job_date: str,
+    storage: Optional[StorageBackend] = None,
+) -> JobSubmission:
+    """Asyncio version of prepare_submission."""
+    submission = create_submission(job_type, form, job_id, job_date, storage)
+    runner = submission.runner
+    if isinstance(runner, PDB2PQRRunner):
+        submission.command_line_args = await runner.prepare_job_async()
+    elif isinstance(runner, APBSRunner):
+        try:
+            submission.command_line_args = await runner.prepare_job_async(
+                OUTPUT_CONTAINER, INPUT_CONTAINER
+            )
+        except MissingFilesError as err:
+            _missing_files(submission, err)
+    if runner is not None and submission.should_queue and pdb_mirror_enabled():
+        await asyncio.to_thread(use_pdb_mirror, runner, INPUT_CONTAINER)
+    if runner is not None and submission.should_queue and input_store_enabled():
+        await asyncio.to_thread(store_inputs, runner, INPUT_CONTAINER)
+    if runner is not None:
+        submission._collect(await asyncio.to_thread(get_runtime_model, runner.storage))
+    return submission
@@ -0,0 +1,373 @@
+"""Parameter sweeps: one submission that runs a job for each set of values.
+
+A sweep is submitted as 'inputs/{date}/{job_id}/sweep-job.json' with:
+
+    {"form": {"job_type": "apbs" | "pdb2pqr",
+              "form": <the usual job form>,
+              "parameters": {"PH": {"start": 4, "stop": 9, "step": 0.5},
+                             "sdie": [40, 78.54]}}}
+
+The base form is prepared once, as the parent job, so the uploaded files
+are sanitized/copied a single time. Each combination of parameter values
+then becomes a child job '{date}/{job_id}/child{N}' that reads the parent's
+input files through its input_manifest instead of getting its own copies.
+Only APBS children need an object of their own, the rewritten input file.
+The parent status is rebuilt from the children by the subjob reducer.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from .apbs import APBSRunner
+from .pdb2pqr import PDB2PQRRunner
+from .storage import StorageBackend, get_storage
+from .submission import (
+    INPUT_CONTAINER,
+    JobSubmission,
+    prepare_submission,
+    prepare_submission_async,
+)
+from .subjobs import SUBJOB_KIND_SWEEP, write_subjob_manifest
+from .utils import DEFAULT_COPY_CONCURRENCY, apbs_infile_creator
+from .weboptions import WebOptionsError
+
+SWEEP_JOB_TYPE = "sweep"
+
+DEFAULT_SWEEP_MAX_CHILDREN = 100
+
+# Form fields that may be swept, by job type. The APBS form has three ions,
+# 0 to 2, whose concentrations are only used if the ion is set
+SWEEP_PARAMETERS = {
+    "pdb2pqr": ("PH",),
+    "apbs": (
+        "conc0",
+        "conc1",
+        "conc2",
+        "temp",
+        "sdie",
+        "pdie",
+        "srad",
+        "swin",
+        "sdens",
+    ),
+}
+
+
+def sweeps_enabled() -> bool:
+    return os.getenv("SWEEP_JOBS", "").lower() in ("1", "true")
+
+
+class SweepError(ValueError):
+    """The sweep description in the form is not valid."""
+
+
+def max_children() -> int:
+    value = os.getenv("SWEEP_MAX_CHILDREN")
+    if not value:
+        return DEFAULT_SWEEP_MAX_CHILDREN
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning(
+            f"Invalid SWEEP_MAX_CHILDREN '{value}', using {DEFAULT_SWEEP_MAX_CHILDREN}"
+        )
+        return DEFAULT_SWEEP_MAX_CHILDREN
+
+
+def child_name(index: int) -> str:
+    return f"child{index}"
+
+
+def _format_value(value: float) -> str:
+    # Avoid '7.000000000000001' from accumulated float steps
+    return f"{round(value, 10):g}"
+
+
+def expand_values(name: str, spec: Union[list, dict]) -> List[str]:
+    """Values of one parameter, from a list or an inclusive start/stop/step range."""
+    if isinstance(spec, list):
+        if not spec:
+            raise SweepError(f"No values given for {name}")
+        return [str(value) for value in spec]
+    if not isinstance(spec, dict):
+        raise SweepError(f"{name} must be a list of values or a start/stop/step range")
+    try:
+        start = float(spec["start"])
+        stop = float(spec["stop"])
+        step = float(spec["step"])
+    except (KeyError, TypeError, ValueError):
+        raise SweepError(f"{name} needs numeric start, stop and step values")
+    if step <= 0 or stop < start:
+        raise SweepError(f"{name} needs start <= stop and a positive step")
+    count = int((stop - start) / step + 1e-9) + 1
+    return [_format_value(start + index * step) for index in range(count)]
+
+
+def expand_parameters(job_type: str, parameters: dict) -> List[Dict[str, str]]:
+    """Every combination of the swept values, as form overrides."""
+    allowed = SWEEP_PARAMETERS.get(job_type)
+    if allowed is None:
+        raise SweepError(f"Sweeps of {job_type} jobs are not supported")
+    if not isinstance(parameters, dict) or not parameters:
+        raise SweepError("No sweep parameters given")
+    unknown = [name for name in parameters if name not in allowed]
+    if unknown:
+        raise SweepError(f"Parameters cannot be swept: {', '.join(unknown)}")
+
+    names = list(parameters)
+    values = [expand_values(name, parameters[name]) for name in names]
+    count = 1
+    for parameter_values in values:
+        count *= len(parameter_values)
+    limit = max_children()
+    if count > limit:
+        raise SweepError(f"Sweep has {count} combinations, the limit is {limit}")
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def _parse_sweep(form: dict) -> Tuple[str, dict, List[Dict[str, str]]]:
+    try:
+        job_type = form["job_type"]
+        base_form = form["form"]
+        parameters = form["parameters"]
+    except (KeyError, TypeError):
+        raise SweepError("A sweep needs job_type, form and parameters")
+    if not isinstance(base_form, dict):
+        raise SweepError("The sweep form must be a job form")
+    if job_type == "apbs" and "filename" in base_form:
+        raise SweepError("Sweeps need an APBS form, not an input file")
+    if job_type == "pdb2pqr" and base_form.get("invoke_method", "gui").lower() not in (
+        "gui",
+        "v1",
+    ):
+        raise SweepError("Sweeps need a PDB2PQR web form")
+    combinations = expand_parameters(job_type, parameters)
+    if job_type == "apbs":
+        _check_ions(base_form, parameters)
+    return job_type, base_form, combinations
+
+
+def _check_ions(base_form: dict, parameters: dict):
+    """Concentrations can only be swept for ions set in the base form."""
+    for name in parameters:
+        if not name.startswith("conc"):
+            continue
+        ion = name[len("conc") :]
+        if not (base_form.get(f"charge{ion}") and base_form.get(f"radius{ion}")):
+            raise SweepError(f"Sweeping {name} needs charge{ion} and radius{ion}")
+
+
+def _parent_source(parent: JobSubmission, object_name: str) -> dict:
+    """Where the parent's copy of an input object actually lives."""
+    return parent.input_manifest.get(
+        object_name, {"container": INPUT_CONTAINER, "object": object_name}
+    )
+
+
+def _child_message(
+    parent: JobSubmission, child: JobSubmission, own_objects: Set[str]
+) -> dict:
+    """Queue message for a child, reading the parent's inputs by reference."""
+    child_tag = child.job_tag
+    manifest = dict(child.input_manifest)
+    for input_file in child.input_files:
+        if input_file in own_objects or not input_file.startswith(f"{child_tag}/"):
+            # URLs, and objects written for the child itself
+            continue
+        parent_object = f"{parent.job_tag}/{input_file[len(child_tag) + 1:]}"
+        manifest[input_file] = _parent_source(parent, parent_object)
+
+    message = child.queue_message()
+    message.update(
+        {
+            "job_date": parent.job_date,
+            "job_id": f"{parent.job_id}/{child.job_id}",
+            "parent_job_tag": parent.job_tag,
+        }
+    )
+    if manifest:
+        message["input_manifest"] = manifest
+    return message
+
+
+def _pdb2pqr_child(
+    parent: JobSubmission, name: str, child_form: dict
+) -> Tuple[JobSubmission, None]:
+    child = JobSubmission(name, parent.job_tag, "pdb2pqr")
+    runner = PDB2PQRRunner(child_form, name, parent.job_tag, parent.runner.storage)
+    # The sanitized copies were made once, for the parent
+    child.command_line_args = runner._set_command_line_args(runner.version_1_job(name))
+    child.runner = runner
+    return child, None
+
+
+def _apbs_child(
+    parent: JobSubmission, name: str, child_form: dict
+) -> Tuple[JobSubmission, Tuple[str, str]]:
+    child = JobSubmission(name, parent.job_tag, "apbs")
+    runner = APBSRunner(child_form, name, parent.job_tag, parent.runner.storage)
+    parent_options = parent.runner.apbs_options
+    apbs_options = runner.apbs_options
+    apbs_options["pqrFileName"] = parent_options["pqrFileName"]
+    apbs_options["tempFile"] = parent_options["tempFile"]
+    runner.pqr_atom_count = parent.runner.pqr_atom_count
+    infile = (
+        f"{child.job_tag}/{apbs_options['tempFile']}",
+        apbs_infile_creator(child.job_tag, apbs_options),
+    )
+    # The PQR file is the parent's, with any waters already removed
+    runner.add_input_file(apbs_options["pqrFileName"])
+    runner.add_input_file(apbs_options["tempFile"])
+    runner.command_line_args = apbs_options["tempFile"]
+    child.command_line_args = runner.command_line_args
+    child.runner = runner
+    return child, infile
+
+
+def _build_children(
+    parent: JobSubmission, base_form: dict, overrides: List[Dict[str, str]]
+) -> Tuple[List[JobSubmission], List[Tuple[str, str]]]:
+    build = _apbs_child if parent.job_type == "apbs" else _pdb2pqr_child
+    children = []
+    infiles = []
+    for index, override in enumerate(overrides):
+        child, infile = build(parent, child_name(index), dict(base_form, **override))
+        child.input_files = child.runner.input_files
+        child.input_manifest = child.runner.input_manifest
+        child.runtime_features = child.runner.runtime_features()
+        # Same inputs as the parent, so the same runtime
+        child.timeout_seconds = parent.timeout_seconds
+        children.append(child)
+        if infile is not None:
+            infiles.append(infile)
+    return children, infiles
+
+
+def _invalid(submission: JobSubmission, message: str) -> JobSubmission:
+    logging.error(f"{submission.job_tag} Invalid sweep: {message}")
+    submission.status = "invalid"
+    submission.message = message
+    return submission
+
+
+def _finish(
+    storage: StorageBackend,
+    sweep: JobSubmission,
+    parent: JobSubmission,
+    children: List[JobSubmission],
+    overrides: List[Dict[str, str]],
+    infiles: List[Tuple[str, str]],
+) -> JobSubmission:
+    names = [child.job_id for child in children]
+    write_subjob_manifest(
+        storage,
+        sweep,
+        SUBJOB_KIND_SWEEP,
+        names,
+        {"parameters": dict(zip(names, overrides))},
+        job_type=parent.job_type,
+    )
+    sweep.input_files = parent.input_files
+    sweep.runtime_features = parent.runtime_features
+    sweep.runtime_estimated = parent.runtime_estimated
+    sweep.timeout_seconds = parent.timeout_seconds
+    sweep.runner = parent.runner
+    own_objects = {object_name for object_name, _ in infiles}
+    sweep.child_messages = [
+        _child_message(parent, child, own_objects) for child in children
+    ]
+    return sweep
+
+
+def _start(
+    form: dict, job_id: str, job_date: str
+) -> Tuple[JobSubmission, str, dict, List[Dict[str, str]]]:
+    sweep = JobSubmission(job_id, job_date, SWEEP_JOB_TYPE)
+    try:
+        job_type, base_form, overrides = _parse_sweep(form)
+    except SweepError as err:
+        _invalid(sweep, str(err))
+        return sweep, "", {}, []
+    logging.info(f"{sweep.job_tag} Sweep of {len(overrides)} {job_type} jobs")
+    return sweep, job_type, base_form, overrides
+
+
+def _copy_failure(sweep: JobSubmission, parent: JobSubmission) -> JobSubmission:
+    sweep.status = parent.status
+    sweep.message = parent.message
+    return sweep
+
+
+def prepare_sweep(
+    form: dict,
+    job_id: str,
+    job_date: str,
+    storage: Optional[StorageBackend] = None,
+) -> JobSubmission:
+    """Prepare the parent job once and a queue message for every child."""
+    if storage is None:
+        storage = get_storage()
+    sweep, job_type, base_form, overrides = _start(form, job_id, job_date)
+    if not sweep.should_queue:
+        return sweep
+    try:
+        parent = prepare_submission(
+            job_type, dict(base_form), job_id, job_date, storage
+        )
+        if not parent.should_queue:
+            return _copy_failure(sweep, parent)
+        children, infiles = _build_children(parent, base_form, overrides)
+    except WebOptionsError as err:
+        return _invalid(sweep, str(err))
+
+    with ThreadPoolExecutor(max_workers=DEFAULT_COPY_CONCURRENCY) as executor:
+        list(
+            executor.map(
+                lambda infile: storage.put_object(
+                    INPUT_CONTAINER, infile[0], infile[1].encode("utf-8")
+                ),
+                infiles,
+            )
+        )
+    return _finish(storage, sweep, parent, children, overrides, infiles)
+
+
+async def prepare_sweep_async(
+    form: dict,
+    job_id: str,
+    job_date: str,
+    storage: Optional[StorageBackend] = None,
+) -> JobSubmission:
+    """Asyncio version of prepare_sweep."""
+    if storage is None:
+        storage = get_storage()
+    sweep, job_type, base_form, overrides = _start(form, job_id, job_date)
+    if not sweep.should_queue:
+        return sweep
+    try:
+        parent = await prepare_submission_async(
+            job_type, dict(base_form), job_id, job_date, storage
+        )
+        if not parent.should_queue:
+            return _copy_failure(sweep, parent)
+        children, infiles = _build_children(parent, base_form, overrides)
+    except WebOptionsError as err:
+        return _invalid(sweep, str(err))
+
+    async_storage = storage.to_async()
+    semaphore = asyncio.Semaphore(DEFAULT_COPY_CONCURRENCY)
+
+    async def _upload(infile: Tuple[str, str]):
+        async with semaphore:
+            await async_storage.put_object(
+                INPUT_CONTAINER, infile[0], infile[1].encode("utf-8")
+            )
+
+    await asyncio.gather(*(_upload(infile) for infile in infiles))
+    return await asyncio.to_thread(
+        _finish, storage, sweep, parent, children, overrides, infiles
+    )
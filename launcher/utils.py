@@ -1,8 +1,19 @@
+import asyncio
+import codecs
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+)
 from io import StringIO
 
-from .azure_storage_utils import AzureUtils
+from .storage import AsyncStorageBackend, StorageBackend, get_storage
 import logging
 from re import split
 
@@ -18,13 +29,236 @@ class AzureCopyObject:
         if self.dest_container is None:
             self.dest_container = self.source_container
 
-    def copy_object(self):
-        return AzureUtils.copy_object(
+    def copy_object(self, storage: Optional[StorageBackend] = None):
+        if storage is None:
+            storage = get_storage()
+        return storage.copy_object(
             container_name=self.source_container,
             src=self.source_object,
             dest=self.dest_object,
+            dest_container=self.dest_container,
         )
 
+    async def copy_object_async(self, storage: Optional[AsyncStorageBackend] = None):
+        if storage is None:
+            storage = get_storage().to_async()
+        return await storage.copy_object(
+            container_name=self.source_container,
+            src=self.source_object,
+            dest=self.dest_object,
+            dest_container=self.dest_container,
+        )
+
+
+@dataclass
+class AzureCopyResult:
+    payload: AzureCopyObject
+    error: Optional[Exception] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+# Upper bound on the number of copies in flight for a single job
+DEFAULT_COPY_CONCURRENCY = 8
+
+
+def copy_objects(
+    job_tag: str,
+    payloads: Iterable[AzureCopyObject],
+    max_workers: int = DEFAULT_COPY_CONCURRENCY,
+    storage: Optional[StorageBackend] = None,
+) -> List[AzureCopyResult]:
+    """Copy a batch of objects concurrently.
+
+    Args:
+        job_tag (str): Tag of the job the copies belong to, used for logging
+        payloads (Iterable[AzureCopyObject]): Objects to copy
+        max_workers (int): Maximum number of copies running at once
+        storage (StorageBackend): Backend to copy in, defaults to get_storage()
+
+    Returns:
+        List[AzureCopyResult]: One result per payload, in the order given
+    """
+    payloads = list(payloads)
+    if not payloads:
+        return []
+
+    def _copy(payload: AzureCopyObject) -> AzureCopyResult:
+        _log_copy(job_tag, payload)
+        try:
+            payload.copy_object(storage)
+        except Exception as err:
+            _log_copy_error(job_tag, payload, err)
+            return AzureCopyResult(payload, err)
+        return AzureCopyResult(payload)
+
+    workers = max(1, min(max_workers, len(payloads)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_copy, payloads))
+
+
+async def copy_objects_async(
+    job_tag: str,
+    payloads: Iterable[AzureCopyObject],
+    max_workers: int = DEFAULT_COPY_CONCURRENCY,
+    storage: Optional[AsyncStorageBackend] = None,
+) -> List[AzureCopyResult]:
+    """Asyncio version of copy_objects."""
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def _copy(payload: AzureCopyObject) -> AzureCopyResult:
+        async with semaphore:
+            _log_copy(job_tag, payload)
+            try:
+                await payload.copy_object_async(storage)
+            except Exception as err:
+                _log_copy_error(job_tag, payload, err)
+                return AzureCopyResult(payload, err)
+            return AzureCopyResult(payload)
+
+    return list(await asyncio.gather(*(_copy(payload) for payload in payloads)))
+
+
+def _log_copy(job_tag: str, payload: AzureCopyObject):
+    logging.info(
+        "%s Copying original object '%s' to sanitized object name '%s' (bucket: %s)",
+        job_tag,
+        payload.source_object,
+        payload.dest_object,
+        payload.source_container,
+    )
+
+
+def _log_copy_error(job_tag: str, payload: AzureCopyObject, err: Exception):
+    logging.error(
+        "%s Failed to copy '%s' to '%s': %s",
+        job_tag,
+        payload.source_object,
+        payload.dest_object,
+        err,
+    )
+
+
+# Lines are re-encoded into blocks of about this size before uploading
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+
+class LineSplitter:
+    """Incrementally decode byte chunks and split them into lines.
+
+    Lines keep their trailing newline character and are split on it only,
+    the same way iterating over a StringIO does.
+    """
+
+    def __init__(self, encoding: str = "utf-8"):
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._pending = ""
+
+    def feed(self, chunk: bytes) -> List[str]:
+        text = self._pending + self._decoder.decode(chunk)
+        *lines, self._pending = text.split("\n")
+        return [f"{line}\n" for line in lines]
+
+    def close(self) -> List[str]:
+        rest = self._pending + self._decoder.decode(b"", final=True)
+        self._pending = ""
+        return [rest] if rest else []
+
+
+class LineEncoder:
+    """Encode lines into byte blocks of roughly STREAM_BLOCK_SIZE."""
+
+    def __init__(self, encoding: str = "utf-8", block_size: int = STREAM_BLOCK_SIZE):
+        self._encoding = encoding
+        self._block_size = block_size
+        self._buffer: List[bytes] = []
+        self._size = 0
+
+    def feed(self, line: str) -> Optional[bytes]:
+        data = line.encode(self._encoding)
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self._block_size:
+            return self.close()
+        return None
+
+    def close(self) -> Optional[bytes]:
+        if not self._buffer:
+            return None
+        block = b"".join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        return block
+
+
+def filter_lines(
+    chunks: Iterable[bytes], keep_line: Callable[[str], bool]
+) -> Iterator[bytes]:
+    """Stream byte chunks through a line filter, yielding byte blocks."""
+    splitter = LineSplitter()
+    encoder = LineEncoder()
+    for chunk in chunks:
+        for line in splitter.feed(chunk):
+            if keep_line(line) and (block := encoder.feed(line)) is not None:
+                yield block
+    for line in splitter.close():
+        if keep_line(line) and (block := encoder.feed(line)) is not None:
+            yield block
+    if (block := encoder.close()) is not None:
+        yield block
+
+
+async def filter_lines_async(
+    chunks: AsyncIterable[bytes], keep_line: Callable[[str], bool]
+) -> AsyncIterator[bytes]:
+    """Asyncio version of filter_lines."""
+    splitter = LineSplitter()
+    encoder = LineEncoder()
+    async for chunk in chunks:
+        for line in splitter.feed(chunk):
+            if keep_line(line) and (block := encoder.feed(line)) is not None:
+                yield block
+    for line in splitter.close():
+        if keep_line(line) and (block := encoder.feed(line)) is not None:
+            yield block
+    if (block := encoder.close()) is not None:
+        yield block
+
+
+def stream_object(
+    storage: StorageBackend,
+    source_container: str,
+    source_object: str,
+    dest_container: str,
+    dest_object: str,
+    keep_line: Optional[Callable[[str], bool]] = None,
+):
+    """Pipe an object to a new location with bounded memory.
+
+    If keep_line is given, only the lines it accepts are written.
+    """
+    chunks = storage.iter_chunks(source_container, source_object)
+    if keep_line is not None:
+        chunks = filter_lines(chunks, keep_line)
+    storage.upload_stream(dest_container, dest_object, chunks)
+
+
+async def stream_object_async(
+    storage: AsyncStorageBackend,
+    source_container: str,
+    source_object: str,
+    dest_container: str,
+    dest_object: str,
+    keep_line: Optional[Callable[[str], bool]] = None,
+):
+    """Asyncio version of stream_object."""
+    chunks = storage.iter_chunks(source_container, source_object)
+    if keep_line is not None:
+        chunks = filter_lines_async(chunks, keep_line)
+    await storage.upload_stream(dest_container, dest_object, chunks)
+
 
 def sanitize_file_name(job_tag: str, file_name: str):
     """Make sure that a file name does not have any special characters in it.
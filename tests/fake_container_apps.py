@@ -0,0 +1,89 @@
+"""In-memory stand-in for ContainerAppsAPIClient, for the scheduler tests.
+
+Only the calls the launcher makes are implemented: jobs.get,
+jobs.begin_start and jobs_executions.list.
+"""
+
+import itertools
+import threading
+from dataclasses import dataclass
+from typing import List
+
+
+@dataclass
+class FakeJobExecution:
+    name: str
+    status: str = "Running"
+
+
+class FakePoller:
+    def __init__(self, execution: FakeJobExecution):
+        self.execution = execution
+
+    def status(self) -> str:
+        return "Succeeded"
+
+    def done(self) -> bool:
+        return True
+
+    def result(self, timeout=None) -> FakeJobExecution:
+        return self.execution
+
+
+class _FakeJobs:
+    def __init__(self, client: "FakeContainerAppsClient"):
+        self._client = client
+
+    def get(self, resource_group_name: str, job_name: str) -> dict:
+        return {"resource_group_name": resource_group_name, "name": job_name}
+
+    def begin_start(self, resource_group_name: str, job_name: str) -> FakePoller:
+        return FakePoller(self._client.add_execution(job_name))
+
+
+class _FakeJobsExecutions:
+    def __init__(self, client: "FakeContainerAppsClient"):
+        self._client = client
+
+    def list(
+        self, resource_group_name: str, job_name: str, filter=None
+    ) -> List[FakeJobExecution]:
+        with self._client._lock:
+            return list(self._client.executions)
+
+
+class FakeContainerAppsClient:
+    """Records every start and lets callers finish executions by hand."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self.executions: List[FakeJobExecution] = []
+        self.jobs = _FakeJobs(self)
+        self.jobs_executions = _FakeJobsExecutions(self)
+
+    @property
+    def start_count(self) -> int:
+        with self._lock:
+            return len(self.executions)
+
+    @property
+    def active_count(self) -> int:
+        with self._lock:
+            return sum(1 for e in self.executions if e.status == "Running")
+
+    def add_execution(self, job_name: str, status: str = "Running") -> FakeJobExecution:
+        with self._lock:
+            execution = FakeJobExecution(f"{job_name}-{next(self._counter)}", status)
+            self.executions.append(execution)
+            return execution
+
+    def finish(self, count: int = 1, status: str = "Succeeded"):
+        """Move the oldest running executions to a finished state."""
+        with self._lock:
+            for execution in self.executions:
+                if count <= 0:
+                    break
+                if execution.status == "Running":
+                    execution.status = status
+                    count -= 1
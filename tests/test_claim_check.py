@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+from launcher.claim_check import CLAIM_CHECK_PREFIX, decode_message, encode_message
+from launcher.storage import MemoryStorage
+
+
+@pytest.fixture(autouse=True)
+def plain_messages(monkeypatch):
+    monkeypatch.delenv("QUEUE_CLAIM_CHECK", raising=False)
+    monkeypatch.delenv("QUEUE_CLAIM_CHECK_THRESHOLD", raising=False)
+    monkeypatch.delenv("QUEUE_MESSAGE_ENCODING", raising=False)
+
+
+def _message(files=200):
+    return {
+        "job_date": "d",
+        "job_id": "abc",
+        "job_tag": "d/abc",
+        "job_type": "apbs",
+        "input_files": [f"d/abc/map{index:04d}.dx" for index in range(files)],
+        "command_line_args": "abc.in",
+        "max_run_time": 2700,
+    }
+
+
+def test_plain_message_is_unchanged():
+    message = _message()
+    body = encode_message(message, MemoryStorage())
+    assert json.loads(body) == message
+    assert decode_message(body) == message
+
+
+def test_large_message_is_sent_as_a_claim_check(monkeypatch):
+    monkeypatch.setenv("QUEUE_CLAIM_CHECK", "1")
+    monkeypatch.setenv("QUEUE_CLAIM_CHECK_THRESHOLD", "1000")
+    storage = MemoryStorage()
+    message = _message()
+    body = encode_message(message, storage)
+    pointer = json.loads(body)
+    assert len(body) < 1000
+    assert pointer["job_tag"] == "d/abc"
+    assert pointer["max_run_time"] == 2700
+    object_name = pointer["claim_check"]["object"]
+    assert object_name.startswith(f"{CLAIM_CHECK_PREFIX}/")
+    assert storage.object_exists("inputs", object_name)
+    assert decode_message(body, storage) == message
+
+    # Small messages are still sent whole
+    small = _message(files=1)
+    assert decode_message(encode_message(small, storage)) == small
+
+
+def test_tampered_claim_check_is_rejected(monkeypatch):
+    monkeypatch.setenv("QUEUE_CLAIM_CHECK", "1")
+    monkeypatch.setenv("QUEUE_CLAIM_CHECK_THRESHOLD", "1000")
+    storage = MemoryStorage()
+    body = encode_message(_message(), storage)
+    object_name = json.loads(body)["claim_check"]["object"]
+    storage.put_object("inputs", object_name, json.dumps(_message(files=1)))
+    with pytest.raises(ValueError):
+        decode_message(body, storage)
+
+
+def test_compact_encoding(monkeypatch):
+    monkeypatch.setenv("QUEUE_MESSAGE_ENCODING", "compact")
+    message = _message()
+    body = encode_message(message, MemoryStorage())
+    assert len(body) < len(json.dumps(message))
+    assert json.loads(body)["encoding"] == "zlib+base64"
+    assert decode_message(body) == message
+
+
+def test_unknown_schema_version_is_rejected():
+    with pytest.raises(ValueError):
+        decode_message(json.dumps({"schema_version": 99}))
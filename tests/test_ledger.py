@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from launcher.ledger import (
+    IDEMPOTENCY_CONTAINER,
+    claim_delivery,
+    claim_marker,
+    run_claimed,
+    submit_claimed,
+)
+from launcher.storage import MemoryStorage
+
+
+@pytest.fixture(autouse=True)
+def default_lease(monkeypatch):
+    monkeypatch.delenv("IDEMPOTENCY_LEASE", raising=False)
+
+
+def _marker(storage, object_name):
+    return json.loads(storage.download_file_str(IDEMPOTENCY_CONTAINER, object_name))
+
+
+def _fail():
+    raise RuntimeError("queue is unavailable")
+
+
+def test_second_claim_is_refused():
+    storage = MemoryStorage()
+    assert claim_marker(storage, "outputs", "d/abc/marker")
+    assert not claim_marker(storage, "outputs", "d/abc/marker")
+    assert _marker(storage, "d/abc/marker")["state"] == "processing"
+
+
+def test_expired_claim_is_taken_over(monkeypatch):
+    storage = MemoryStorage()
+    storage.put_object(
+        "outputs", "d/abc/marker", json.dumps({"state": "processing", "time": 0})
+    )
+    assert claim_marker(storage, "outputs", "d/abc/marker")
+    assert not claim_marker(storage, "outputs", "d/abc/marker")
+
+    monkeypatch.setenv("IDEMPOTENCY_LEASE", "0")
+    assert claim_marker(storage, "outputs", "d/abc/marker")
+
+
+@pytest.mark.parametrize(
+    "body", [json.dumps({"state": "done", "time": 0}), "", "legacy marker"]
+)
+def test_done_markers_never_expire(monkeypatch, body):
+    monkeypatch.setenv("IDEMPOTENCY_LEASE", "0")
+    storage = MemoryStorage()
+    storage.put_object("outputs", "d/abc/marker", body)
+    assert not claim_marker(storage, "outputs", "d/abc/marker")
+
+
+def test_run_claimed_marks_done():
+    storage = MemoryStorage()
+    assert claim_marker(storage, "outputs", "d/abc/marker")
+    assert run_claimed(storage, "outputs", ["d/abc/marker"], lambda: 42) == 42
+    assert _marker(storage, "d/abc/marker")["state"] == "done"
+
+
+def test_run_claimed_releases_on_error():
+    storage = MemoryStorage()
+    assert claim_marker(storage, "outputs", "d/abc/marker")
+    with pytest.raises(RuntimeError):
+        run_claimed(storage, "outputs", ["d/abc/marker"], _fail)
+    assert not storage.object_exists("outputs", "d/abc/marker")
+    assert claim_marker(storage, "outputs", "d/abc/marker")
+
+
+def test_redelivery_is_suppressed_after_submission():
+    storage = MemoryStorage()
+    claim = claim_delivery(storage, "d/abc", "apbs-job.json", "etag")
+    assert claim is not None
+    # Not submitted yet: a concurrent delivery is still suppressed
+    assert claim_delivery(storage, "d/abc", "apbs-job.json", "etag") is None
+    submit_claimed(storage, [claim], lambda: None)
+    assert _marker(storage, claim.object_name)["state"] == "done"
+    assert claim_delivery(storage, "d/abc", "apbs-job.json", "etag") is None
+    # A new version of the blob is a new delivery
+    assert claim_delivery(storage, "d/abc", "apbs-job.json", "etag2") is not None
+
+
+def test_failed_submission_can_be_retried():
+    storage = MemoryStorage()
+    claims = [
+        claim_delivery(storage, "d/abc", "apbs-job.json", "etag"),
+        claim_delivery(storage, "d/def", "apbs-job.json", "etag"),
+    ]
+    with pytest.raises(RuntimeError):
+        submit_claimed(storage, claims, _fail)
+    for claim in claims:
+        assert not storage.object_exists(IDEMPOTENCY_CONTAINER, claim.object_name)
+    assert claim_delivery(storage, "d/abc", "apbs-job.json", "etag") == claims[0]
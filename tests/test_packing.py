@@ -0,0 +1,37 @@
+from launcher.packing import BATCH_JOB_TYPE, pack_batches
+
+
+def _message(index, max_run_time=2700):
+    return {
+        "job_tag": f"d/job{index}",
+        "job_type": "apbs",
+        "max_run_time": max_run_time,
+    }
+
+
+def test_jobs_are_packed_up_to_the_job_limit():
+    messages = [_message(index) for index in range(20)]
+    batches = pack_batches(messages, 8, 8 * 2700)
+    assert [len(batch["jobs"]) for batch in batches] == [8, 8, 4]
+    assert all(batch["job_type"] == BATCH_JOB_TYPE for batch in batches)
+    assert batches[2]["max_run_time"] == 4 * 2700
+    # Every job is sent once, in order
+    assert [job for batch in batches for job in batch["jobs"]] == messages
+
+
+def test_single_job_is_sent_unchanged():
+    message = _message(0)
+    assert pack_batches([message], 8, 8 * 2700) == [message]
+
+
+def test_jobs_are_packed_up_to_the_runtime_limit():
+    messages = [_message(0, 3000), _message(1, 3000), _message(2, 1000)]
+    batches = pack_batches(messages, 8, 5000)
+    assert batches[0] == messages[0]
+    assert batches[1]["jobs"] == messages[1:]
+    assert batches[1]["max_run_time"] == 4000
+
+
+def test_long_job_gets_a_batch_of_its_own():
+    messages = [_message(0, 1000), _message(1, 9000), _message(2, 1000)]
+    assert pack_batches(messages, 8, 5000) == messages
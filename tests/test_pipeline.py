@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from launcher.pipeline import advance_pipeline, run_stage
+from launcher.storage import MemoryStorage
+
+
+def _storage(state="failed", pipeline=True):
+    storage = MemoryStorage()
+    storage.put_object(
+        "outputs",
+        "d/abc/pdb2pqr-status.json",
+        json.dumps(
+            {"jobid": "abc", "jobtype": "pdb2pqr", "pdb2pqr": {"status": state}}
+        ),
+    )
+    if pipeline:
+        storage.put_object("inputs", "d/abc/pipeline.json", json.dumps({"form": {}}))
+    return storage
+
+
+def _fail():
+    raise RuntimeError("queue is unavailable")
+
+
+@pytest.mark.parametrize("state", ["pending", "running"])
+def test_unfinished_stage_does_not_advance(state):
+    assert advance_pipeline(_storage(state), "abc", "d") is None
+
+
+def test_plain_pdb2pqr_job_does_not_advance():
+    assert advance_pipeline(_storage(pipeline=False), "abc", "d") is None
+    assert advance_pipeline(MemoryStorage(), "abc", "d") is None
+
+
+def test_stage_advances_once():
+    storage = _storage()
+    submission = advance_pipeline(storage, "abc", "d")
+    assert submission.job_type == "apbs"
+    assert submission.status == "failed"
+    # A status event delivered before the stage is queued
+    assert advance_pipeline(storage, "abc", "d") is None
+
+    run_stage(storage, "d/abc", lambda: None)
+    assert advance_pipeline(storage, "abc", "d") is None
+
+
+def test_stage_advances_again_if_queueing_fails():
+    storage = _storage()
+    assert advance_pipeline(storage, "abc", "d") is not None
+    with pytest.raises(RuntimeError):
+        run_stage(storage, "d/abc", _fail)
+    assert advance_pipeline(storage, "abc", "d") is not None
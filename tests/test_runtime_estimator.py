@@ -0,0 +1,105 @@
+import json
+
+from launcher.runtime_estimator import (
+    MIN_SAMPLES,
+    RUNTIME_HISTORY_OBJECT,
+    RUNTIME_MODEL_CONTAINER,
+    JobFeatures,
+    fit_runtime_model,
+    history_record,
+    record_runtime,
+)
+from launcher.storage import MemoryStorage
+
+
+def _records(count):
+    records = []
+    for index in range(count):
+        grid_points = 1000 * (index % 5 + 1)
+        atom_count = 500 * (index % 4 + 1)
+        records.append(
+            {
+                "features": JobFeatures(
+                    "apbs",
+                    calc_type="mg-auto",
+                    grid_points=grid_points,
+                    atom_count=atom_count,
+                ).to_dict(),
+                "duration": 0.01 * grid_points + 0.02 * atom_count,
+            }
+        )
+        records.append(
+            {
+                "features": JobFeatures("pdb2pqr", atom_count=atom_count).to_dict(),
+                "duration": 0.05 * atom_count,
+            }
+        )
+    return records
+
+
+def _status(job_type="apbs", start=100.0, end=400.0):
+    return {
+        "jobid": "abc",
+        "jobtype": job_type,
+        job_type: {"status": "complete", "startTime": start, "endTime": end},
+        "metadata": {"runtimeFeatures": JobFeatures(job_type).to_dict()},
+    }
+
+
+def test_too_few_records_are_not_fitted():
+    records = _records(MIN_SAMPLES)[: MIN_SAMPLES - 1]
+    assert fit_runtime_model(records) is None
+    # Unusable records are not counted
+    records += [{"features": {"job_type": "apbs"}, "duration": 0}, {}]
+    assert fit_runtime_model(records) is None
+
+
+def test_fitted_model_follows_the_history():
+    model = fit_runtime_model(_records(MIN_SAMPLES))
+    assert model.samples == 2 * MIN_SAMPLES
+    assert model.covers(JobFeatures("apbs"))
+    assert model.covers(JobFeatures("pdb2pqr"))
+    assert not model.covers(JobFeatures("sweep"))
+    small = model.predict_seconds(JobFeatures("apbs", "mg-auto", 1000, 1, 500))
+    large = model.predict_seconds(JobFeatures("apbs", "mg-auto", 5000, 1, 2000))
+    assert 10 < small < large < 150
+    assert model.max_runtime(JobFeatures("apbs", "mg-auto", 5000, 1, 2000)) >= large
+
+
+def test_history_record():
+    assert history_record(_status()) == {
+        "features": JobFeatures("apbs").to_dict(),
+        "duration": 300.0,
+    }
+    status = _status()
+    status["apbs"]["status"] = "failed"
+    assert history_record(status) is None
+    del status["metadata"]
+    assert history_record(status) is None
+
+
+def test_only_single_container_jobs_are_recorded():
+    assert history_record(_status("sweep")) is None
+    storage = MemoryStorage()
+    storage.put_object(
+        "outputs", "d/abc/sweep-status.json", json.dumps(_status("sweep"))
+    )
+    assert not record_runtime(storage, "d/abc", "sweep")
+    assert not storage.object_exists(RUNTIME_MODEL_CONTAINER, RUNTIME_HISTORY_OBJECT)
+
+
+def test_runtime_is_recorded_once():
+    storage = MemoryStorage()
+    storage.put_object("outputs", "d/abc/apbs-status.json", json.dumps(_status()))
+    storage.put_object(
+        "outputs", "d/def/pdb2pqr-status.json", json.dumps(_status("pdb2pqr"))
+    )
+    assert record_runtime(storage, "d/abc", "apbs")
+    # A redelivered status event
+    assert not record_runtime(storage, "d/abc", "apbs")
+    assert record_runtime(storage, "d/def", "pdb2pqr")
+    assert not record_runtime(storage, "d/missing", "apbs")
+    history = storage.download_file_str(RUNTIME_MODEL_CONTAINER, RUNTIME_HISTORY_OBJECT)
+    records = [json.loads(line) for line in history.splitlines()]
+    assert [record["job"] for record in records] == ["d/abc/apbs", "d/def/pdb2pqr"]
+    assert records[0]["duration"] == 300.0
@@ -0,0 +1,105 @@
+import pytest
+
+from fake_container_apps import FakeContainerAppsClient
+from launcher.container_jobs import ContainerJobSettings
+from launcher.scheduler import ScalingPolicy, StartScheduler, reconcile_executions
+
+SETTINGS = ContainerJobSettings("client-id", "subscription", "group", "apbs-app")
+
+
+@pytest.fixture(autouse=True)
+def wait_for_starts(monkeypatch):
+    monkeypatch.delenv("CONTAINER_JOB_START_MODE", raising=False)
+    monkeypatch.delenv("CONTAINER_JOB_DIAGNOSTICS", raising=False)
+
+
+class _FailingExecutions:
+    def list(self, resource_group_name, job_name, filter=None):
+        raise RuntimeError("listing is not allowed")
+
+
+def _scheduler(client, queue, policy=ScalingPolicy(), window=60):
+    return StartScheduler(
+        window=window,
+        client=client,
+        settings=SETTINGS,
+        policy=policy,
+        queue_depth=lambda: len(queue),
+    )
+
+
+def test_burst_is_coalesced_into_one_decision():
+    client = FakeContainerAppsClient()
+    queue = []
+    scheduler = _scheduler(client, queue, ScalingPolicy(jobs_per_execution=5))
+    for job in range(5):
+        queue.append(job)
+        scheduler.request_start()
+    # The first request is decided at once, the others wait for the window
+    assert client.start_count == 1
+    assert scheduler.flush() == 0
+    assert client.start_count == 1
+
+
+def test_coalesced_requests_start_the_shortfall():
+    client = FakeContainerAppsClient()
+    queue = []
+    scheduler = _scheduler(client, queue)
+    for job in range(4):
+        queue.append(job)
+        scheduler.request_start()
+    assert client.start_count == 1
+    assert scheduler.flush() == 3
+    assert client.active_count == 4
+
+
+def test_first_request_is_not_left_on_the_timer():
+    client = FakeContainerAppsClient()
+    scheduler = _scheduler(client, [], window=3600)
+    # Not yet visible in the queue depth: the request count stands in for it
+    scheduler.request_start()
+    assert client.start_count == 1
+    assert scheduler.flush() == 0
+
+
+def test_no_window_decides_every_request():
+    client = FakeContainerAppsClient()
+    queue = []
+    scheduler = _scheduler(client, queue, window=0)
+    for job in range(3):
+        queue.append(job)
+        scheduler.request_start()
+        assert client.start_count == job + 1
+
+
+def test_policy_caps_executions():
+    client = FakeContainerAppsClient()
+    policy = ScalingPolicy(jobs_per_execution=1, max_executions=3)
+    assert reconcile_executions(client, SETTINGS, policy, 20) == 3
+    assert reconcile_executions(client, SETTINGS, policy, 20) == 0
+    client.finish()
+    assert reconcile_executions(client, SETTINGS, policy, 20) == 1
+    assert client.active_count == 3
+
+
+def test_finished_executions_are_not_counted():
+    client = FakeContainerAppsClient()
+    client.add_execution(SETTINGS.job_name)
+    client.add_execution(SETTINGS.job_name, status="Failed")
+    assert reconcile_executions(client, SETTINGS, ScalingPolicy(), 3) == 2
+
+
+def test_requested_stands_in_for_unknown_queue_depth():
+    client = FakeContainerAppsClient()
+    assert reconcile_executions(client, SETTINGS, ScalingPolicy(), None, 2) == 2
+
+
+def test_listing_failure_assumes_none_running():
+    client = FakeContainerAppsClient()
+    client.add_execution(SETTINGS.job_name)
+    client.jobs_executions = _FailingExecutions()
+    policy = ScalingPolicy(jobs_per_execution=1, max_executions=4)
+    assert reconcile_executions(client, SETTINGS, policy, 3) == 3
+    # Still capped by the policy
+    assert reconcile_executions(client, SETTINGS, policy, 10) == 4
+    assert client.start_count == 8
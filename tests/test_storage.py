@@ -0,0 +1,87 @@
+import pytest
+
+from launcher.storage import LocalStorage, MemoryStorage, StorageStats
+
+
+@pytest.fixture(params=["memory", "local"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStorage()
+    return LocalStorage(str(tmp_path))
+
+
+def test_put_and_download(storage):
+    storage.put_object("outputs", "d/abc/abc.in", "read\nend\n")
+    assert storage.download_file_str("outputs", "d/abc/abc.in") == "read\nend\n"
+    assert b"".join(storage.iter_chunks("outputs", "d/abc/abc.in")) == b"read\nend\n"
+    assert storage.object_exists("outputs", "d/abc/abc.in")
+    assert not storage.object_exists("outputs", "d/abc/abc.pqr")
+
+
+def test_missing_objects_raise(storage):
+    with pytest.raises(FileNotFoundError):
+        storage.download_with_etag("outputs", "d/abc/missing")
+    with pytest.raises(FileNotFoundError):
+        b"".join(storage.iter_chunks("outputs", "d/abc/missing"))
+
+
+def test_copy_and_delete(storage):
+    storage.put_object("inputs", "d/abc/abc.pqr", b"ATOM")
+    storage.copy_object("inputs", "d/abc/abc.pqr", "d/abc/abc.pqr", "outputs")
+    assert storage.download_file_str("outputs", "d/abc/abc.pqr") == "ATOM"
+    storage.delete_object("inputs", "d/abc/abc.pqr")
+    assert not storage.object_exists("inputs", "d/abc/abc.pqr")
+    # Deleting again is not an error
+    storage.delete_object("inputs", "d/abc/abc.pqr")
+
+
+def test_create_object_only_once(storage):
+    assert storage.create_object("outputs", "marker", "first")
+    assert not storage.create_object("outputs", "marker", "second")
+    assert storage.download_file_str("outputs", "marker") == "first"
+
+
+def test_replace_object_needs_current_etag(storage):
+    storage.put_object("outputs", "history", "one")
+    _, etag = storage.download_with_etag("outputs", "history")
+    assert storage.replace_object("outputs", "history", "two", etag)
+    # The ETag changed with the content
+    assert not storage.replace_object("outputs", "history", "three", etag)
+    data, new_etag = storage.download_with_etag("outputs", "history")
+    assert data == b"two"
+    assert new_etag != etag
+
+
+def test_replace_object_does_not_create(storage):
+    assert not storage.replace_object("outputs", "missing", "body", "etag")
+    assert not storage.object_exists("outputs", "missing")
+
+
+def test_stats_count_operations_and_bytes(storage):
+    storage.put_object("outputs", "a", b"12345")
+    storage.download_file_str("outputs", "a")
+    b"".join(storage.iter_chunks("outputs", "a"))
+    storage.create_object("outputs", "a", b"123")
+    counts = storage.stats.snapshot()
+    assert counts["operations"] == {
+        "upload": 1,
+        "download": 1,
+        "download_stream": 1,
+        "create": 1,
+    }
+    assert counts["bytes_read"] == 10
+    # Nothing is written by a create that finds the object
+    assert counts["bytes_written"] == 5
+
+
+def test_stats_reset():
+    stats = StorageStats()
+    stats.record("upload", bytes_written=3)
+    stats.add_bytes(bytes_read=4)
+    assert stats.snapshot() == {
+        "operations": {"upload": 1},
+        "bytes_read": 4,
+        "bytes_written": 3,
+    }
+    stats.reset()
+    assert stats.snapshot() == {"operations": {}, "bytes_read": 0, "bytes_written": 0}
@@ -0,0 +1,74 @@
+import pytest
+
+from launcher.sweep import SweepError, expand_parameters, expand_values
+
+
+@pytest.fixture(autouse=True)
+def default_limit(monkeypatch):
+    monkeypatch.delenv("SWEEP_MAX_CHILDREN", raising=False)
+
+
+def test_list_values():
+    assert expand_values("PH", [7, 7.5, "8"]) == ["7", "7.5", "8"]
+
+
+def test_range_is_inclusive_without_float_noise():
+    values = expand_values("PH", {"start": 4, "stop": 9, "step": 0.5})
+    assert len(values) == 11
+    assert values[0] == "4"
+    assert values[6] == "7"
+    assert values[-1] == "9"
+    assert expand_values("temp", {"start": 0.1, "stop": 0.3, "step": 0.1}) == [
+        "0.1",
+        "0.2",
+        "0.3",
+    ]
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        [],
+        "7",
+        {"start": 4, "stop": 9},
+        {"start": "a", "stop": 9, "step": 1},
+        {"start": 9, "stop": 4, "step": 1},
+        {"start": 4, "stop": 9, "step": 0},
+    ],
+)
+def test_invalid_values(spec):
+    with pytest.raises(SweepError):
+        expand_values("PH", spec)
+
+
+def test_every_combination():
+    combinations = expand_parameters(
+        "apbs", {"sdie": [2, 4], "temp": {"start": 290, "stop": 310, "step": 10}}
+    )
+    assert len(combinations) == 6
+    assert combinations[0] == {"sdie": "2", "temp": "290"}
+    assert combinations[-1] == {"sdie": "4", "temp": "310"}
+
+
+@pytest.mark.parametrize(
+    "job_type, parameters",
+    [
+        ("batch", {"PH": [7]}),
+        ("pdb2pqr", {}),
+        ("pdb2pqr", {"FF": ["amber"]}),
+        # Not part of the APBS web form
+        ("apbs", {"conc3": [0.1]}),
+    ],
+)
+def test_invalid_parameters(job_type, parameters):
+    with pytest.raises(SweepError):
+        expand_parameters(job_type, parameters)
+
+
+def test_combinations_are_limited(monkeypatch):
+    monkeypatch.setenv("SWEEP_MAX_CHILDREN", "10")
+    parameters = {"sdie": [2, 4, 8], "pdie": [1, 2, 4, 8]}
+    with pytest.raises(SweepError, match="12 combinations"):
+        expand_parameters("apbs", parameters)
+    monkeypatch.setenv("SWEEP_MAX_CHILDREN", "12")
+    assert len(expand_parameters("apbs", parameters)) == 12